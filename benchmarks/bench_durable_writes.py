@@ -0,0 +1,64 @@
+"""
+Rendimiento de escritura de storage.durable para cada política de fsync.
+
+Uso:  python benchmarks/bench_durable_writes.py [N] [DIRECTORIO]
+
+Escribe N ajustes de usuario (~400 bytes) con write_text directo (la escritura
+anterior, sin garantías), atomic_write uno a uno y write_many en grupos de 32.
+DIRECTORIO permite medir en el disco real del bot (por defecto, un temporal).
+
+write_many solo adelanta a atomic_write cuando hay fsync ("file" y "full"): agrupa
+los fsync de los archivos y, con "full", los del directorio. Con "none" cuesta lo
+mismo. Si el temporal está en memoria (tmpfs) el fsync es casi gratis y las
+diferencias desaparecen, así que conviene medir en el disco real.
+"""
+import sys
+import os
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(os.path.join(os.getcwd(), 'src'))
+
+from storage.durable import FSYNC_POLICIES, atomic_write, write_many
+from storage.users import DEFAULT_SETTINGS
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+BASE = Path(sys.argv[2]) if len(sys.argv) > 2 else None
+GROUP = 32
+
+payload = json.dumps(dict(DEFAULT_SETTINGS, loras=["detail_tweaker", "lcm_lora"], selected_model="dreamshaper_8"), ensure_ascii=False)
+
+def run(name, fn):
+    workdir = Path(tempfile.mkdtemp(dir=BASE))
+    try:
+        start = time.perf_counter()
+        fn(workdir)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{name:<28} {N / elapsed:>10.0f} escrituras/s  ({elapsed * 1000 / N:.3f} ms/escritura)")
+
+def plain(workdir):
+    for i in range(N):
+        (workdir / f"{i}.json").write_text(payload, encoding="utf-8")
+
+def single(policy):
+    def _run(workdir):
+        for i in range(N):
+            atomic_write(workdir / f"{i}.json", payload, policy=policy)
+    return _run
+
+def grouped(policy):
+    def _run(workdir):
+        for start in range(0, N, GROUP):
+            write_many(((workdir / f"{i}.json", payload) for i in range(start, min(N, start + GROUP))), policy=policy)
+    return _run
+
+print(f"{N} escrituras de {len(payload)} bytes en {BASE or tempfile.gettempdir()}\n")
+run("write_text (sin garantías)", plain)
+for policy in FSYNC_POLICIES:
+    run(f"atomic_write [{policy}]", single(policy))
+    run(f"write_many x{GROUP} [{policy}]", grouped(policy))
@@ -0,0 +1,75 @@
+"""
+Rendimiento de la composición del prompt final (modificadores + preset + LoRA).
+
+Uso:  python benchmarks/bench_prompt_composer.py [N]
+
+Compara la versión anterior (compose_prompt de main.py más deduplicate_prompts de
+JobQueue._build_spec, que buscaba cada tag como subcadena del prompt) con el pipeline
+(prompt_composer al crear el trabajo y preset_composer al generar), con y sin preset,
+en prompts por segundo. Cada prompt de usuario es distinto, así que solo los de
+preset y modificadores aprovechan la caché.
+"""
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.getcwd(), 'src'))
+
+from utils.prompt_composer import preset_composer, prompt_composer
+from pressets.pressets import get_preset_for_model
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+PROMPTS = {
+    "corto": "1girl, solo, smile",
+    "medio": "1girl, solo, long hair, looking at viewer, smile, (masterpiece:1.2), outdoors, cherry blossoms, best quality",
+    "largo": ", ".join(f"tag {i}" for i in range(60)) + ", <lora:detail:0.6>, (4k, 8k), highres",
+}
+
+SETTINGS = {
+    "pre_modifiers": ["masterpiece, best quality", "ultra detailed"],
+    "post_modifiers": ["film grain, noisy", "bloom, soft glow"],
+    "loras": ["add_detail", "style_anime"],
+}
+
+def legacy_compose(prompt, settings, preset):
+    # main.compose_prompt
+    lora = " ".join(f"<lora:{name}:1>" for name in settings.get("loras", []))
+    parts = [", ".join(settings.get("pre_modifiers", [])), prompt, ", ".join(settings.get("post_modifiers", [])), lora]
+    prompt = ", ".join(filter(None, parts))
+    if preset is None:
+        return prompt
+    # deduplicate_prompts de JobQueue._build_spec
+    def dedup(user_prompt, additional):
+        if not additional:
+            return ""
+        user_lower = user_prompt.lower()
+        return ", ".join(t for t in (t.strip() for t in additional.split(',')) if t.lower() not in user_lower)
+    final = prompt
+    pre = dedup(prompt, preset.pre_prompt)
+    if pre:
+        final = f"{pre}, {final}"
+    post = dedup(prompt, preset.post_prompt)
+    if post:
+        final = f"{final}, {post}"
+    return final
+
+def pipeline_compose(prompt, settings, preset):
+    # main.txt2img compone una vez; JobQueue._build_spec solo añade el preset
+    return preset_composer.compose(prompt_composer.compose(prompt, settings), preset=preset)
+
+def run(name, fn, prompt, preset):
+    prompts = [f"{prompt}, variation {i}" for i in range(N)]
+    start = time.perf_counter()
+    for p in prompts:
+        fn(p, SETTINGS, preset)
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<12} {N / elapsed:>12,.0f} prompts/s")
+
+preset = get_preset_for_model("waiIllustriousSDXL_v150")
+print(f"{N} prompts por caso; preset: {preset.model_name}\n")
+for label, prompt in PROMPTS.items():
+    for preset_label, p in (("sin preset", None), ("con preset", preset)):
+        print(f"{label}, {preset_label}:")
+        run("anterior", legacy_compose, prompt, p)
+        run("pipeline", pipeline_compose, prompt, p)
@@ -0,0 +1,61 @@
+"""
+Coste por prompt de PromptGenerator.generate con los resources/*.txt reales.
+
+Uso:  python benchmarks/bench_prompt_generator.py [N]
+
+Compara la versión anterior (regex compilado en cada llamada, dict.fromkeys y
+random.sample por aparición) con la plantilla compilada, para prompts sin claves,
+con una clave y con varias, y con las estrategias sample_subset(33) y all_values.
+"""
+import sys
+import os
+import random
+import re
+import time
+
+sys.path.append(os.path.join(os.getcwd(), 'src'))
+
+from utils.prompt_generator import PromptGenerator, all_values, sample_subset
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+PROMPTS = {
+    "sin claves": "masterpiece, best quality, a girl standing in a field of flowers, detailed background",
+    "1 clave": "masterpiece, best quality, f_anime, detailed background",
+    "4 claves": "f_anime, r_action, in r_place, r_light, r_angle, by r_artist",
+}
+
+generator = PromptGenerator("resources")
+
+def legacy_generate(template):
+    # PromptGenerator.generate antes de la plantilla compilada
+    pattern = re.compile(r"\b(r_color|r_artist|r_place|r_style|r_action|r_object|f_anime|m_anime|r_light|r_angle)\b")
+    def replace_match(match):
+        key = match.group(1)
+        values = generator.replacements.get(key, [f"!{key.upper()}!"])
+        unique_values = list(dict.fromkeys(values))
+        if len(unique_values) > 33:
+            selected_values = random.sample(unique_values, 33)
+        else:
+            selected_values = unique_values
+        return "{" + "|".join(selected_values) + "}"
+    return pattern.sub(replace_match, template)
+
+def run(name, fn, template):
+    start = time.perf_counter()
+    for _ in range(N):
+        fn(template)
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<26} {elapsed * 1e6 / N:>8.2f} µs/prompt")
+
+sizes = ", ".join(f"{k}={len(v)}" for k, v in generator.replacements.items())
+print(f"{N} prompts por caso; recursos: {sizes}\n")
+engines = {
+    "anterior": legacy_generate,
+    "compilado sample_subset(33)": PromptGenerator("resources", sampler=sample_subset(33)).generate,
+    "compilado all_values": PromptGenerator("resources", sampler=all_values).generate,
+}
+for label, template in PROMPTS.items():
+    print(f"{label}:")
+    for name, fn in engines.items():
+        run(name, fn, template)
@@ -1,2 +1,132 @@
 A1111_URL = "http://localhost:7860"
-# A1111_URL = "https://64b323dfdef939dea8.gradio.live"
\ No newline at end of file
+# A1111_URL = "https://64b323dfdef939dea8.gradio.live"
+
+# Pool de conexiones HTTP hacia A1111 (keep-alive compartido por todas las llamadas)
+A1111_POOL_SIZE = 8
+A1111_KEEPALIVE = 60  # segundos que una conexión ociosa permanece abierta
+A1111_CONNECT_TIMEOUT = 10
+
+# Timeouts totales (segundos) por endpoint, clave "MÉTODO ruta"
+A1111_TIMEOUTS = {
+    "default": 10,
+    "GET /sdapi/v1/progress": 5,
+    "POST /sdapi/v1/options": 300,  # cambiar de checkpoint puede tardar bastante
+    "POST /sdapi/v1/txt2img": 300,
+    "POST /sdapi/v1/extra-single-image": 300,
+}
+
+# Caché de metadatos de A1111 (samplers, schedulers, loras, modelos, ADetailer)
+A1111_METADATA_TTL = 300  # segundos que una lista se considera fresca
+A1111_METADATA_STALE_TTL = 3600  # ventana extra en la que se sirve la lista vieja mientras se refresca
+
+# Cada cuánto se reconcilia en segundo plano el modelo cargado con /sdapi/v1/options
+A1111_MODEL_RECONCILE_INTERVAL = 120
+
+# Servidores A1111 entre los que se reparten las generaciones. El primero es el
+# principal (menús, upscale, extras). "concurrency": generaciones simultáneas por servidor
+A1111_BACKENDS = [
+    {"name": "principal", "url": A1111_URL, "concurrency": 1},
+    # {"name": "gpu2", "url": "http://192.168.1.20:7860", "concurrency": 1},
+]
+A1111_ROUTING = "affinity"  # "affinity" (prefiere el que ya tiene el checkpoint) o "least_loaded"
+A1111_HEALTH_INTERVAL = 30  # segundos entre sondeos de salud
+A1111_MAX_FAILURES = 2  # errores seguidos para dar un servidor por caído
+A1111_FAILOVER_ATTEMPTS = 2  # reintentos de un trabajo en otro servidor si el suyo falla
+
+# Planificación de la cola: cuántas veces puede adelantarse un trabajo pendiente
+# para aprovechar el checkpoint ya cargado antes de forzar el cambio de modelo
+JOBQUEUE_MAX_BYPASS = 3
+
+# Fusión opcional de trabajos compatibles en un único txt2img (usa batch_size de A1111).
+# La API acepta un solo prompt por petición, así que solo se fusionan trabajos con el mismo
+# prompt final y los mismos parámetros y seed aleatoria (p. ej. varios "Repetir" del mismo
+# prompt o el modo automático); prompts distintos nunca comparten lote
+JOBQUEUE_BATCHING = False
+JOBQUEUE_BATCH_MAX_IMAGES = 4  # imágenes máximas por lote (limitado por la VRAM)
+
+# Reparto de la cola: clases de prioridad por tipo de operación (menor = antes) y
+# deficit round-robin entre usuarios dentro de cada clase
+JOBQUEUE_PRIORITIES = {"txt2img": 0, "upscale_hr": 1, "repeat": 1, "newseed": 1}
+JOBQUEUE_AUTO_PRIORITY = 2  # trabajos reencolados por el modo automático
+JOBQUEUE_DRR_QUANTUM = 1  # imágenes de crédito que gana cada usuario por vuelta
+JOBQUEUE_MAX_PER_USER = 5  # trabajos en cola por usuario (0 = sin límite)
+
+# Control de admisión: se rechazan trabajos nuevos si la cola está llena, si el usuario
+# envía demasiado seguido o si la espera estimada supera el umbral (0 desactiva cada límite)
+JOBQUEUE_MAX_PENDING = 50  # trabajos en cola en total
+ADMISSION_MAX_WAIT = 900  # segundos de espera estimada
+ADMISSION_USER_RATE = 6  # trabajos por minuto por usuario
+ADMISSION_USER_BURST = 3
+ADMISSION_SECONDS_PER_IMAGE = 8.0  # estimación inicial hasta medir generaciones reales
+ADMISSION_EWMA_ALPHA = 0.2  # peso de cada generación nueva en la media de segundos por imagen
+
+# Resultados generados a la espera de ser entregados; si se llena, la generación espera
+JOBQUEUE_DELIVERY_QUEUE_SIZE = 4
+
+# Diario SQLite de la cola (en data/): los trabajos sin terminar se reencolan al arrancar
+QUEUE_JOURNAL = True
+QUEUE_JOURNAL_PATH = "queue.sqlite3"
+
+# Sondeo de progreso: intervalo adaptativo según la ETA de A1111 (segundos)
+PROGRESS_MIN_INTERVAL = 0.75
+PROGRESS_MAX_INTERVAL = 5.0
+
+# Ediciones de mensajes de progreso en Telegram (mensajes por segundo)
+TELEGRAM_EDIT_GLOBAL_RATE = 20
+TELEGRAM_EDIT_CHAT_RATE = 0.5
+TELEGRAM_EDIT_CHAT_BURST = 3
+
+# Subidas de imágenes a Telegram (la URL puede apuntar a un servidor Bot API local)
+TELEGRAM_API_URL = "https://api.telegram.org"
+TELEGRAM_UPLOAD_POOL_SIZE = 8
+TELEGRAM_UPLOAD_PER_CHAT = 1  # subidas simultáneas por chat (1 conserva el orden de las imágenes)
+
+# Modo de entrega: "document" sube el PNG original; "preview" envía una foto comprimida
+# y guarda el PNG en disco para enviarlo solo si el usuario lo pide (requiere Pillow)
+DELIVERY_MODE = "document"
+PREVIEW_FORMAT = "JPEG"  # "JPEG" o "WEBP"
+PREVIEW_QUALITY = 85
+PREVIEW_MAX_SIDE = 1280  # Telegram reescala las fotos a 1280 px de todos modos
+PREVIEW_ENCODE_WORKERS = 2  # hilos dedicados a la recompresión
+
+# Payloads de los botones inline: LRU acotado en memoria; lo expulsado pasa a data/callbacks
+REQUEST_STORE_MAX_ENTRIES = 5000
+REQUEST_STORE_TTL = 7 * 24 * 3600  # segundos que un botón sigue respondiendo
+REQUEST_STORE_SPILL = True
+
+# Listas de palabras para los prompts (cada resources/*.txt es una clave, p. ej. r_color).
+# Se recargan solas si cambian; los packs de resources/packs/<nombre>/ añaden o
+# sustituyen claves para un chat concreto o para un preset (Preset.resource_pack)
+RESOURCES_DIR = "resources"
+RESOURCE_RELOAD_INTERVAL = 2.0  # segundos mínimos entre comprobaciones de cambios
+RESOURCE_CHAT_PACKS = {}  # chat_id -> nombre del pack
+# "choices": cada clave se envía como bloque {a|b|c} y A1111 elige.
+# "local": el bot elige un valor concreto con la seed de la generación (prompt corto y reproducible)
+PROMPT_EXPANSION = "choices"
+
+# Presets recomendados por modelo (JSON, se recarga solo si cambia). None usa el de
+# src/pressets/presets.json; otra ruta permite mantener los presets fuera del código
+PRESETS_FILE = None
+
+# Almacenamiento de ajustes, trabajos y mensajes de error: "json" (un archivo por
+# registro en data/) o "sqlite" (una base en data/, migrar antes con `python -m storage.migrate`)
+STORAGE_BACKEND = "json"
+STORAGE_SQLITE_PATH = "bot.sqlite3"  # relativo a data/
+# Durabilidad de las escrituras: "none" (temporal + rename), "file" (+ fsync del archivo)
+# o "full" (+ fsync del directorio). En SQLite equivale a synchronous OFF/NORMAL/FULL
+STORAGE_FSYNC = "file"
+
+# Caché de ajustes de usuario en memoria; los cambios se vuelcan juntos tras este retardo
+USER_SETTINGS_CACHE_SIZE = 1000
+USER_SETTINGS_FLUSH_DELAY = 2.0  # segundos
+
+# Mensajes de error pendientes de borrar (motor JSON): el registro de altas/bajas se
+# compacta en data/error_messages.json cada N entradas
+ERROR_LOG_COMPACT_EVERY = 500
+# Limpieza al arrancar: Telegram borra hasta 100 mensajes por llamada a deleteMessages
+ERROR_CLEANUP_CONCURRENCY = 4  # chats limpiados en paralelo
+
+# Retención del historial de trabajos enviados (None desactiva cada límite)
+JOB_RETENTION_DAYS = 30
+JOB_RETENTION_PER_USER = 500  # trabajos más recientes que se conservan por usuario
+JOB_REAPER_INTERVAL = 3600  # segundos entre pasadas de limpieza
@@ -0,0 +1,86 @@
+import time
+from dataclasses import dataclass
+from typing import Dict
+
+from utils.rate_limit import TokenBucket
+
+@dataclass
+class Admission:
+    accepted: bool
+    reason: str = ""  # "user_cap", "full", "rate" o "wait" cuando se rechaza
+    eta: float = 0.0  # espera estimada (segundos) hasta que empiece el trabajo
+    retry_after: float = 0.0  # segundos tras los que tiene sentido reintentar
+
+class AdmissionController:
+    """
+    Decide si un trabajo nuevo entra en la cola.
+
+    Rechaza cuando el usuario ya tiene `per_user_cap` trabajos esperando, cuando la
+    cola tiene `max_pending`, cuando el usuario supera su ritmo (token bucket de
+    `user_rate` trabajos/minuto) o cuando la espera estimada supera `max_wait`. La
+    espera se estima con una media móvil exponencial de los segundos por imagen de
+    las últimas generaciones, repartida entre los slots de generación.
+    """
+    def __init__(self, max_pending: int, per_user_cap: int, max_wait: float, user_rate: float, user_burst: float, seconds_per_image: float = 8.0, alpha: float = 0.2):
+        self.max_pending = max_pending
+        self.per_user_cap = per_user_cap
+        self.max_wait = max_wait
+        self.user_rate = user_rate / 60.0
+        self.user_burst = user_burst
+        self.seconds_per_image = seconds_per_image
+        self.alpha = alpha
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._last_prune = time.monotonic()
+        self.rejected: Dict[str, int] = {}
+
+    def record(self, seconds: float, images: int) -> None:
+        """Registra la duración de una generación terminada."""
+        if images <= 0 or seconds <= 0:
+            return
+        sample = seconds / images
+        self.seconds_per_image += self.alpha * (sample - self.seconds_per_image)
+
+    def estimate(self, images_ahead: float, slots: int = 1) -> float:
+        return images_ahead * self.seconds_per_image / max(1, slots)
+
+    def check(self, user_id: int, user_pending: int, pending: int, images_ahead: float, slots: int = 1, charge: bool = True) -> Admission:
+        """
+        Evalúa un trabajo de `user_id`. `images_ahead` son las imágenes que se generarán
+        antes que él (cola de igual o mayor prioridad y generaciones en curso). Con
+        `charge`, un trabajo aceptado consume un token del usuario.
+        """
+        eta = self.estimate(images_ahead, slots)
+        if self.per_user_cap and user_pending >= self.per_user_cap:
+            return self._reject("user_cap", eta, retry_after=eta / max(1, user_pending))
+        if self.max_pending and pending >= self.max_pending:
+            return self._reject("full", eta, retry_after=self.estimate(1, slots))
+        bucket = self._bucket(user_id) if charge and self.user_rate > 0 else None
+        if bucket is not None:
+            wait = bucket.time_until()
+            if wait > 0:
+                return self._reject("rate", eta, retry_after=wait)
+        if self.max_wait and eta > self.max_wait:
+            return self._reject("wait", eta, retry_after=eta - self.max_wait)
+        if bucket is not None:
+            bucket.try_acquire()
+        return Admission(True, eta=eta)
+
+    def _reject(self, reason: str, eta: float, retry_after: float) -> Admission:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return Admission(False, reason, eta, max(1.0, retry_after))
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        self._prune()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    def _prune(self) -> None:
+        # Un bucket lleno equivale a uno nuevo: se descartan para no crecer sin límite
+        now = time.monotonic()
+        if now - self._last_prune < 300:
+            return
+        self._last_prune = now
+        for user_id in [u for u, b in self._buckets.items() if b.time_until(b.capacity) == 0]:
+            del self._buckets[user_id]
@@ -1,20 +1,83 @@
 import asyncio
-import aiohttp
+import contextlib
+import time
+import uuid
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional, Tuple
 from io import BytesIO
 from telegram import InputFile, InlineKeyboardMarkup, InlineKeyboardButton
-from services.a1111 import a1111_txt2img, a1111_get_progress, get_current_model, set_sd_model, fetch_sd_models, fetch_adetailer_models
+from services.a1111 import a1111_txt2img, set_sd_model, fetch_sd_models, fetch_adetailer_models
+from services.a1111_pool import A1111Backend, a1111_pool, is_backend_failure
 from pressets.pressets import get_preset_for_model
 from storage.users import load_user_settings
-from utils.formatting import FormatText, format_generation_complete
+from jobqueue.scheduler import JobScheduler
+from jobqueue.progress import ProgressMonitor
+from services.telegram_edits import EditDispatcher
+from services.telegram_upload import TelegramUploader
+from config import (
+    JOBQUEUE_MAX_BYPASS,
+    JOBQUEUE_BATCHING,
+    JOBQUEUE_BATCH_MAX_IMAGES,
+    PROGRESS_MIN_INTERVAL,
+    PROGRESS_MAX_INTERVAL,
+    TELEGRAM_EDIT_GLOBAL_RATE,
+    TELEGRAM_EDIT_CHAT_RATE,
+    TELEGRAM_EDIT_CHAT_BURST,
+    TELEGRAM_API_URL,
+    TELEGRAM_UPLOAD_POOL_SIZE,
+    TELEGRAM_UPLOAD_PER_CHAT,
+    JOBQUEUE_DELIVERY_QUEUE_SIZE,
+    JOBQUEUE_PRIORITIES,
+    JOBQUEUE_AUTO_PRIORITY,
+    JOBQUEUE_DRR_QUANTUM,
+    JOBQUEUE_MAX_PER_USER,
+    JOBQUEUE_MAX_PENDING,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_USER_RATE,
+    ADMISSION_USER_BURST,
+    ADMISSION_SECONDS_PER_IMAGE,
+    ADMISSION_EWMA_ALPHA,
+    A1111_FAILOVER_ATTEMPTS,
+    QUEUE_JOURNAL,
+    QUEUE_JOURNAL_PATH,
+    STORAGE_FSYNC,
+    DELIVERY_MODE,
+    PREVIEW_FORMAT,
+    PREVIEW_QUALITY,
+    PREVIEW_MAX_SIDE,
+    PREVIEW_ENCODE_WORKERS,
+    REQUEST_STORE_MAX_ENTRIES,
+    REQUEST_STORE_TTL,
+    REQUEST_STORE_SPILL,
+    PROMPT_EXPANSION,
+)
+from utils.formatting import FormatText, format_generation_complete, format_queue_rejected, format_queue_status
+from utils.imaging import PREVIEW_CONTENT_TYPES, encode_preview_async, previews_available
+from storage.originals import delete_original, save_original
+from storage.callbacks import RequestStore, SPILL_DIR as CALLBACK_SPILL_DIR
+from storage.backend import DATA_DIR
+from storage.durable import SQLITE_SYNCHRONOUS
+from jobqueue.journal import QueueJournal
+from jobqueue.admission import Admission, AdmissionController
 import logging
-import json
 import random
 from utils.common import ratio_to_dims
+from utils.prompt_generator import prompt_generator, resource_pack_for
+from utils.prompt_composer import preset_composer
+
+class QueueFullError(Exception):
+    """
+    La cola (o la parte del usuario) está llena: JOBQUEUE_MAX_PENDING / JOBQUEUE_MAX_PER_USER.
+    `reason`, `eta` y `retry_after` siguen el formato de Admission para mostrar el rechazo.
+    """
+    def __init__(self, message: str, reason: str, eta: float = 0.0, retry_after: float = 0.0):
+        super().__init__(message)
+        self.reason = reason
+        self.eta = eta
+        self.retry_after = retry_after
 
 class GenJob:
-    def __init__(self, user_id: int, chat_id: int, prompt: str, status_message_id: int, user_name: str, overrides: Optional[dict] = None, hr_options: Optional[dict] = None, alwayson_scripts: Optional[dict] = None, operation_type: str = "txt2img", operation_metadata: Optional[dict] = None):
+    def __init__(self, user_id: int, chat_id: int, prompt: str, status_message_id: int, user_name: str, overrides: Optional[dict] = None, hr_options: Optional[dict] = None, alwayson_scripts: Optional[dict] = None, operation_type: str = "txt2img", operation_metadata: Optional[dict] = None, priority: Optional[int] = None):
         self.user_id = user_id
         self.chat_id = chat_id
         self.prompt = prompt
@@ -25,45 +88,335 @@ class GenJob:
         self.alwayson_scripts = alwayson_scripts
         self.operation_type = operation_type  # "txt2img", "upscale_hr", "repeat", "newseed"
         self.operation_metadata = operation_metadata or {}  # Additional context for messages
+        self.target_model: Optional[str] = None  # Checkpoint pedido al encolar (pista para el planificador)
+        self.priority = JOBQUEUE_PRIORITIES.get(operation_type, 0) if priority is None else priority  # menor = antes
+        self.cost = 1  # imágenes que generará (coste en el reparto justo); se calcula al encolar
+        self.queue_position: Optional[int] = None  # Última posición mostrada en el mensaje de estado
+        self.recovered = False  # Reencolado desde el diario tras un reinicio
+        self.last_progress = -1.0  # Último progreso mostrado en el mensaje de estado
+        self.job_id = uuid.uuid4().hex  # Clave en el diario de la cola
+
+    # Campos que sobreviven a un reinicio (diario de la cola)
+    _PERSISTED = ("job_id", "user_id", "chat_id", "prompt", "status_message_id", "user_name", "overrides",
+                  "hr_options", "alwayson_scripts", "operation_type", "operation_metadata", "target_model",
+                  "priority", "cost")
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self._PERSISTED}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GenJob":
+        job = cls(
+            user_id=data["user_id"],
+            chat_id=data["chat_id"],
+            prompt=data["prompt"],
+            status_message_id=data["status_message_id"],
+            user_name=data["user_name"],
+            overrides=data.get("overrides"),
+            hr_options=data.get("hr_options"),
+            alwayson_scripts=data.get("alwayson_scripts"),
+            operation_type=data.get("operation_type", "txt2img"),
+            operation_metadata=data.get("operation_metadata"),
+            priority=data.get("priority"),
+        )
+        job.job_id = data.get("job_id", job.job_id)
+        job.target_model = data.get("target_model")
+        job.cost = data.get("cost", job.cost)
+        return job
+
+# Operation-specific titles and emojis
+_OPERATION_TITLES = {
+    "txt2img": ("🎨", "Generando Imagen"),
+    "upscale_hr": ("🔍", "Generando con Upscale HR"),
+    "repeat": ("🔄", "Repitiendo Generación"),
+    "newseed": ("🎲", "Nueva Variación")
+}
+
+def _format_progress(job: "GenJob", prog_data: dict) -> str:
+    progress = prog_data.get("progress", 0)
+    eta = prog_data.get("eta_relative", 0)
+    bar_len = 10
+    filled = int(progress * bar_len)
+    bar = "▓" * filled + "░" * (bar_len - filled)
+    pct = int(progress * 100)
+    
+    # Extract step info from state
+    state = prog_data.get("state", {})
+    current_step = state.get("sampling_step", 0)
+    total_steps = state.get("sampling_steps", 0)
+    job_no = state.get("job_no", 0)
+    job_count = state.get("job_count", 0)
+    
+    emoji, title = _OPERATION_TITLES.get(job.operation_type, ("🎨", "Generando"))
+    
+    # Build enhanced message with visual separator
+    # Use final_prompt if available (with pre/post prompts), otherwise use original
+    display_prompt = getattr(job, 'final_prompt', job.prompt)
+    prompt_preview = display_prompt[:45] + "..." if len(display_prompt) > 45 else display_prompt
+    
+    msg_parts = [
+        f"{FormatText.bold(FormatText.emoji(f'{emoji} {title}', '⏳'))}",
+        "━━━━━━━━━━━━━━━━━━━━",
+        f"{FormatText.code(f'[{bar}] {pct}%')}"
+    ]
+    
+    # Progress section
+    progress_info = []
+    if total_steps > 0:
+        progress_info.append(f"Step: {FormatText.code(f'{current_step}/{total_steps}')}")
+    if job_count > 1:
+        progress_info.append(f"Imagen: {FormatText.code(f'{job_no}/{job_count}')}")
+    if eta > 0:
+        progress_info.append(f"ETA: {FormatText.code(f'~{int(eta)}s')}")
+    
+    if progress_info:
+        msg_parts.append("")
+        msg_parts.append(f"{FormatText.bold('📊 Progreso:')}")
+        for info in progress_info:
+            msg_parts.append(f"  • {info}")
+    
+    # Configuration section (if metadata available)
+    if job.operation_metadata:
+        msg_parts.append("")
+        msg_parts.append(f"{FormatText.bold('🔧 Configuración:')}")
+        
+        if "hr_scale" in job.operation_metadata:
+            hr_scale_val = f"{job.operation_metadata['hr_scale']}x"
+            msg_parts.append(f"  • Factor: {FormatText.code(hr_scale_val)}")
+        if "upscaler" in job.operation_metadata:
+            msg_parts.append(f"  • Upscaler: {FormatText.code(job.operation_metadata['upscaler'])}")
+        if "denoising" in job.operation_metadata:
+            msg_parts.append(f"  • Denoising: {FormatText.code(str(job.operation_metadata['denoising']))}")
+    
+    # Prompt preview
+    msg_parts.append("")
+    msg_parts.append(f"{FormatText.italic(f'💬 {prompt_preview}')}")
+    
+    return "\n".join(msg_parts)
+
+def _job_params(job: GenJob, s: dict) -> tuple:
+    """(width, height, steps, cfg, sampler, scheduler, n_iter, seed) de los ajustes del usuario y los overrides del trabajo, antes del preset."""
+    w, h = ratio_to_dims(s.get("aspect_ratio", "1:1"), s.get("base_size", 512))
+    steps = int(s.get("steps", 4))
+    cfg = float(s.get("cfg_scale", 1.0))
+    sampler = s.get("sampler_name", "LCM")
+    scheduler = s.get("scheduler", "")
+    n_images = int(s.get("n_iter", 1))
+    seed = -1
+    if job.overrides:
+        steps = int(job.overrides.get("steps", steps))
+        cfg = float(job.overrides.get("cfg_scale", cfg))
+        sampler = job.overrides.get("sampler_name", sampler)
+        scheduler = job.overrides.get("scheduler", scheduler)
+        w = int(job.overrides.get("width", w))
+        h = int(job.overrides.get("height", h))
+        n_images = int(job.overrides.get("n_iter", n_images))
+        seed = int(job.overrides.get("seed", seed))
+    return w, h, steps, cfg, sampler, scheduler, n_images, seed
+
+def _batch_hint(job: GenJob, s: dict) -> Optional[tuple]:
+    """
+    Filtro barato previo a _batch_key, solo con campos del trabajo y sus ajustes (sin
+    preset, composición ni expansión): dos trabajos con distinta pista no se fusionan.
+    """
+    if job.operation_type == "upscale_hr" or job.hr_options or job.alwayson_scripts:
+        return None
+    w, h, steps, cfg, sampler, scheduler, _, seed = _job_params(job, s)
+    if seed != -1:
+        return None
+    if PROMPT_EXPANSION == "local" and prompt_generator.has_keys(job.prompt):
+        return None  # cada trabajo expande sus claves con su propia seed
+    return (job.prompt, w, h, steps, cfg, sampler, scheduler)
+
+def _batch_key(spec: dict) -> Optional[tuple]:
+    """
+    Clave de compatibilidad para fusionar trabajos en un mismo txt2img, o None si no se puede.
+    La API de A1111 solo acepta un prompt por petición, así que el prompt final debe coincidir;
+    con seed -1 cada imagen del lote recibe su propia seed.
+    """
+    if spec["seed"] != -1 or spec["hr_options"] or spec["alwayson_scripts"]:
+        return None
+    return (
+        spec["prompt"], spec["negative_prompt"], spec["width"], spec["height"],
+        spec["steps"], spec["cfg_scale"], spec["sampler_name"], spec["scheduler"],
+    )
+
+def _split_result(res: dict, counts: List[int]) -> List[dict]:
+    """Reparte imágenes, all_prompts y all_seeds de un txt2img por lotes entre los trabajos de origen."""
+    if len(counts) == 1:
+        return [res]
+    images = res.get("images") or []
+    info = res.get("info") or {}
+    parts = []
+    offset = 0
+    for n in counts:
+        part_info = dict(info)
+        for key in ("all_prompts", "all_seeds", "all_subseeds", "infotexts"):
+            if isinstance(info.get(key), list):
+                part_info[key] = info[key][offset:offset + n]
+        parts.append({"images": images[offset:offset + n], "parameters": res.get("parameters"), "info": part_info})
+        offset += n
+    return parts
 
 class JobQueue:
-    def __init__(self, concurrency: int = 2):
-        self.q = asyncio.Queue()
+    """
+    Pipeline de dos etapas: workers de generación que solo hablan con A1111 (uno por
+    slot del pool de servidores) y un pool de `concurrency` workers de entrega
+    (captions, subidas, save_job, teclados y auto-reencolado), conectados por una
+    cola acotada. Así el siguiente txt2img empieza en cuanto llegan las imágenes del anterior.
+    """
+    def __init__(self, concurrency: int = 2, delivery_queue_size: int = JOBQUEUE_DELIVERY_QUEUE_SIZE, pool=a1111_pool):
+        self.pool = pool
+        self.q = JobScheduler(pool.has_loaded, max_bypass=JOBQUEUE_MAX_BYPASS, quantum=JOBQUEUE_DRR_QUANTUM)
         self.concurrency = concurrency
+        # Resultados pendientes de entregar; si se llena, la generación espera (acota la memoria de imágenes)
+        self.deliveries: asyncio.Queue = asyncio.Queue(maxsize=delivery_queue_size)
+        # Diario en disco de los trabajos sin terminar (se reencolan al arrancar)
+        self.journal = QueueJournal(DATA_DIR / QUEUE_JOURNAL_PATH, SQLITE_SYNCHRONOUS[STORAGE_FSYNC]) if QUEUE_JOURNAL else None
         self.workers = []
         self.bot = None
-        # Semaphore to ensure only 1 job is generating at a time
-        # This prevents multiple jobs from showing the same progress
-        self.generation_semaphore = asyncio.Semaphore(1)
+        # Métricas de cambios de checkpoint (para medir el efecto de la afinidad de modelo)
+        self.model_swaps = 0
+        self.model_swaps_skipped = 0
+        # Un sondeo de progreso por servidor, compartido por todos los trabajos que genera
+        self.progress = {}
+        for backend in pool.backends:
+            monitor = ProgressMonitor(backend.get_progress, min_interval=PROGRESS_MIN_INTERVAL, max_interval=PROGRESS_MAX_INTERVAL)
+            monitor.subscribe(self._on_progress)
+            self.progress[backend.name] = monitor
+        self.failovers = 0
+        # Admisión de trabajos nuevos: cola acotada, ritmo por usuario y espera estimada
+        self.admission = AdmissionController(
+            max_pending=JOBQUEUE_MAX_PENDING,
+            per_user_cap=JOBQUEUE_MAX_PER_USER,
+            max_wait=ADMISSION_MAX_WAIT,
+            user_rate=ADMISSION_USER_RATE,
+            user_burst=ADMISSION_USER_BURST,
+            seconds_per_image=ADMISSION_SECONDS_PER_IMAGE,
+            alpha=ADMISSION_EWMA_ALPHA,
+        )
+        self.in_flight_images = 0  # imágenes que se están generando ahora mismo
+        # Ediciones de los mensajes de estado, con límite de ritmo y coalescencia
+        self.edits = EditDispatcher(
+            global_rate=TELEGRAM_EDIT_GLOBAL_RATE,
+            global_burst=TELEGRAM_EDIT_GLOBAL_RATE,
+            chat_rate=TELEGRAM_EDIT_CHAT_RATE,
+            chat_burst=TELEGRAM_EDIT_CHAT_BURST,
+        )
+        # Subidas de imágenes por una sesión compartida con límite por chat
+        self.uploader = TelegramUploader(pool_size=TELEGRAM_UPLOAD_POOL_SIZE, per_chat=TELEGRAM_UPLOAD_PER_CHAT, base_url=TELEGRAM_API_URL)
 
     async def start(self, bot):
+        if DELIVERY_MODE == "preview" and not previews_available():
+            logging.warning("DELIVERY_MODE='preview' requiere Pillow; se enviarán los PNG originales")
         self.bot = bot
+        self.edits.start(bot)
+        await self.uploader.start(bot.token)
+        await self._replay()
+        for _ in range(self.pool.capacity):
+            self.workers.append(asyncio.create_task(self._generation_worker()))
         for _ in range(self.concurrency):
-            self.workers.append(asyncio.create_task(self._worker()))
+            self.workers.append(asyncio.create_task(self._delivery_worker()))
 
     async def stop(self):
         for w in self.workers:
             w.cancel()
+        # Esperar a que terminen sus finally (journal.complete) antes de cerrar el diario
+        await asyncio.gather(*self.workers, return_exceptions=True)
         self.workers = []
+        await self.edits.stop()
+        await self.uploader.close()
+        if self.journal is not None:
+            # Lo pendiente ya está en el diario; cerrar vuelca el WAL en la base
+            self.journal.close()
+
+    def stats(self) -> dict:
+        """Métricas de la cola para /status."""
+        return {
+            "pending": self.q.qsize(),
+            "in_flight_images": self.in_flight_images,
+            "model_swaps": self.model_swaps,
+            "model_swaps_skipped": self.model_swaps_skipped,
+            "failovers": self.failovers,
+            "backends": self.pool.status(),
+            "requests": _REQ_STORE.stats(),
+        }
+
+    def admit(self, user_id: int, cost: int = 1, priority: int = 0, charge: bool = True) -> Admission:
+        """
+        Decide si se acepta un trabajo nuevo antes de crearlo. Con `charge` (peticiones
+        del usuario) cuenta para su límite de ritmo; el modo automático no lo usa.
+        """
+        ahead = self.q.pending_cost(priority) + self.in_flight_images
+        decision = self.admission.check(
+            user_id,
+            user_pending=self.q.count(user_id),
+            pending=self.q.qsize(),
+            images_ahead=ahead,
+            slots=self.pool.capacity,
+            charge=charge,
+        )
+        if not decision.accepted:
+            logging.info(f"Admisión rechazada para usuario {user_id}: {decision.reason} (espera estimada {decision.eta:.0f}s, cola {self.q.qsize()})")
+        return decision
 
     async def enqueue(self, job: GenJob):
+        # Límites duros; la decisión con mensaje al usuario se toma antes con admit()
+        if JOBQUEUE_MAX_PENDING and self.q.qsize() >= JOBQUEUE_MAX_PENDING:
+            eta = self.admission.estimate(self.q.pending_cost(job.priority) + self.in_flight_images, self.pool.capacity)
+            raise QueueFullError("La cola está llena; inténtalo de nuevo en unos minutos", "full", eta, max(1.0, self.admission.estimate(1, self.pool.capacity)))
+        user_pending = self.q.count(job.user_id)
+        if JOBQUEUE_MAX_PER_USER and user_pending >= JOBQUEUE_MAX_PER_USER:
+            eta = self.admission.estimate(self.q.pending_cost(job.priority) + self.in_flight_images, self.pool.capacity)
+            raise QueueFullError(f"Ya tienes {JOBQUEUE_MAX_PER_USER} trabajos en cola; espera a que termine alguno", "user_cap", eta, max(1.0, eta / user_pending))
+        s = load_user_settings(job.user_id)
+        if job.target_model is None:
+            job.target_model = s.get("selected_model")
+        job.cost = max(1, int((job.overrides or {}).get("n_iter", s.get("n_iter", 1))))
+        if self.journal is not None:
+            self.journal.add(job.job_id, job.to_dict())
         await self.q.put(job)
+        self._announce_positions()
 
-    async def _progress_loop(self, job: GenJob):
-        last_progress = -1
-        has_started = False  # Track if we've confirmed this job is being processed
-        consecutive_progress_count = 0  # Count consecutive progress updates
-        
-        # Operation titles
-        operation_titles = {
-            "txt2img": ("🎨", "Generando Imagen"),
-            "upscale_hr": ("🔍", "Generando con Upscale HR"),
-            "repeat": ("🔄", "Repitiendo Generación"),
-            "newseed": ("🎲", "Nueva Variación")
-        }
-        emoji, title = operation_titles.get(job.operation_type, ("🎨", "Generando"))
-        
-        # Show queued message immediately on first check
+    def _announce_positions(self) -> None:
+        """Actualiza la posición en cola de los mensajes de estado que hayan cambiado."""
+        order = self.q.order()
+        ahead = self.in_flight_images
+        for position, job in enumerate(order, start=1):
+            eta = self.admission.estimate(ahead, self.pool.capacity)
+            ahead += job.cost
+            if job.queue_position == position:
+                continue
+            job.queue_position = position
+            text = format_queue_status(position, len(order), job.prompt, eta)
+            if job.recovered:
+                text += f"\n\n{FormatText.italic('♻️ Recuperado tras reinicio')}"
+            self.edits.submit(job.chat_id, job.status_message_id, text, parse_mode="HTML")
+
+    async def _replay(self) -> int:
+        """Reencola los trabajos que quedaron sin terminar antes del último apagado."""
+        if self.journal is None:
+            return 0
+        replayed = 0
+        for data in self.journal.pending():
+            try:
+                job = GenJob.from_dict(data)
+            except Exception as e:
+                logging.error(f"Trabajo ilegible en el diario de la cola, se descarta: {e}")
+                self.journal.complete(data.get("job_id", ""))
+                continue
+            # Sin límite por usuario: ya se aceptaron antes del reinicio
+            job.recovered = True
+            await self.q.put(job)
+            replayed += 1
+        if replayed:
+            # Reutiliza los mensajes de estado que quedaron colgados para mostrar la posición
+            self._announce_positions()
+            logging.info(f"♻️ {replayed} trabajos recuperados del diario de la cola")
+        return replayed
+
+    def _show_starting(self, job: GenJob) -> None:
+        emoji, title = _OPERATION_TITLES.get(job.operation_type, ("🎨", "Generando"))
         queued_msg = (
             f"{FormatText.bold(FormatText.emoji(f'{emoji} {title}', '⏳'))}\n"
             "━━━━━━━━━━━━━━━━━━━━\n"
@@ -71,504 +424,520 @@ class JobQueue:
             f"{FormatText.italic('⏰ Esperando turno para procesar...')}"
         )
         
-        try:
-            await self.bot.edit_message_text(
-                chat_id=job.chat_id,
-                message_id=job.status_message_id,
-                text=queued_msg,
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logging.warning(f"Failed to show initial queued status: {e}")
-        
-        while True:
-            await asyncio.sleep(1.5)
-            try:
-                prog_data = await a1111_get_progress()
-                progress = prog_data.get("progress", 0)
-                eta = prog_data.get("eta_relative", 0)
-                
-                # Only consider job as "started" if we see consistent progress
-                # This prevents showing progress from other jobs in the queue
-                if progress > 0:
-                    consecutive_progress_count += 1
-                    # Require at least 2 consecutive progress updates to confirm it's our job
-                    if consecutive_progress_count >= 2:
-                        has_started = True
-                else:
-                    consecutive_progress_count = 0
-                    # If we had started but now have no progress, keep showing as started
-                    # (this handles brief gaps in progress reporting)
-                
-                # If job hasn't started, keep showing queued message
-                if not has_started:
-                    # Message already shown initially, just continue waiting
-                    continue
-                
-                # Only show progress if job has started and progress changed significantly
-                if has_started and progress > 0 and (progress - last_progress > 0.05 or int(progress * 20) != int(last_progress * 20)):
-                    last_progress = progress
-                    bar_len = 10
-                    filled = int(progress * bar_len)
-                    bar = "▓" * filled + "░" * (bar_len - filled)
-                    pct = int(progress * 100)
-                    
-                    # Extract step info from state
-                    state = prog_data.get("state", {})
-                    current_step = state.get("sampling_step", 0)
-                    total_steps = state.get("sampling_steps", 0)
-                    job_no = state.get("job_no", 0)
-                    job_count = state.get("job_count", 0)
-                    
-                    # Operation-specific titles and emojis
-                    operation_titles = {
-                        "txt2img": ("🎨", "Generando Imagen"),
-                        "upscale_hr": ("🔍", "Generando con Upscale HR"),
-                        "repeat": ("🔄", "Repitiendo Generación"),
-                        "newseed": ("🎲", "Nueva Variación")
-                    }
-                    
-                    emoji, title = operation_titles.get(job.operation_type, ("🎨", "Generando"))
-                    
-                    # Build enhanced message with visual separator
-                    # Use final_prompt if available (with pre/post prompts), otherwise use original
-                    display_prompt = getattr(job, 'final_prompt', job.prompt)
-                    prompt_preview = display_prompt[:45] + "..." if len(display_prompt) > 45 else display_prompt
-                    
-                    msg_parts = [
-                        f"{FormatText.bold(FormatText.emoji(f'{emoji} {title}', '⏳'))}",
-                        "━━━━━━━━━━━━━━━━━━━━",
-                        f"{FormatText.code(f'[{bar}] {pct}%')}"
-                    ]
-                    
-                    # Progress section
-                    progress_info = []
-                    if total_steps > 0:
-                        progress_info.append(f"Step: {FormatText.code(f'{current_step}/{total_steps}')}")
-                    if job_count > 1:
-                        progress_info.append(f"Imagen: {FormatText.code(f'{job_no}/{job_count}')}")
-                    if eta > 0:
-                        progress_info.append(f"ETA: {FormatText.code(f'~{int(eta)}s')}")
-                    
-                    if progress_info:
-                        msg_parts.append("")
-                        msg_parts.append(f"{FormatText.bold('📊 Progreso:')}")
-                        for info in progress_info:
-                            msg_parts.append(f"  • {info}")
-                    
-                    # Configuration section (if metadata available)
-                    if job.operation_metadata:
-                        msg_parts.append("")
-                        msg_parts.append(f"{FormatText.bold('🔧 Configuración:')}")
-                        
-                        if "hr_scale" in job.operation_metadata:
-                            hr_scale_val = f"{job.operation_metadata['hr_scale']}x"
-                            msg_parts.append(f"  • Factor: {FormatText.code(hr_scale_val)}")
-                        if "upscaler" in job.operation_metadata:
-                            msg_parts.append(f"  • Upscaler: {FormatText.code(job.operation_metadata['upscaler'])}")
-                        if "denoising" in job.operation_metadata:
-                            msg_parts.append(f"  • Denoising: {FormatText.code(str(job.operation_metadata['denoising']))}")
-                    
-                    # Prompt preview
-                    msg_parts.append("")
-                    msg_parts.append(f"{FormatText.italic(f'💬 {prompt_preview}')}")
-                    
-                    msg = "\n".join(msg_parts)
-                    
-                    try:
-                        await self.bot.edit_message_text(
-                            chat_id=job.chat_id,
-                            message_id=job.status_message_id,
-                            text=msg,
-                            parse_mode="HTML"
-                        )
-                    except Exception as e:
-                        if "not modified" not in str(e).lower():
-                            logging.warning(f"Failed to update progress: {e}")
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                logging.error(f"Error in progress loop: {e}")
+        self.edits.submit(job.chat_id, job.status_message_id, queued_msg, parse_mode="HTML")
 
-    async def _worker(self):
+    async def _on_progress(self, owner: List[GenJob], prog_data: dict) -> None:
+        """Suscriptor del ProgressMonitor: el progreso pertenece al lote que tiene la GPU."""
+        progress = prog_data.get("progress", 0)
+        if progress <= 0:
+            return
+        for job in owner:
+            # Only update when progress changed significantly
+            if progress - job.last_progress > 0.05 or int(progress * 20) != int(job.last_progress * 20):
+                job.last_progress = progress
+                # The dispatcher keeps only the latest text per message and rate-limits the edits
+                self.edits.submit(job.chat_id, job.status_message_id, _format_progress(job, prog_data), parse_mode="HTML")
+
+    async def _generation_worker(self):
         while True:
+            # El trabajo se elige cuando hay un servidor libre, así la afinidad de
+            # modelo se decide con los checkpoints realmente cargados
+            await self.pool.wait_available()
             job: GenJob = await self.q.get()
+            self._announce_positions()
+            batch = await self._generate(job)
+            for item in batch:
+                await self.deliveries.put(item)
+
+    async def _delivery_worker(self):
+        while True:
+            job, s, spec, res = await self.deliveries.get()
             try:
-                s = load_user_settings(job.user_id)
-                
-                # Cambiar al modelo seleccionado por el usuario antes de generar
-                user_model = s.get("selected_model")
-                if user_model:
-                    logging.info(f"Cambiando modelo a '{user_model}' para usuario {job.user_id}")
-                    try:
-                        ok = await set_sd_model(user_model)
-                        if ok:
-                            logging.info(f"Modelo cambiado exitosamente a '{user_model}'")
-                        else:
-                            logging.warning("Fallo al establecer el modelo seleccionado; intentando elegir uno disponible aleatoriamente")
-                            try:
-                                models = await fetch_sd_models()
-                                choices = [m.get("model_name") for m in models if m.get("model_name")]
-                                if choices:
-                                    chosen = choices[0] if len(choices) == 1 else random.choice(choices)
-                                    ok2 = await set_sd_model(chosen)
-                                    if ok2:
-                                        s["selected_model"] = chosen
-                                        from storage.users import save_user_settings
-                                        save_user_settings(job.user_id, s)
-                                        logging.info(f"Modelo alternativo establecido: '{chosen}'")
-                                    else:
-                                        logging.error("No se pudo establecer el modelo alternativo seleccionado")
-                                else:
-                                    logging.error("No hay modelos disponibles desde el endpoint /sd-models")
-                            except Exception as e2:
-                                logging.error(f"Error al obtener/establecer modelos alternativos: {e2}")
-                    except Exception as e:
-                        logging.error(f"Error al cambiar modelo: {e}")
-                        try:
-                            models = await fetch_sd_models()
-                            choices = [m.get("model_name") for m in models if m.get("model_name")]
-                            if choices:
-                                chosen = choices[0] if len(choices) == 1 else random.choice(choices)
-                                ok2 = await set_sd_model(chosen)
-                                if ok2:
-                                    s["selected_model"] = chosen
-                                    from storage.users import save_user_settings
-                                    save_user_settings(job.user_id, s)
-                                    logging.info(f"Modelo alternativo establecido tras excepción: '{chosen}'")
-                                else:
-                                    logging.error("No se pudo establecer el modelo alternativo tras excepción")
-                            else:
-                                logging.error("No hay modelos disponibles tras excepción")
-                        except Exception as e3:
-                            logging.error(f"Error en fallback de modelos tras excepción: {e3}")
-                        # Continuar con la generación incluso si falla el cambio de modelo
-                
-                w, h = ratio_to_dims(s.get("aspect_ratio", "1:1"), s.get("base_size", 512))
-                steps = int(s.get("steps", 4))
-                cfg = float(s.get("cfg_scale", 1.0))
-                sampler = s.get("sampler_name", "LCM")
-                scheduler = s.get("scheduler", "")
-                n_images = int(s.get("n_iter", 1))
-                seed = -1
-                if job.overrides:
-                    steps = int(job.overrides.get("steps", steps))
-                    cfg = float(job.overrides.get("cfg_scale", cfg))
-                    sampler = job.overrides.get("sampler_name", sampler)
-                    scheduler = job.overrides.get("scheduler", scheduler)
-                    w = int(job.overrides.get("width", w))
-                    h = int(job.overrides.get("height", h))
-                    n_images = int(job.overrides.get("n_iter", n_images))
-                    seed = int(job.overrides.get("seed", seed))
-                logging.info(f"Iniciando generación con parámetros: prompt='{job.prompt[:50]}...', width={w}, height={h}, steps={steps}, cfg={cfg}, sampler={sampler}, scheduler={scheduler}, seed={seed}, n_iter={n_images}, hr_options={job.hr_options}, alwayson_scripts={job.alwayson_scripts}")
-                
-                # Get current model and its preset to apply pre/post/negative prompts
-                current_model = await get_current_model()
-                preset = get_preset_for_model(current_model) if current_model else None
-                
-                # Helper function to deduplicate prompt tags
-                def deduplicate_prompts(user_prompt: str, additional_prompt: str) -> str:
-                    """
-                    Remove tags from additional_prompt that already exist in user_prompt.
-                    Compares case-insensitive and handles both individual words and parenthesized groups.
-                    """
-                    if not additional_prompt:
-                        return ""
-                    
-                    # Normalize: lowercase for comparison
-                    user_lower = user_prompt.lower()
-                    
-                    # Split additional_prompt by comma and strip whitespace
-                    additional_tags = [tag.strip() for tag in additional_prompt.split(',')]
-                    
-                    # Filter out duplicates
-                    deduplicated = []
-                    for tag in additional_tags:
-                        # Check if the tag (or its content) exists in user prompt
-                        tag_lower = tag.lower()
-                        
-                        # For parenthesized tags like "(4k,8k,Ultra HD)", check the whole thing
-                        # For simple tags like "masterpiece", check if it's a substring
-                        if tag_lower not in user_lower:
-                            deduplicated.append(tag)
-                    
-                    return ", ".join(deduplicated) if deduplicated else ""
-                
-                # Build final prompt with preset pre/post prompts (deduplicated)
-                final_prompt = job.prompt
-                negative_prompt = ""
-                
-                if preset:
-                    logging.info(f"ORIGINAL user prompt: '{job.prompt}'")
-                    
-                    if preset.pre_prompt:
-                        logging.info(f"Applying PRE_PROMPT: '{preset.pre_prompt}'")
-                        deduplicated_pre = deduplicate_prompts(job.prompt, preset.pre_prompt)
-                        logging.info(f"Deduplicated PRE_PROMPT: '{deduplicated_pre}'")
-                        if deduplicated_pre:
-                            final_prompt = f"{deduplicated_pre}, {final_prompt}"
-                            logging.info(f"After PRE: '{final_prompt}'")
-                    
-                    if preset.post_prompt:
-                        logging.info(f"Applying POST_PROMPT: '{preset.post_prompt}'")
-                        deduplicated_post = deduplicate_prompts(job.prompt, preset.post_prompt)
-                        logging.info(f"Deduplicated POST_PROMPT: '{deduplicated_post}'")
-                        if deduplicated_post:
-                            final_prompt = f"{final_prompt}, {deduplicated_post}"
-                            logging.info(f"After POST: '{final_prompt}'")
-                    
-                    negative_prompt = preset.negative_prompt
-                    logging.info(f"FINAL prompt: '{final_prompt}'")
-                    logging.info(f"Preset '{preset.model_name}' aplicado: pre_prompt={bool(preset.pre_prompt)}, post_prompt={bool(preset.post_prompt)}, negative_prompt={bool(preset.negative_prompt)}")
-                    
-                    # Validación estricta contra el preset: si no cumple, aplicar valores del preset
-                    is_valid = (
-                        (steps in preset.steps) and
-                        (cfg in preset.cfg) and
-                        (sampler in preset.samplers) and
-                        (scheduler in preset.schedulers)
-                    )
-                    if not is_valid:
-                        logging.warning("⚠️ Parámetros no compatibles con el preset. Aplicando valores del preset (conservando tamaño, n_iter y seed)")
-                        steps = preset.steps[0]
-                        cfg = preset.cfg[0]
-                        sampler = preset.samplers[0]
-                        scheduler = preset.schedulers[0]
-                        logging.info(f"✅ Preset aplicado: Steps={steps}, CFG={cfg}, Sampler={sampler}, Scheduler={scheduler}")
-                
-                # Prepare ADetailer defaults if none provided in job and user has none
-                alwayson_scripts_local = job.alwayson_scripts
-                if not alwayson_scripts_local and job.operation_type == "upscale_hr":
+                if res is not None:
+                    await self._deliver(job, s, spec, res)
+            except Exception as e:
+                await self._report_error(job, e)
+            finally:
+                if job.status_message_id:
+                    self.edits.discard(job.chat_id, job.status_message_id)
                     try:
-                        selected_ad = s.get("adetailer_models", []) or []
-                        if not selected_ad:
-                            available = await fetch_adetailer_models()
-                            defaults = ["face_yolov8n.pt", "mediapipe_face_mesh_eyes_only"]
-                            selected_ad = [m for m in defaults if m in available]
-                        if selected_ad:
-                            ad_args = [{"ad_model": m, "ad_confidence": 0.3} for m in selected_ad]
-                            alwayson_scripts_local = {"ADetailer": {"args": ad_args}}
-                            logging.info(f"Applying ADetailer defaults for generation: {selected_ad}")
+                        await self.bot.delete_message(chat_id=job.chat_id, message_id=job.status_message_id)
                     except Exception as e:
-                        logging.warning(f"Failed to prepare ADetailer defaults: {e}")
+                        logging.warning(f"No se pudo borrar el mensaje de estado {job.status_message_id}: {e}")
+                if self.journal is not None:
+                    self.journal.complete(job.job_id)
+                self.q.task_done()
+                self.deliveries.task_done()
+
+    async def _ensure_model(self, job: GenJob, s: dict, backend: A1111Backend) -> None:
+        """Carga en `backend` el checkpoint elegido por el usuario salvo que ya esté cargado."""
+        user_model = s.get("selected_model")
+        if not user_model:
+            return
+        await backend.tracker.get()
+        if backend.tracker.is_loaded(user_model):
+            self.model_swaps_skipped += 1
+            logging.info(f"Modelo '{user_model}' ya cargado; se omite el cambio para usuario {job.user_id}")
+            return
+        logging.info(f"Cambiando modelo a '{user_model}' en '{backend.name}' para usuario {job.user_id}")
+        try:
+            ok = await set_sd_model(user_model, backend)
+            if ok:
+                self.model_swaps += 1
+                logging.info(f"Modelo cambiado exitosamente a '{user_model}' (cambios de modelo: {self.model_swaps})")
+                return
+            logging.warning("Fallo al establecer el modelo seleccionado; intentando elegir uno disponible aleatoriamente")
+        except Exception as e:
+            logging.error(f"Error al cambiar modelo: {e}")
+        try:
+            models = await fetch_sd_models()
+            choices = [m.get("model_name") for m in models if m.get("model_name")]
+            if choices:
+                chosen = choices[0] if len(choices) == 1 else random.choice(choices)
+                ok2 = await set_sd_model(chosen, backend)
+                if ok2:
+                    self.model_swaps += 1
+                    s["selected_model"] = chosen
+                    from storage.users import save_user_settings
+                    save_user_settings(job.user_id, s)
+                    logging.info(f"Modelo alternativo establecido: '{chosen}'")
+                else:
+                    logging.error("No se pudo establecer el modelo alternativo seleccionado")
+            else:
+                logging.error("No hay modelos disponibles desde el endpoint /sd-models")
+        except Exception as e2:
+            logging.error(f"Error al obtener/establecer modelos alternativos: {e2}")
+        # Continuar con la generación incluso si falla el cambio de modelo
+
+    async def _build_spec(self, job: GenJob, s: dict, backend: A1111Backend) -> dict:
+        """Resuelve los parámetros finales de txt2img (ajustes, overrides, preset y ADetailer)."""
+        w, h, steps, cfg, sampler, scheduler, n_images, seed = _job_params(job, s)
+        
+        # Get current model and its preset to apply pre/post/negative prompts
+        current_model = await backend.tracker.get()
+        preset = get_preset_for_model(current_model) if current_model else None
+        
+        # Local expansion: concrete resource values picked with the generation seed,
+        # so the same template and seed always give the same (short) prompt
+        user_prompt = job.prompt
+        if PROMPT_EXPANSION == "local":
+            pack = resource_pack_for(job.chat_id, preset)
+            if prompt_generator.has_keys(job.prompt, pack):
+                if seed == -1:
+                    seed = random.randrange(1 << 31)
+                user_prompt = prompt_generator.expand(job.prompt, seed, pack=pack)
+                logging.info(f"Expansión local con seed {seed}: '{user_prompt[:80]}'")
+        
+        # job.prompt ya trae modificadores y LoRA (se compuso al crear el trabajo);
+        # aquí solo se añade el pre/post prompt del preset del modelo cargado
+        final_prompt = preset_composer.compose(user_prompt, preset=preset)
+        negative_prompt = ""
+        
+        if preset:
+            logging.info(f"ORIGINAL user prompt: '{user_prompt}'")
+            negative_prompt = preset.negative_prompt
+            logging.info(f"FINAL prompt: '{final_prompt}'")
+            logging.info(f"Preset '{preset.model_name}' aplicado: pre_prompt={bool(preset.pre_prompt)}, post_prompt={bool(preset.post_prompt)}, negative_prompt={bool(preset.negative_prompt)}")
+            
+            # Validación estricta contra el preset: si no cumple, aplicar valores del preset
+            is_valid = (
+                preset.allows("steps", steps) and
+                preset.allows("cfg_scale", cfg) and
+                preset.allows("sampler_name", sampler) and
+                preset.allows("scheduler", scheduler)
+            )
+            if not is_valid:
+                logging.warning("⚠️ Parámetros no compatibles con el preset. Aplicando valores del preset (conservando tamaño, n_iter y seed)")
+                steps = preset.steps[0]
+                cfg = preset.cfg[0]
+                sampler = preset.samplers[0]
+                scheduler = preset.schedulers[0]
+                logging.info(f"✅ Preset aplicado: Steps={steps}, CFG={cfg}, Sampler={sampler}, Scheduler={scheduler}")
+        
+        # Prepare ADetailer defaults if none provided in job and user has none
+        alwayson_scripts_local = job.alwayson_scripts
+        if not alwayson_scripts_local and job.operation_type == "upscale_hr":
+            try:
+                selected_ad = s.get("adetailer_models", []) or []
+                if not selected_ad:
+                    available = await fetch_adetailer_models()
+                    defaults = ["face_yolov8n.pt", "mediapipe_face_mesh_eyes_only"]
+                    selected_ad = [m for m in defaults if m in available]
+                if selected_ad:
+                    ad_args = [{"ad_model": m, "ad_confidence": 0.3} for m in selected_ad]
+                    alwayson_scripts_local = {"ADetailer": {"args": ad_args}}
+                    logging.info(f"Applying ADetailer defaults for generation: {selected_ad}")
+            except Exception as e:
+                logging.warning(f"Failed to prepare ADetailer defaults: {e}")
+        return {
+            "prompt": final_prompt,
+            "negative_prompt": negative_prompt,
+            "width": w,
+            "height": h,
+            "steps": steps,
+            "cfg_scale": cfg,
+            "sampler_name": sampler,
+            "scheduler": scheduler,
+            "n_iter": n_images,
+            "seed": seed,
+            "hr_options": job.hr_options,
+            "alwayson_scripts": alwayson_scripts_local,
+        }
+
+    async def _generate(self, job: GenJob) -> List[Tuple[GenJob, Optional[dict], Optional[dict], Optional[dict]]]:
+        """
+        Toma un servidor del pool, cambia de modelo si hace falta y ejecuta txt2img para
+        el trabajo (y los que se fusionen con él). Si el servidor cae a mitad del trabajo,
+        lo reintenta en otro hasta A1111_FAILOVER_ATTEMPTS veces. Devuelve (job, settings,
+        spec, resultado) por trabajo; el resultado es None si falló (el error ya se notificó).
+        """
+        batch = [(job, None, None)]
+        backend = await self.pool.acquire(job.target_model)
+        backend_error = None
+        failed = []
+        try:
+            s = load_user_settings(job.user_id)
+            await self._ensure_model(job, s, backend)
+            spec = await self._build_spec(job, s, backend)
+            batch = [(job, s, spec)]
+            if JOBQUEUE_BATCHING:
+                merged = await self._collect_batch(job, s, spec, backend)
+                if merged:
+                    batch += merged
+                    # Los fusionados salen de la cola: los demás avanzan de posición
+                    self._announce_positions()
 
+            for j, _, sp in batch:
                 # Store final_prompt in job so progress messages show it
-                job.final_prompt = final_prompt
-                
-                # Acquire semaphore to ensure only 1 job generates at a time
-                # This prevents multiple jobs from showing the same API progress
-                async with self.generation_semaphore:
-                    # Start progress loop AFTER acquiring semaphore
-                    progress_task = asyncio.create_task(self._progress_loop(job))
-                    
+                j.final_prompt = sp["prompt"]
+            counts = [sp["n_iter"] for _, _, sp in batch]
+            if len(batch) > 1:
+                logging.info(f"Lote de {len(batch)} trabajos fusionados en un único txt2img ({sum(counts)} imágenes)")
+            
+            for j, _, sp in batch:
+                logging.info(f"Iniciando generación con parámetros: prompt='{j.prompt[:50]}...', width={sp['width']}, height={sp['height']}, steps={sp['steps']}, cfg={sp['cfg_scale']}, sampler={sp['sampler_name']}, scheduler={sp['scheduler']}, seed={sp['seed']}, n_iter={sp['n_iter']}, hr_options={j.hr_options}, alwayson_scripts={j.alwayson_scripts}")
+                self._show_starting(j)
+            
+            while True:
+                try:
+                    started = time.monotonic()
+                    self.in_flight_images += sum(counts)
                     try:
-                        res = await a1111_txt2img(
-                            final_prompt,
-                            width=w,
-                            height=h,
-                            steps=steps,
-                            cfg_scale=cfg,
-                            sampler_name=sampler,
-                            n_iter=n_images,
-                            scheduler=scheduler,
-                            seed=seed,
-                            negative_prompt=negative_prompt,
-                            hr_options=job.hr_options,
-                            alwayson_scripts=alwayson_scripts_local,
-                        )
+                        res = await self._txt2img(backend, batch, spec, counts)
                     finally:
-                        progress_task.cancel()
-                        try:
-                            await progress_task
-                        except asyncio.CancelledError:
-                            pass
-                logging.info(f"Generación completada. Response keys: {list(res.keys()) if res else 'None'}")
-                
-                imgs = res.get("images") or []
-                params = res.get("parameters") or {}
-                info = res.get("info") or {}
-                
-                # Extract arrays from info for individual image data
-                all_prompts = info.get("all_prompts", [])
-                all_seeds = info.get("all_seeds", [])
-                
-                logging.info(f"Imágenes generadas: {len(imgs)}, parámetros: {params}, info: {info}")
-                logging.info(f"all_prompts: {all_prompts}, all_seeds: {all_seeds}")
-                
-                if not imgs:
-                    await self.bot.send_message(job.chat_id, f"{FormatText.bold(FormatText.emoji('❌ Sin imágenes generadas', '⚠️'))}", parse_mode="HTML")
+                        self.in_flight_images -= sum(counts)
+                    self.admission.record(time.monotonic() - started, sum(counts))
+                    break
+                except Exception as e:
+                    if not is_backend_failure(e):
+                        raise
+                    failed.append(backend)
+                    alternatives = [b for b in self.pool.backends if b.healthy and b not in failed]
+                    if len(failed) > A1111_FAILOVER_ATTEMPTS or not alternatives:
+                        backend_error = e
+                        raise
+                    logging.warning(f"txt2img falló en '{backend.name}' ({e}); se reintenta en otro servidor")
+                    await self.pool.release(backend, e)
+                    backend = None
+                    backend = await self.pool.acquire(job.target_model, exclude=failed)
+                    self.failovers += 1
+                    batch = await self._move_batch(batch, backend)
+                    spec = batch[0][2]
+                    counts = [sp["n_iter"] for _, _, sp in batch]
+            logging.info(f"Generación completada en '{backend.name}'. Response keys: {list(res.keys()) if res else 'None'}")
+            parts = _split_result(res, counts)
+            return [(j, s_, sp, part) for (j, s_, sp), part in zip(batch, parts)]
+        except Exception as e:
+            for j, _, _ in batch:
+                await self._report_error(j, e)
+            return [(j, s_, sp, None) for j, s_, sp in batch]
+        finally:
+            if backend is not None:
+                await self.pool.release(backend, backend_error)
+
+    async def _move_batch(self, batch: list, backend: A1111Backend) -> list:
+        """
+        Prepara el lote para reintentarlo en `backend`: carga allí el checkpoint del trabajo
+        principal y reconstruye cada spec con el preset de ese servidor. Los fusionados que
+        ya no encajan (otro checkpoint u otros parámetros) vuelven a la cola.
+        """
+        job, s, _ = batch[0]
+        await self._ensure_model(job, s, backend)
+        spec = await self._build_spec(job, s, backend)
+        job.final_prompt = spec["prompt"]
+        moved = [(job, s, spec)]
+        key = _batch_key(spec)
+        requeued = 0
+        for j, js, _ in batch[1:]:
+            target = js.get("selected_model")
+            jspec = None
+            if not target or backend.tracker.is_loaded(target):
+                jspec = await self._build_spec(j, js, backend)
+            if jspec is None or _batch_key(jspec) != key:
+                j.queue_position = None
+                await self.q.put(j)
+                requeued += 1
+                continue
+            j.final_prompt = jspec["prompt"]
+            moved.append((j, js, jspec))
+        if requeued:
+            logging.info(f"{requeued} trabajos del lote vuelven a la cola: no encajan en '{backend.name}'")
+            self._announce_positions()
+        return moved
+
+    async def _txt2img(self, backend: A1111Backend, batch: list, spec: dict, counts: List[int]) -> dict:
+        # El progreso de la API es de todo el servidor: con varios slots en el mismo
+        # servidor solo el primer lote en curso lo muestra
+        monitor = self.progress[backend.name]
+        watch = monitor.watch([j for j, _, _ in batch]) if monitor.owner is None else contextlib.nullcontext()
+        async with watch:
+            return await a1111_txt2img(
+                spec["prompt"],
+                width=spec["width"],
+                height=spec["height"],
+                steps=spec["steps"],
+                cfg_scale=spec["cfg_scale"],
+                sampler_name=spec["sampler_name"],
+                n_iter=spec["n_iter"] if len(batch) == 1 else 1,
+                batch_size=1 if len(batch) == 1 else sum(counts),
+                scheduler=spec["scheduler"],
+                seed=spec["seed"],
+                negative_prompt=spec["negative_prompt"],
+                hr_options=spec["hr_options"],
+                alwayson_scripts=spec["alwayson_scripts"],
+                backend=backend,
+            )
+
+    async def _collect_batch(self, job: GenJob, s: dict, spec: dict, backend: A1111Backend) -> list:
+        """
+        Saca de la cola los trabajos pendientes que pueden compartir el txt2img de `spec`.
+        Los candidatos se filtran primero con _batch_hint; el spec completo solo se
+        construye para los que pasan el filtro.
+        """
+        key = _batch_key(spec)
+        hint = _batch_hint(job, s)
+        if key is None or hint is None:
+            return []
+        budget = JOBQUEUE_BATCH_MAX_IMAGES - spec["n_iter"]
+        batch = []
+        for cand in self.q.pending():
+            if budget <= 0:
+                break
+            if cand.cost > budget:
+                continue
+            cs = load_user_settings(cand.user_id)
+            target = cs.get("selected_model")
+            if target and not backend.tracker.is_loaded(target):
+                continue
+            if _batch_hint(cand, cs) != hint:
+                continue
+            cspec = await self._build_spec(cand, cs, backend)
+            if cspec["n_iter"] > budget or _batch_key(cspec) != key:
+                continue
+            if self.q.remove(cand):
+                batch.append((cand, cs, cspec))
+                budget -= cspec["n_iter"]
+        return batch
+
+    async def _deliver(self, job: GenJob, s: dict, spec: dict, res: dict) -> None:
+        """Envía las imágenes generadas, guarda cada trabajo y reencola en modo automático."""
+        final_prompt = spec["prompt"]
+        w, h = spec["width"], spec["height"]
+        steps, cfg = spec["steps"], spec["cfg_scale"]
+        sampler, scheduler = spec["sampler_name"], spec["scheduler"]
+        
+        imgs = res.get("images") or []
+        params = res.get("parameters") or {}
+        info = res.get("info") or {}
+        
+        # Extract arrays from info for individual image data
+        all_prompts = info.get("all_prompts", [])
+        all_seeds = info.get("all_seeds", [])
+        
+        logging.info(f"Imágenes generadas: {len(imgs)}, parámetros: {params}, info: {info}")
+        logging.info(f"all_prompts: {all_prompts}, all_seeds: {all_seeds}")
+        
+        if not imgs:
+            await self.bot.send_message(job.chat_id, f"{FormatText.bold(FormatText.emoji('❌ Sin imágenes generadas', '⚠️'))}", parse_mode="HTML")
+        else:
+            previews = [None] * len(imgs)
+            originals = [None] * len(imgs)
+            if DELIVERY_MODE == "preview":
+                # Se preparan todas antes de enviar (en paralelo; gather conserva el orden) para
+                # que las subidas pidan turno en el chat en el orden de las imágenes
+                previews = await asyncio.gather(*(encode_preview_async(b, PREVIEW_FORMAT, PREVIEW_QUALITY, PREVIEW_MAX_SIDE, PREVIEW_ENCODE_WORKERS) for b in imgs))
+
+                async def _keep_original(b: bytes, preview: Optional[bytes]) -> Optional[str]:
+                    # El PNG sin pérdida queda en disco y solo se sube si lo piden
+                    return await asyncio.to_thread(save_original, b) if preview is not None else None
+                originals = await asyncio.gather(*(_keep_original(b, p) for b, p in zip(imgs, previews)))
+
+            async def _send_image(i: int, b: bytes, preview: Optional[bytes], original: Optional[str]) -> None:
+                # Use the actual resolved prompt and seed for THIS specific image
+                actual_prompt = all_prompts[i] if i < len(all_prompts) else final_prompt
+                actual_seed = all_seeds[i] if i < len(all_seeds) else -1
+            
+                # Enhanced caption with better formatting and emojis
+                size_str = f"{params.get('width', w)}x{params.get('height', h)}"
+                caption = (
+                    f"{FormatText.bold(FormatText.emoji('🎨 Generación completada', '✅'))}\n\n"
+                    f"{FormatText.bold('📝 Prompt:')} {FormatText.code(actual_prompt)}\n\n"
+                    f"{FormatText.bold('⚙️ Configuración:')}\n"
+                    f"• {FormatText.bold('Pasos:')} {FormatText.code(str(params.get('steps', steps)))}\n"
+                    f"• {FormatText.bold('Sampler:')} {FormatText.code(params.get('sampler_name', sampler))}\n"
+                    f"• {FormatText.bold('Scheduler:')} {FormatText.code(params.get('scheduler', scheduler))}\n"
+                    f"• {FormatText.bold('CFG:')} {FormatText.code(str(params.get('cfg_scale', cfg)))}\n"
+                    f"• {FormatText.bold('Seed:')} {FormatText.code(str(actual_seed))}\n"
+                    f"• {FormatText.bold('Tamaño:')} {FormatText.code(size_str)}\n\n"
+                    f"{FormatText.bold(FormatText.emoji('👤 Autor:', ''))} {FormatText.code(job.user_name)}"
+                )
+                job_data = {
+                    "user_id": job.user_id,
+                    "chat_id": job.chat_id,
+                    "prompt": actual_prompt,
+                    "width": params.get('width', w),
+                    "height": params.get('height', h),
+                    "steps": params.get('steps', steps),
+                    "cfg_scale": params.get('cfg_scale', cfg),
+                    "sampler_name": params.get('sampler_name', sampler),
+                    "scheduler": params.get('scheduler', scheduler),
+                    "seed": actual_seed,
+                }
+                if PROMPT_EXPANSION == "local":
+                    job_data["template"] = job.prompt
+                # The store keeps a reference, so file_id/original added below reach the callbacks too
+                rid = put_request(job_data)
+            
+                # Enhanced keyboard with better buttons and emojis
+                if job.hr_options:
+                    rows = [
+                        [InlineKeyboardButton("🔄 Repetir", callback_data=f"job:repeat:{rid}"), 
+                         InlineKeyboardButton("🔍 Final Upscale", callback_data=f"job:final:{rid}")]
+                    ]
                 else:
-                    for i, b in enumerate(imgs):
-                        # Use the actual resolved prompt and seed for THIS specific image
-                        actual_prompt = all_prompts[i] if i < len(all_prompts) else final_prompt
-                        actual_seed = all_seeds[i] if i < len(all_seeds) else -1
-                        
-                        # Enhanced caption with better formatting and emojis
-                        size_str = f"{params.get('width', w)}x{params.get('height', h)}"
-                        caption = (
-                            f"{FormatText.bold(FormatText.emoji('🎨 Generación completada', '✅'))}\n\n"
-                            f"{FormatText.bold('📝 Prompt:')} {FormatText.code(actual_prompt)}\n\n"
-                            f"{FormatText.bold('⚙️ Configuración:')}\n"
-                            f"• {FormatText.bold('Pasos:')} {FormatText.code(str(params.get('steps', steps)))}\n"
-                            f"• {FormatText.bold('Sampler:')} {FormatText.code(params.get('sampler_name', sampler))}\n"
-                            f"• {FormatText.bold('Scheduler:')} {FormatText.code(params.get('scheduler', scheduler))}\n"
-                            f"• {FormatText.bold('CFG:')} {FormatText.code(str(params.get('cfg_scale', cfg)))}\n"
-                            f"• {FormatText.bold('Seed:')} {FormatText.code(str(actual_seed))}\n"
-                            f"• {FormatText.bold('Tamaño:')} {FormatText.code(size_str)}\n\n"
-                            f"{FormatText.bold(FormatText.emoji('👤 Autor:', ''))} {FormatText.code(job.user_name)}"
-                        )
-                        payload = {
-                            "prompt": actual_prompt,
-                            "width": params.get('width', w),
-                            "height": params.get('height', h),
-                            "steps": params.get('steps', steps),
-                            "cfg_scale": params.get('cfg_scale', cfg),
-                            "sampler_name": params.get('sampler_name', sampler),
-                            "scheduler": params.get('scheduler', scheduler),
-                            "seed": actual_seed,
-                        }
-                        rid = put_request(payload)
-                        
-                        # Enhanced keyboard with better buttons and emojis
-                        job_data = {
-                            "user_id": job.user_id,
-                            "prompt": actual_prompt,
-                            "width": params.get('width', w),
-                            "height": params.get('height', h),
-                            "steps": params.get('steps', steps),
-                            "cfg_scale": params.get('cfg_scale', cfg),
-                            "sampler_name": params.get('sampler_name', sampler),
-                            "scheduler": params.get('scheduler', scheduler),
-                            "seed": actual_seed,
-                        }
-                        
-                        if job.hr_options:
-                            rows = [
-                                [InlineKeyboardButton("🔄 Repetir", callback_data=f"job:repeat:{rid}"), 
-                                 InlineKeyboardButton("🔍 Final Upscale", callback_data=f"job:final:{rid}")]
-                            ]
-                        else:
-                            rows = [
-                                [InlineKeyboardButton("🔄 Repetir", callback_data=f"job:repeat:{rid}"), 
-                                 InlineKeyboardButton("🔍 Upscale", callback_data=f"job:upscale:{rid}")]
-                            ]
-                        
-                        if s.get("auto_mode"):
-                            rows.append([InlineKeyboardButton("🛑 Detener Auto", callback_data="stop:auto")])
-                            
-                        kb = InlineKeyboardMarkup(rows)
-                        
-                        # Guardar el trabajo para poder recuperarlo después
-                        from storage.jobs import save_job
-                        
-                        # Enviar el mensaje y obtener el resultado
+                    rows = [
+                        [InlineKeyboardButton("🔄 Repetir", callback_data=f"job:repeat:{rid}"), 
+                         InlineKeyboardButton("🔍 Upscale", callback_data=f"job:upscale:{rid}")]
+                    ]
+            
+                if preview is not None:
+                    job_data["original"] = original
+                    rows.append([InlineKeyboardButton("📥 PNG original", callback_data=f"job:png:{rid}")])
+            
+                if s.get("auto_mode"):
+                    rows.append([InlineKeyboardButton("🛑 Detener Auto", callback_data="stop:auto")])
+                
+                kb = InlineKeyboardMarkup(rows)
+            
+                # Guardar el trabajo para poder recuperarlo después
+                from storage.jobs import save_job
+            
+                try:
+                    # Enviar el mensaje y obtener el resultado
+                    if preview is not None:
+                        sent_message = await self._send_photo(job.chat_id, preview, f"image_{i}.{PREVIEW_FORMAT.lower()}", caption, kb)
+                    else:
                         sent_message = await self._send_document_long(job.chat_id, b, f"image_{i}.png", caption, kb)
-                        
-                        # Guardar el file_id para upscale final
-                        if sent_message and 'document' in sent_message:
-                            job_data['file_id'] = sent_message['document']['file_id']
-                            job_data['message_id'] = sent_message['message_id']
-                            
-                        # Guardar el trabajo usando el message_id real del mensaje enviado
-                            save_job(sent_message['message_id'], job_data)
                 
-                # Check for auto-mode and requeue if active
-                if s.get("auto_mode"):
-                    logging.info(f"Auto-mode active for user {job.user_id}. Re-queueing job.")
-                    
-                    # Create new status message for the next job
-                    queue_message = (
-                        f"{FormatText.bold(FormatText.emoji('🔄 Auto-Generación', '✅'))}\n"
-                        f"{FormatText.bold('Prompt:')} {FormatText.code(job.prompt[:100] + '...' if len(job.prompt) > 100 else job.prompt)}\n"
-                        f"{FormatText.bold('Estado:')} {FormatText.emoji('En cola (Auto)', '⏳')}\n\n"
-                        f"{FormatText.italic('Generando automáticamente...')}"
-                    )
+                    # Guardar el file_id para upscale final
+                    if sent_message and ('document' in sent_message or 'photo' in sent_message):
+                        if 'document' in sent_message:
+                            job_data['file_id'] = sent_message['document']['file_id']
+                        else:
+                            # La última variante es la de mayor resolución
+                            job_data['file_id'] = sent_message['photo'][-1]['file_id']
+                        job_data['message_id'] = sent_message['message_id']
                     
-                    try:
-                        status_message = await self.bot.send_message(job.chat_id, queue_message, parse_mode="HTML")
-                        
-                        # Create new job identical to current one
-                        new_job = GenJob(
-                            user_id=job.user_id,
-                            chat_id=job.chat_id,
-                            prompt=job.prompt,
-                            status_message_id=status_message.message_id,
-                            user_name=job.user_name,
-                            overrides=job.overrides,
-                            hr_options=job.hr_options,
-                            alwayson_scripts=job.alwayson_scripts,
-                            operation_type=job.operation_type,
-                            operation_metadata=job.operation_metadata
-                        )
-                        
-                        # Enqueue the new job (FIFO ensures turn-based if others are waiting)
-                        await self.enqueue(new_job)
-                        
-                    except Exception as e:
-                        logging.error(f"Failed to auto-requeue job: {e}")
-
-            except Exception as e:
-                logging.error(f"Error en generación para job {job}: {str(e)}", exc_info=True)
-                error_msg = f"{FormatText.bold(FormatText.emoji('❌ Error en generación', '⚠️'))}\n{FormatText.code(str(e))}"
-                err_message = await self.bot.send_message(job.chat_id, error_msg, parse_mode="HTML")
+                    # Guardar el trabajo usando el message_id real del mensaje enviado
+                        save_job(sent_message['message_id'], job_data)
+                except Exception:
+                    if original:
+                        # Sin mensaje ni trabajo guardado nadie podrá pedir el PNG
+                        await asyncio.to_thread(delete_original, original)
+                    raise
+            
+            # Images go out concurrently (the uploader limits uploads per chat and,
+            # since nothing awaits before the upload, takes them in image order)
+            await asyncio.gather(*(_send_image(i, b, p, o) for i, (b, p, o) in enumerate(zip(imgs, previews, originals))))
+        
+        # Check for auto-mode and requeue if active
+        if s.get("auto_mode") and not self.admit(job.user_id, job.cost, JOBQUEUE_AUTO_PRIORITY, charge=False).accepted:
+            logging.info(f"Auto-mode: no se reencola el trabajo del usuario {job.user_id} (cola llena o espera excesiva)")
+        elif s.get("auto_mode"):
+            logging.info(f"Auto-mode active for user {job.user_id}. Re-queueing job.")
+            
+            # Create new status message for the next job
+            queue_message = (
+                f"{FormatText.bold(FormatText.emoji('🔄 Auto-Generación', '✅'))}\n"
+                f"{FormatText.bold('Prompt:')} {FormatText.code(job.prompt[:100] + '...' if len(job.prompt) > 100 else job.prompt)}\n"
+                f"{FormatText.bold('Estado:')} {FormatText.emoji('En cola (Auto)', '⏳')}\n\n"
+                f"{FormatText.italic('Generando automáticamente...')}"
+            )
+            
+            try:
+                status_message = await self.bot.send_message(job.chat_id, queue_message, parse_mode="HTML")
                 
-                # Track error message for cleanup on restart
-                from storage.error_messages import add_error_message, remove_error_message
-                add_error_message(job.chat_id, err_message.message_id)
+                # Create new job identical to current one
+                new_job = GenJob(
+                    user_id=job.user_id,
+                    chat_id=job.chat_id,
+                    prompt=job.prompt,
+                    status_message_id=status_message.message_id,
+                    user_name=job.user_name,
+                    overrides=job.overrides,
+                    hr_options=job.hr_options,
+                    alwayson_scripts=job.alwayson_scripts,
+                    operation_type=job.operation_type,
+                    operation_metadata=job.operation_metadata,
+                    priority=JOBQUEUE_AUTO_PRIORITY,
+                )
                 
-                # Auto-delete error message after 5 seconds
-                async def _auto_delete_error():
-                    try:
-                        await asyncio.sleep(5)
-                        await self.bot.delete_message(chat_id=job.chat_id, message_id=err_message.message_id)
-                        # Remove from tracking after successful deletion
-                        remove_error_message(job.chat_id, err_message.message_id)
-                    except Exception as del_err:
-                        logging.warning(f"Could not delete error message: {del_err}")
+                # Lowest priority class: auto-mode never delays interactive requests
+                await self.enqueue(new_job)
                 
-                asyncio.create_task(_auto_delete_error())
-            finally:
-                if job.status_message_id:
-                    try:
-                        await self.bot.delete_message(chat_id=job.chat_id, message_id=job.status_message_id)
-                    except Exception as e:
-                        logging.warning(f"No se pudo borrar el mensaje de estado {job.status_message_id}: {e}")
-                self.q.task_done()
+            except QueueFullError as e:
+                logging.info(f"Auto-requeue rechazado para usuario {job.user_id}: {e.reason}")
+                self.edits.submit(job.chat_id, status_message.message_id, format_queue_rejected(e.reason, e.eta, e.retry_after), parse_mode="HTML")
+            except Exception as e:
+                logging.error(f"Failed to auto-requeue job: {e}")
 
-    async def _send_document_long(self, chat_id: int, img_bytes: bytes, filename: str, caption: str, kb: Optional[InlineKeyboardMarkup]) -> dict:
-        url = f"https://api.telegram.org/bot{self.bot.token}/sendDocument"
-        attempt = 0
-        while True:
-            form = aiohttp.FormData()
-            form.add_field("chat_id", str(chat_id))
-            form.add_field("caption", caption)
-            form.add_field("parse_mode", "HTML")
-            if kb:
-                form.add_field("reply_markup", json.dumps(kb.to_dict()))
-            form.add_field("document", img_bytes, filename=filename, content_type="image/png")
+    async def _report_error(self, job: GenJob, e: Exception) -> None:
+        logging.error(f"Error en generación para job {job}: {str(e)}", exc_info=True)
+        error_msg = f"{FormatText.bold(FormatText.emoji('❌ Error en generación', '⚠️'))}\n{FormatText.code(str(e))}"
+        err_message = await self.bot.send_message(job.chat_id, error_msg, parse_mode="HTML")
+        
+        # Track error message for cleanup on restart
+        from storage.error_messages import add_error_message, remove_error_message
+        add_error_message(job.chat_id, err_message.message_id)
+        
+        # Auto-delete error message after 5 seconds
+        async def _auto_delete_error():
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(url, data=form) as resp:
-                        resp.raise_for_status()
-                        result = await resp.json()
-                        if not result.get("ok"):
-                            logging.error(f"Telegram API error: {result}")
-                            raise Exception(f"Telegram API error: {result.get('description', 'Unknown error')}")
-                        return result.get("result", {})
-            except Exception as e:
-                attempt += 1
-                logging.error(f"Error en _send_document_long (attempt {attempt}): {str(e)}")
-                if attempt >= 3:
-                    raise
-                await asyncio.sleep(5 * attempt)
+                await asyncio.sleep(5)
+                await self.bot.delete_message(chat_id=job.chat_id, message_id=err_message.message_id)
+                # Remove from tracking after successful deletion
+                remove_error_message(job.chat_id, err_message.message_id)
+            except Exception as del_err:
+                logging.warning(f"Could not delete error message: {del_err}")
+        
+        asyncio.create_task(_auto_delete_error())
+
+    async def _send_document_long(self, chat_id: int, img_bytes: bytes, filename: str, caption: str, kb: Optional[InlineKeyboardMarkup]) -> dict:
+        return await self.uploader.send_document(chat_id, img_bytes, filename, caption, kb.to_dict() if kb else None)
+
+    async def _send_photo(self, chat_id: int, img_bytes: bytes, filename: str, caption: str, kb: Optional[InlineKeyboardMarkup]) -> dict:
+        content_type = PREVIEW_CONTENT_TYPES.get(PREVIEW_FORMAT.upper(), "image/jpeg")
+        return await self.uploader.send_file("sendPhoto", "photo", chat_id, img_bytes, filename, caption, kb.to_dict() if kb else None, content_type)
 
-# Simple in-memory request store for callbacks
-_REQ_STORE = {}
+# Payloads referenced by the inline buttons (job:<acción>:<rid>)
+_REQ_STORE = RequestStore(
+    max_entries=REQUEST_STORE_MAX_ENTRIES,
+    ttl=REQUEST_STORE_TTL,
+    spill_dir=CALLBACK_SPILL_DIR if REQUEST_STORE_SPILL else None,
+)
 
 def put_request(payload: dict) -> str:
-    rid = str(id(payload)) + ":" + str(asyncio.get_event_loop().time())
-    _REQ_STORE[rid] = payload
-    return rid
+    return _REQ_STORE.put(payload)
 
 def get_request(rid: str) -> Optional[dict]:
     return _REQ_STORE.get(rid)
@@ -0,0 +1,56 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+class QueueJournal:
+    """
+    Diario SQLite de la cola: cada trabajo se inserta al encolarse y se borra al
+    terminar su entrega, así tras un reinicio o caída se reencola lo que quedó a
+    medias. Coste fijo por trabajo: un INSERT y un DELETE (WAL, sentencias fijas).
+    """
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pending (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_id TEXT NOT NULL UNIQUE,
+        enqueued REAL NOT NULL,
+        data TEXT NOT NULL
+    );
+    """
+
+    def __init__(self, path: Path, synchronous: str = "NORMAL"):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={synchronous}")
+        self._conn.executescript(self._SCHEMA)
+
+    def add(self, job_id: str, data: dict) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending (job_id, enqueued, data) VALUES (?, ?, ?)",
+                (job_id, time.time(), json.dumps(data, ensure_ascii=False, separators=(",", ":"))),
+            )
+
+    def complete(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM pending WHERE job_id = ?", (job_id,))
+
+    def pending(self) -> List[dict]:
+        """Trabajos sin terminar, en el orden en que se encolaron."""
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM pending ORDER BY seq").fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
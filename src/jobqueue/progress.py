@@ -0,0 +1,82 @@
+import asyncio
+import contextlib
+import logging
+from typing import Any, Awaitable, Callable, List, Optional
+
+class ProgressMonitor:
+    """
+    Sondeo de /sdapi/v1/progress de un servidor A1111; JobQueue crea uno por cada
+    servidor del pool.
+
+    Solo consulta su servidor mientras hay una generación en curso (`watch`), sabe a
+    quién pertenece el progreso (el lote que ocupa ese servidor) y publica cada lectura
+    a los suscriptores. El intervalo se adapta a la ETA y el bucle se detiene en reposo,
+    así que el número de peticiones no depende de cuántos trabajos haya en cola.
+    """
+    def __init__(self, fetch: Callable[[], Awaitable[dict]], min_interval: float = 0.75, max_interval: float = 5.0, default_interval: float = 1.5):
+        self._fetch = fetch
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self.owner: Any = None
+        self.last: dict = {}
+        self.polls = 0
+        self._subscribers: List[Callable[[Any, dict], Awaitable[None]]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, callback: Callable[[Any, dict], Awaitable[None]]) -> None:
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[Any, dict], Awaitable[None]]) -> None:
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    @contextlib.asynccontextmanager
+    async def watch(self, owner: Any):
+        """Marca a `owner` como dueño de la GPU y sondea el progreso mientras dure el bloque."""
+        self.owner = owner
+        self.last = {}
+        self._task = asyncio.create_task(self._poll_loop(owner))
+        try:
+            yield self
+        finally:
+            task, self._task = self._task, None
+            self.owner = None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _next_interval(self, data: dict) -> float:
+        progress = data.get("progress") or 0
+        eta = data.get("eta_relative") or 0
+        if progress <= 0 or eta <= 0 or progress >= 1:
+            return self.default_interval
+        # Tiempo estimado para avanzar un 5% más, acotado
+        step = eta * 0.05 / (1 - progress)
+        return max(self.min_interval, min(self.max_interval, step))
+
+    async def _poll_loop(self, owner: Any) -> None:
+        interval = self.default_interval
+        while self.owner is owner:
+            await asyncio.sleep(interval)
+            try:
+                data = await self._fetch()
+                self.polls += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error al obtener progreso: {e}")
+                continue
+            if self.owner is not owner:
+                break
+            self.last = data or {}
+            interval = self._next_interval(self.last)
+            for callback in list(self._subscribers):
+                try:
+                    await callback(owner, self.last)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f"Error in progress subscriber: {e}")
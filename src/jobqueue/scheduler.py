@@ -0,0 +1,172 @@
+import asyncio
+import itertools
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+@dataclass
+class _Entry:
+    job: Any
+    seq: int  # orden de llegada
+    bypassed: int = 0  # veces que otro trabajo pasó por delante por afinidad de modelo
+
+def _cost(job) -> float:
+    return max(1, getattr(job, "cost", 1) or 1)
+
+class JobScheduler:
+    """
+    Cola de trabajos pendientes con prioridades, reparto justo entre usuarios y
+    afinidad de modelo.
+
+    - Clases de prioridad (`job.priority`, menor = antes): una clase solo se atiende
+      cuando las anteriores están vacías.
+    - Dentro de cada clase, deficit round-robin entre usuarios: en cada vuelta un
+      usuario gana `quantum` de crédito y sus trabajos cuestan `job.cost` (imágenes),
+      así quien encola una docena de prompts no bloquea al resto.
+    - Afinidad: si el trabajo al que le toca no usa el checkpoint cargado, puede
+      adelantarlo uno posterior del mismo usuario o el siguiente de otro usuario de
+      la misma clase con crédito que sí lo use, como mucho `max_bypass` veces.
+
+    Mantiene la interfaz de asyncio.Queue que usa JobQueue (put/get/task_done/qsize).
+    """
+    def __init__(self, is_loaded: Callable[[Optional[str]], bool], max_bypass: int = 3, quantum: float = 1):
+        self._is_loaded = is_loaded
+        self.max_bypass = max_bypass
+        self.quantum = quantum
+        # prioridad -> usuario -> trabajos en orden; el orden de usuarios es la ronda
+        self._classes: Dict[int, "OrderedDict[Any, Deque[_Entry]]"] = {}
+        self._deficit: Dict[tuple, float] = {}
+        self._per_user: Dict[Any, int] = {}
+        self._size = 0
+        self._seq = itertools.count()
+        self._ready = asyncio.Event()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return not self._size
+
+    def count(self, user_id) -> int:
+        """Trabajos pendientes de un usuario (para el límite por usuario)."""
+        return self._per_user.get(user_id, 0)
+
+    def pending_cost(self, max_priority: Optional[int] = None) -> float:
+        """Coste (imágenes) pendiente en las clases de prioridad hasta `max_priority` incluida."""
+        return sum(
+            _cost(e.job)
+            for priority, users in self._classes.items()
+            if max_priority is None or priority <= max_priority
+            for q in users.values()
+            for e in q
+        )
+
+    def put_nowait(self, job) -> None:
+        users = self._classes.setdefault(getattr(job, "priority", 0), OrderedDict())
+        users.setdefault(job.user_id, deque()).append(_Entry(job, next(self._seq)))
+        self._per_user[job.user_id] = self._per_user.get(job.user_id, 0) + 1
+        self._size += 1
+        self._ready.set()
+
+    async def put(self, job) -> None:
+        self.put_nowait(job)
+
+    async def get(self):
+        while not self._size:
+            self._ready.clear()
+            await self._ready.wait()
+        priority = min(self._classes)
+        user, index = self._select(priority)
+        q = self._classes[priority][user]
+        entry = q[index]
+        del q[index]
+        self._deficit[(priority, user)] -= _cost(entry.job)
+        self._discard(priority, user, entry)
+        return entry.job
+
+    def task_done(self) -> None:
+        pass
+
+    def pending(self) -> list:
+        """Copia de los trabajos pendientes en orden de llegada."""
+        entries = [e for users in self._classes.values() for q in users.values() for e in q]
+        return [e.job for e in sorted(entries, key=lambda e: e.seq)]
+
+    def remove(self, job) -> bool:
+        """Saca un trabajo pendiente concreto (p. ej. para fusionarlo en un lote)."""
+        priority = getattr(job, "priority", 0)
+        q = self._classes.get(priority, {}).get(job.user_id)
+        if not q:
+            return False
+        for entry in q:
+            if entry.job is job:
+                q.remove(entry)
+                self._discard(priority, job.user_id, entry)
+                return True
+        return False
+
+    def order(self) -> list:
+        """
+        Trabajos pendientes en el orden en que se atenderán (sin contar la afinidad de
+        modelo, que solo puede adelantar alguno). Simula la ronda sin modificar la cola.
+        """
+        result = []
+        for priority in sorted(self._classes):
+            users = OrderedDict((u, deque(q)) for u, q in self._classes[priority].items())
+            deficit = {u: self._deficit.get((priority, u), 0) for u in users}
+            while users:
+                user, q = next(iter(users.items()))
+                if deficit[user] < _cost(q[0].job):
+                    deficit[user] += self.quantum
+                    users.move_to_end(user)
+                    continue
+                entry = q.popleft()
+                deficit[user] -= _cost(entry.job)
+                result.append(entry.job)
+                if not q:
+                    del users[user]
+        return result
+
+    def _discard(self, priority: int, user, entry: _Entry) -> None:
+        users = self._classes[priority]
+        if not users[user]:
+            # Un usuario sin trabajos no acumula crédito para la próxima vez
+            del users[user]
+            self._deficit.pop((priority, user), None)
+            if not users:
+                del self._classes[priority]
+        self._per_user[user] -= 1
+        if not self._per_user[user]:
+            del self._per_user[user]
+        self._size -= 1
+
+    def _fits_loaded_model(self, entry: _Entry) -> bool:
+        target = getattr(entry.job, "target_model", None)
+        return not target or self._is_loaded(target)
+
+    def _select(self, priority: int) -> Tuple[Any, int]:
+        """(usuario, posición en su cola) del trabajo de la clase `priority` que se atiende ahora."""
+        users = self._classes[priority]
+        while True:
+            user, q = next(iter(users.items()))
+            key = (priority, user)
+            self._deficit.setdefault(key, 0)
+            if self._deficit[key] >= _cost(q[0].job):
+                break
+            self._deficit[key] += self.quantum
+            users.move_to_end(user)
+        head = q[0]
+        if head.bypassed >= self.max_bypass or self._fits_loaded_model(head):
+            return user, 0
+        # Un trabajo posterior del mismo usuario con el checkpoint ya cargado (agrupa sus
+        # prompts por modelo en lugar de alternar checkpoints)
+        for index in range(1, len(q)):
+            if self._deficit[key] >= _cost(q[index].job) and self._fits_loaded_model(q[index]):
+                head.bypassed += 1
+                return user, index
+        # Otro usuario con crédito suficiente y el checkpoint ya cargado puede ir antes
+        for other, oq in users.items():
+            if other != user and self._deficit.get((priority, other), 0) >= _cost(oq[0].job) and self._fits_loaded_model(oq[0]):
+                head.bypassed += 1
+                return other, 0
+        return user, 0
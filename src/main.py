@@ -11,11 +11,12 @@ import aiohttp
 from typing import Union
 from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
-from jobqueue.jobs import JobQueue, GenJob
+from telegram.error import RetryAfter
+from jobqueue.jobs import JobQueue, GenJob, QueueFullError, get_request
 import re
 from services.a1111 import (
     a1111_extra_single_image, 
-    get_current_model, 
+    model_tracker,
     a1111_test_connection, 
     fetch_sd_models, 
     set_sd_model,
@@ -23,12 +24,19 @@ from services.a1111 import (
     fetch_schedulers,
     fetch_loras,
     fetch_adetailer_models,
-    a1111_txt2img
+    invalidate_metadata_cache,
+    a1111_txt2img,
 )
-from utils.formatting import FormatText, format_welcome_message, format_queue_status, format_generation_complete, format_error_message, format_settings_updated
-from utils.prompt_generator import prompt_generator
+from services.a1111_pool import a1111_pool
+from utils.formatting import FormatText, format_welcome_message, format_queue_status, format_generation_complete, format_error_message, format_settings_updated, format_queue_rejected, describe_queue_rejection, format_queue_stats
+from utils.prompt_generator import prompt_generator, resource_pack_for
+from utils.prompt_composer import prompt_composer
 from utils.process_manager import process_manager
-from storage.jobs import save_job, get_job, delete_job
+from storage.jobs import save_job, get_job, delete_job, job_reaper
+from storage.users import load_user_settings, save_user_settings, flush_user_settings
+from storage.backend import get_backend
+from services.telegram_edits import retry_after_seconds
+from storage.originals import load_original
 from pressets.pressets import Preset, get_preset_for_model
 from ui.menus import (
     main_menu_keyboard, 
@@ -53,25 +61,9 @@ def log_callback_payload(payload: dict):
     except Exception as e:
         logging.error(f"Error guardando log de callback: {e}")
 
-from config import A1111_URL
+from config import A1111_URL, ERROR_CLEANUP_CONCURRENCY, JOBQUEUE_PRIORITIES, PROMPT_EXPANSION
 BOT_TOKEN_DEFAULT = os.environ.get("BOT_TOKEN", "7126310269:AAGiMx_x9jZzOpMWzoKFYfV82-YSx2oG44w")
 
-USER_DATA_DIR = Path(__file__).resolve().parent.parent / "data" / "users"
-USER_DATA_DIR.mkdir(parents=True, exist_ok=True)
-
-DEFAULT_SETTINGS = {
-    "sampler_name": "LCM",
-    "scheduler": "",
-    "steps": 4,
-    "cfg_scale": 1.0,
-    "aspect_ratio": "1:1",
-    "base_size": 512,
-    "n_iter": 1,
-    "pre_modifiers": [],
-    "post_modifiers": [],
-    "loras": [],
-}
-
 JOBQ = JobQueue(concurrency=2)
 
 PRE_MODIFIERS = [
@@ -123,47 +115,28 @@ CFG_CHOICES = [i * 0.5 for i in range(2, 25)]
 
 from utils.common import ratio_to_dims
 
-def load_user_settings(user_id: int) -> dict:
-    fp = USER_DATA_DIR / f"{user_id}.json"
-    if fp.exists():
+async def enqueue_or_reject(job: GenJob, status_message) -> bool:
+    """
+    Encola `job`. Si la cola se llenó entre admit() y enqueue() (peticiones simultáneas),
+    el mensaje de estado pasa a mostrar el rechazo en lugar de quedarse "En cola".
+    """
+    try:
+        await JOBQ.enqueue(job)
+        return True
+    except QueueFullError as e:
+        logging.info(f"Trabajo de usuario {job.user_id} rechazado al encolar: {e.reason}")
         try:
-            return json.loads(fp.read_text(encoding="utf-8"))
-        except Exception:
-            return DEFAULT_SETTINGS.copy()
-    return DEFAULT_SETTINGS.copy()
-
-def save_user_settings(user_id: int, settings: dict) -> None:
-    fp = USER_DATA_DIR / f"{user_id}.json"
-    fp.write_text(json.dumps(settings, ensure_ascii=False), encoding="utf-8")
-
-def lora_tokens(settings: dict) -> str:
-    lst = settings.get("loras", [])
-    if not lst:
-        return ""
-    return " ".join([f"<lora:{name}:1>" for name in lst])
-
-def compose_prompt(user_settings: dict, user_prompt: str) -> str:
-    """Enhanced prompt composition with modifiers and loras."""
-    
-    pre_modifiers = ", ".join(user_settings.get("pre_modifiers", []))
-    post_modifiers = ", ".join(user_settings.get("post_modifiers", []))
-    
-    parts = [
-        pre_modifiers,
-        user_prompt,
-        post_modifiers,
-        lora_tokens(user_settings)
-    ]
-    
-    final_prompt = ", ".join(filter(None, parts))
-    logging.info(f"Composed prompt: {final_prompt[:150]}...")
-    return final_prompt
-
-
+            await status_message.edit_text(format_queue_rejected(e.reason, e.eta, e.retry_after), parse_mode="HTML")
+        except Exception as edit_error:
+            logging.warning(f"No se pudo actualizar el mensaje de estado rechazado: {edit_error}")
+        return False
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(format_welcome_message(), parse_mode="HTML")
 
+async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(format_queue_stats(JOBQ.stats()), parse_mode="HTML")
+
 async def txt2img(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     settings = load_user_settings(user_id)
@@ -183,8 +156,9 @@ async def txt2img(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logging.error(f"Failed to fetch or validate LoRAs: {e}")
 
     # Validate and auto-correct settings against current model preset
+    preset = None
     try:
-        model_name = await get_current_model()
+        model_name = await model_tracker.get()
         preset = get_preset_for_model(model_name)
         if preset:
             is_compliant, corrected_settings = validate_and_correct_settings(settings, preset)
@@ -196,9 +170,15 @@ async def txt2img(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logging.warning(f"Failed to validate settings against model: {e}")
 
     prompt_raw = " ".join(context.args).strip() if getattr(context, "args", None) else (update.message.text if update.message else "")
-    # Parse resource keywords (f_anime, r_color, etc.) before composing final prompt
-    prompt_parsed = prompt_generator.generate(prompt_raw)
-    prompt = compose_prompt(settings, prompt_parsed)
+    # Parse resource keywords (f_anime, r_color, etc.) before composing final prompt.
+    # In local mode they stay as keywords and the job expands them with its seed
+    if PROMPT_EXPANSION == "local":
+        prompt_parsed = prompt_raw
+    else:
+        prompt_parsed = prompt_generator.generate(prompt_raw, pack=resource_pack_for(update.effective_chat.id, preset))
+    # Modifiers and LoRA now; the job adds the preset once the model is known
+    prompt = prompt_composer.compose(prompt_parsed, settings)
+    logging.info(f"Composed prompt: {prompt[:150]}...")
     if not prompt:
         await update.message.reply_text(
             f"{FormatText.bold(FormatText.emoji('❌ Uso incorrecto', '⚠️'))}\n"
@@ -207,6 +187,13 @@ async def txt2img(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             parse_mode="HTML"
         )
         return
+    admission = JOBQ.admit(user_id, int(settings.get("n_iter", 1)), JOBQUEUE_PRIORITIES["txt2img"])
+    if not admission.accepted:
+        await update.message.reply_text(
+            format_queue_rejected(admission.reason, admission.eta, admission.retry_after),
+            parse_mode="HTML"
+        )
+        return
     try:
         n_images = int(settings.get("n_iter", 1))
         # Enhanced queue message with emojis and better formatting
@@ -219,7 +206,7 @@ async def txt2img(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         
         status_message = await update.message.reply_text(queue_message, parse_mode="HTML")
-        await JOBQ.enqueue(GenJob(user_id=user_id, chat_id=update.effective_chat.id, prompt=prompt, status_message_id=status_message.message_id, user_name=update.effective_user.first_name, operation_type="txt2img"))
+        await enqueue_or_reject(GenJob(user_id=user_id, chat_id=update.effective_chat.id, prompt=prompt, status_message_id=status_message.message_id, user_name=update.effective_user.first_name, operation_type="txt2img"), status_message)
     except Exception as e:
         error_msg = format_error_message(str(e))
         err_msg = await update.message.reply_text(
@@ -297,7 +284,7 @@ def validate_and_correct_settings(settings: dict, preset: Preset) -> tuple[bool,
     was_modified = False
 
     # Validate Steps
-    if corrected.get("steps") not in preset.steps:
+    if not preset.allows("steps", corrected.get("steps")):
         # Find nearest valid step or default to a safe value (e.g., first in list or random)
         # For simplicity, let's pick the closest value if possible, or just the first one.
         # Here we just pick a random one to be safe/simple as per previous logic, 
@@ -311,17 +298,17 @@ def validate_and_correct_settings(settings: dict, preset: Preset) -> tuple[bool,
         was_modified = True
 
     # Validate CFG
-    if corrected.get("cfg_scale") not in preset.cfg:
+    if not preset.allows("cfg_scale", corrected.get("cfg_scale")):
         corrected["cfg_scale"] = preset.cfg[0]
         was_modified = True
 
     # Validate Sampler
-    if corrected.get("sampler_name") not in preset.samplers:
+    if not preset.allows("sampler_name", corrected.get("sampler_name")):
         corrected["sampler_name"] = preset.samplers[0]
         was_modified = True
 
     # Validate Scheduler
-    if corrected.get("scheduler") not in preset.schedulers:
+    if not preset.allows("scheduler", corrected.get("scheduler")):
         # If scheduler is empty string and "none" is in preset (or vice versa), handle that?
         # The preset usually has "none" or specific names.
         # If current is "", map to "none" for check? 
@@ -331,7 +318,7 @@ def validate_and_correct_settings(settings: dict, preset: Preset) -> tuple[bool,
         was_modified = True
 
     # Validate Base Size
-    if corrected.get("base_size") not in preset.resolutions:
+    if not preset.allows("base_size", corrected.get("base_size")):
         corrected["base_size"] = preset.resolutions[0]
         was_modified = True
     
@@ -366,7 +353,7 @@ async def settings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     s = load_user_settings(user_id)
     try:
-        model_name = await get_current_model()
+        model_name = await model_tracker.get()
         preset = get_preset_for_model(model_name)
     except Exception as e:
         logging.warning(f"A1111 offline: {e}")
@@ -425,7 +412,7 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user_id = update.effective_user.id
 
     # Obtener el preset para el modelo actual
-    model_name = await get_current_model()
+    model_name = await model_tracker.get()
     preset = get_preset_for_model(model_name)
 
     submenu_texts = {
@@ -506,6 +493,11 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if data.startswith("menu:"):
         parts = data.split(":")
         kind = parts[1]
+        if kind == "refresh":
+            # Vuelve a pedir la lista a A1111 (checkpoints o LoRA añadidos sin reiniciar el bot)
+            kind = parts[2] if len(parts) > 2 else "model"
+            invalidate_metadata_cache("sd_models" if kind == "model" else "loras")
+            parts = ["menu", kind, "0"]
         if kind == "autoconfig":
             # Check if we have a valid preset
             if preset is None:
@@ -795,22 +787,33 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         # Intentar obtener el trabajo usando get_job() primero
         job_data = None
         if data.startswith("job:") and len(parts) > 2:
-            try:
-                message_id = int(parts[2])
-                job_data = get_job(message_id)
-                logging.info(f"Buscando job con message_id={message_id}, encontrado={job_data is not None}")
-                if job_data:
-                    logging.info(f"Job data encontrado: {json.dumps(job_data, ensure_ascii=False)}")
-            except (ValueError, IndexError) as e:
-                logging.error(f"Error al parsear message_id del callback job: {e}")
+            rid = parts[2]
+            job_data = get_request(rid)
+            if not job_data and q.message:
+                # Los trabajos también se guardan con el message_id del mensaje que lleva los botones
+                job_data = get_job(q.message.message_id)
+            logging.info(f"Buscando job con rid={rid}, encontrado={job_data is not None}")
+            if job_data:
+                logging.info(f"Job data encontrado: {json.dumps(job_data, ensure_ascii=False)}")
         elif data.startswith("img:") and len(parts) >= 4:
             # Formato antiguo img:action:timestamp:request_id - usar regex fallback
             logging.info(f"Callback formato antiguo img:, usando regex fallback")
         else:
             logging.info(f"Callback no es job: o no tiene suficientes partes. data={data}")
         
+        if action == "png":
+            # Entrega bajo demanda del PNG sin pérdida de una vista previa comprimida
+            original = load_original(job_data["original"]) if job_data and job_data.get("original") else None
+            if not original:
+                await q.answer("El original ya no está disponible")
+                return
+            await q.answer("📥 Enviando PNG original...")
+            await JOBQ.uploader.send_document(update.effective_chat.id, original, "original.png")
+            return
+        
         # Inicializar variables con valores por defecto
         prompt_p = ""
+        template_p = None
         steps_p = 20
         sampler_p = "Euler"
         sched_p = "normal"
@@ -822,6 +825,8 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         if job_data:
             # Usar datos del trabajo almacenado
             prompt_p = job_data.get("prompt", "")
+            # Plantilla con las claves sin expandir (modo local): repeat/newseed la vuelven a expandir con la nueva seed
+            template_p = job_data.get("template")
             steps_p = job_data.get("steps", 20)
             sampler_p = job_data.get("sampler_name", "Euler")
             sched_p = job_data.get("scheduler", "normal")
@@ -913,13 +918,19 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 height_p = int(m.group(8))
                 logging.info(f"Regex exitoso: prompt='{prompt_p[:50]}...', steps={steps_p}, sampler={sampler_p}, cfg={cfg_p}, seed={seed_p}, size={width_p}x{height_p}")
         logging.info(f"Procesando acción: {action} con prompt='{prompt_p[:50]}...', steps={steps_p}, sampler={sampler_p}, cfg={cfg_p}, seed={seed_p}, size={width_p}x{height_p}")
+        if action in ("repeat", "upscale", "newseed"):
+            operation = "upscale_hr" if action == "upscale" else action
+            admission = JOBQ.admit(user_id, int(load_user_settings(user_id).get("n_iter", 1)), JOBQUEUE_PRIORITIES[operation])
+            if not admission.accepted:
+                await q.answer(f"⏳ {describe_queue_rejection(admission.reason, admission.eta, admission.retry_after)}", show_alert=True)
+                return
         
         if action == "repeat":
             logging.info(f"Ejecutando REPEAT con seed aleatorio y auto-config parcial")
             
             # Get current model preset to auto-configure sampler/scheduler
             try:
-                current_model_name = await get_current_model()
+                current_model_name = await model_tracker.get()
                 current_preset = get_preset_for_model(current_model_name)
             except Exception as e:
                 logging.warning(f"Could not get model/preset for repeat auto-config: {e}")
@@ -953,7 +964,7 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 f"{FormatText.italic('Generando con configuración idéntica pero seed diferente...')}"
             )
             status_message = await update.effective_chat.send_message(repeat_message, parse_mode="HTML")
-            await JOBQ.enqueue(GenJob(user_id=user_id, chat_id=update.effective_chat.id, prompt=prompt_p, overrides=overrides, status_message_id=status_message.message_id, user_name=update.effective_user.first_name, operation_type="repeat"))
+            await enqueue_or_reject(GenJob(user_id=user_id, chat_id=update.effective_chat.id, prompt=template_p or prompt_p, overrides=overrides, status_message_id=status_message.message_id, user_name=update.effective_user.first_name, operation_type="repeat"), status_message)
             return
         if action == "upscale":
             logging.info(f"Ejecutando UPSCALE con HR")
@@ -1012,7 +1023,7 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 f"{FormatText.italic('Generando versión de alta resolución...')}"
             )
             status_message = await update.effective_chat.send_message(upscale_message, parse_mode="HTML")
-            await JOBQ.enqueue(GenJob(user_id=user_id, chat_id=update.effective_chat.id, prompt=prompt_p, overrides=overrides, hr_options=hr, alwayson_scripts=always_scripts, status_message_id=status_message.message_id, user_name=update.effective_user.first_name, operation_type="upscale_hr", operation_metadata={"hr_scale": 1.5, "upscaler": "R-ESRGAN 4x+", "denoising": 0.3}))
+            await enqueue_or_reject(GenJob(user_id=user_id, chat_id=update.effective_chat.id, prompt=prompt_p, overrides=overrides, hr_options=hr, alwayson_scripts=always_scripts, status_message_id=status_message.message_id, user_name=update.effective_user.first_name, operation_type="upscale_hr", operation_metadata={"hr_scale": 1.5, "upscaler": "R-ESRGAN 4x+", "denoising": 0.3}), status_message)
             return
         if action == "newseed":
             logging.info(f"Ejecutando NEWSEED con seed aleatorio")
@@ -1036,7 +1047,7 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 f"{FormatText.italic('Se usará un seed diferente para variar el resultado...')}"
             )
             status_message = await update.effective_chat.send_message(seed_message, parse_mode="HTML")
-            await JOBQ.enqueue(GenJob(user_id=user_id, chat_id=update.effective_chat.id, prompt=prompt_p, overrides=overrides, status_message_id=status_message.message_id, user_name=update.effective_user.first_name, operation_type="newseed"))
+            await enqueue_or_reject(GenJob(user_id=user_id, chat_id=update.effective_chat.id, prompt=template_p or prompt_p, overrides=overrides, status_message_id=status_message.message_id, user_name=update.effective_user.first_name, operation_type="newseed"), status_message)
             await q.answer("Nuevo seed en cola")
             return
 
@@ -1058,8 +1069,13 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 
                 logging.info("Conexión a A1111 exitosa, procediendo con FINAL UPSCALE")
                     
+                # Preferir el PNG original guardado en disco (las vistas previas están comprimidas)
+                original = load_original(job_data["original"]) if job_data and job_data.get("original") else None
+                if original:
+                    logging.info(f"Usando PNG original guardado: {job_data['original']}")
+                    file = None
                 # Si tenemos job_data con file_id, usarlo directamente
-                if job_data and 'file_id' in job_data:
+                elif job_data and 'file_id' in job_data:
                     file_id = job_data['file_id']
                     logging.info(f"Usando file_id del job_data: {file_id}")
                     file = await context.bot.get_file(file_id)
@@ -1073,39 +1089,40 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                     logging.info(f"Usando documento del mensaje actual: {doc.file_id}")
                     file = await context.bot.get_file(doc.file_id)
                 
-                logging.info(f"Descargando imagen de Telegram: file_path={file.file_path}")
+                img_bytes = original
+                if img_bytes is None:
+                    logging.info(f"Descargando imagen de Telegram: file_path={file.file_path}")
 
-                img_bytes = None
-                try:
-                    # Determinar la URL de descarga correcta
-                    if file.file_path.startswith('http'):
-                        url = file.file_path
-                    else:
-                        url = f"https://api.telegram.org/file/bot{BOT_TOKEN_DEFAULT}/{file.file_path}"
+                    try:
+                        # Determinar la URL de descarga correcta
+                        if file.file_path.startswith('http'):
+                            url = file.file_path
+                        else:
+                            url = f"https://api.telegram.org/file/bot{BOT_TOKEN_DEFAULT}/{file.file_path}"
                     
-                    logging.info(f"URL de descarga final: {url}")
+                        logging.info(f"URL de descarga final: {url}")
 
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(url) as resp:
-                            resp.raise_for_status()
-                            # LEER LA IMAGEN DENTRO DEL CONTEXTO de la sesión
-                            img_bytes = await resp.read()
+                        async with aiohttp.ClientSession() as session:
+                            async with session.get(url) as resp:
+                                resp.raise_for_status()
+                                # LEER LA IMAGEN DENTRO DEL CONTEXTO de la sesión
+                                img_bytes = await resp.read()
                     
-                    if not img_bytes:
-                        raise ValueError("La imagen descargada está vacía.")
+                        if not img_bytes:
+                            raise ValueError("La imagen descargada está vacía.")
 
-                    logging.info(f"Imagen descargada: {len(img_bytes)} bytes")
+                        logging.info(f"Imagen descargada: {len(img_bytes)} bytes")
                     
-                    # Log Base64 string for debugging
-                    base64_encoded = base64.b64encode(img_bytes).decode('utf-8')
-                    with open(LOG_DIR / "base64_debug.log", "w") as f:
-                        f.write(base64_encoded)
-                    logging.info("Base64 de la imagen guardado en base64_debug.log")
+                        # Log Base64 string for debugging
+                        base64_encoded = base64.b64encode(img_bytes).decode('utf-8')
+                        with open(LOG_DIR / "base64_debug.log", "w") as f:
+                            f.write(base64_encoded)
+                        logging.info("Base64 de la imagen guardado en base64_debug.log")
                         
-                except Exception as e:
-                    logging.error(f"Error al descargar o procesar la imagen: {e}", exc_info=True)
-                    await update.effective_chat.send_message("❌ Error al descargar la imagen para upscale.")
-                    return
+                    except Exception as e:
+                        logging.error(f"Error al descargar o procesar la imagen: {e}", exc_info=True)
+                        await update.effective_chat.send_message("❌ Error al descargar la imagen para upscale.")
+                        return
                 
                 logging.info(f"Llamando a a1111_extra_single_image con {len(img_bytes)} bytes")
                 logging.info(f"Parámetros del upscale: upscaler_1='R-ESRGAN 4x+', upscaling_resize=2")
@@ -1160,14 +1177,25 @@ async def settings_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                 return
 
 async def _post_init(app):
+    # El pool abre los clientes y trackers de todos los servidores (incluido el principal)
+    await a1111_pool.start()
+    await job_reaper.start()
     await JOBQ.start(app.bot)
 
+async def _post_shutdown(app):
+    await JOBQ.stop()
+    await job_reaper.stop()
+    await a1111_pool.stop()
+    flush_user_settings()
+    get_backend().close()
+
 def build_app() -> "Application":
     token = BOT_TOKEN_DEFAULT
-    app = ApplicationBuilder().token(token).post_init(_post_init).build()
+    app = ApplicationBuilder().token(token).post_init(_post_init).post_shutdown(_post_shutdown).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("txt2img", txt2img))
     app.add_handler(CommandHandler("settings", settings_cmd))
+    app.add_handler(CommandHandler("status", status_cmd))
     app.add_handler(CallbackQueryHandler(settings_menu_cb))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     return app
@@ -1184,17 +1212,31 @@ async def cleanup_error_messages(app):
         
         deleted_count = 0
         failed_count = 0
+        limit = asyncio.Semaphore(ERROR_CLEANUP_CONCURRENCY)
         
-        # Iterate through all tracked error messages
-        for chat_id, message_ids in error_msgs.items():
-            for message_id in message_ids:
+        async def _delete_chunk(chat_id: int, message_ids: list) -> None:
+            nonlocal deleted_count, failed_count
+            for attempt in range(3):
                 try:
-                    await bot.delete_message(chat_id=chat_id, message_id=message_id)
-                    deleted_count += 1
-                    logging.debug(f"Deleted error message {message_id} from chat {chat_id}")
+                    await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+                    deleted_count += len(message_ids)
+                    return
+                except RetryAfter as e:
+                    await asyncio.sleep(retry_after_seconds(e.retry_after))
                 except Exception as e:
-                    failed_count += 1
-                    logging.debug(f"Failed to delete message {message_id} from chat {chat_id}: {e}")
+                    logging.debug(f"Failed to delete {len(message_ids)} messages from chat {chat_id}: {e}")
+                    break
+            failed_count += len(message_ids)
+        
+        async def _cleanup_chat(chat_id: int, message_ids: set) -> None:
+            ids = sorted(message_ids)
+            async with limit:
+                # deleteMessages acepta hasta 100 IDs por llamada
+                for i in range(0, len(ids), 100):
+                    await _delete_chunk(chat_id, ids[i:i + 100])
+        
+        # Chats en paralelo (acotado); dentro de cada chat, lotes secuenciales
+        await asyncio.gather(*(_cleanup_chat(chat_id, ids) for chat_id, ids in error_msgs.items()))
         
         # Clear the tracking file after cleanup attempt
         clear_all_error_messages()
@@ -1224,8 +1266,9 @@ def main() -> None:
     
     logging.info("🚀 Iniciando bot avanzado con mejoras")
     logging.info(f"📋 PID: {os.getpid()}")
-    logging.info(f"📁 Directorio de datos: {USER_DATA_DIR}")
+    logging.info(f"📁 Almacenamiento: {type(get_backend()).__name__}")
     logging.info(f"🎯 Concurrency: {JOBQ.concurrency}")
+    logging.info(f"🖥️ Servidores A1111: {', '.join(f'{b.name} ({b.client.base_url} x{b.concurrency})' for b in a1111_pool.backends)}")
     
     try:
         app = build_app()
@@ -1233,25 +1276,13 @@ def main() -> None:
         # Run cleanup on startup
         async def post_init(application):
             await cleanup_error_messages(application)
-            await JOBQ.start(application.bot)
+            await _post_init(application)
         
         app.post_init = post_init
         
         app.run_polling(allowed_updates=Update.ALL_TYPES)
     finally:
-        # Cleanup on exit
-        async def shutdown():
-            await JOBQ.stop()
-            
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                loop.create_task(shutdown())
-            else:
-                loop.run_until_complete(shutdown())
-        except Exception as e:
-            logging.error(f"Error stopping JobQueue: {e}")
-
+        # run_polling ya ejecutó _post_shutdown (cola, reaper, pool, ajustes y almacenamiento)
         process_manager.remove_pid_file()
         logging.info("👋 Bot detenido correctamente")
 
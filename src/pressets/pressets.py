@@ -1,5 +1,23 @@
-from typing import List, Optional, Tuple
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+import json
+import logging
 import random
+import re
+import time
+
+from config import PRESETS_FILE, RESOURCE_RELOAD_INTERVAL
+
+# Ajuste del usuario -> atributo del preset con sus valores recomendados
+PRESET_FIELDS = {
+    "steps": "steps",
+    "cfg_scale": "cfg",
+    "sampler_name": "samplers",
+    "scheduler": "schedulers",
+    "base_size": "resolutions",
+}
 
 class Preset:
     """
@@ -15,7 +33,8 @@ class Preset:
                  resolutions: List[int],
                  pre_prompt: str = "",  # Texto que se añade ANTES del prompt del usuario
                  post_prompt: str = "",  # Texto que se añade DESPUÉS del prompt del usuario
-                 negative_prompt: str = ""):  # Negative prompt preestablecido para este preset
+                 negative_prompt: str = "",  # Negative prompt preestablecido para este preset
+                 resource_pack: Optional[str] = None):  # Pack de resources/packs/ para las claves r_* de este modelo
         self.model_name = model_name
         self.steps = steps
         self.cfg = cfg
@@ -25,8 +44,16 @@ class Preset:
         self.pre_prompt = pre_prompt
         self.post_prompt = post_prompt
         self.negative_prompt = negative_prompt
+        self.resource_pack = resource_pack
+        # Conjuntos para validar sin recorrer las listas (las listas se mantienen para random.choice y [0])
+        self.allowed: Dict[str, frozenset] = {key: frozenset(getattr(self, attr)) for key, attr in PRESET_FIELDS.items()}
 
-# --- Definición de Presets para cada modelo ---
+    def allows(self, key: str, value) -> bool:
+        """True si `value` es un valor recomendado para el ajuste `key` (p. ej. "steps")."""
+        try:
+            return value in self.allowed[key]
+        except TypeError:
+            return False  # valores no hashables (listas) nunca son válidos
 
 # Preset por defecto si no se encuentra uno específico para el modelo
 DEFAULT_PRESET = Preset(
@@ -38,130 +65,125 @@ DEFAULT_PRESET = Preset(
     resolutions=[512, 768]
 )
 
-# Preset para el modelo Dreamshaper
-DREAMSHAPER_PRESET = Preset(
-    model_name="dreamshaper",
-    steps=[25, 30, 35],
-    cfg=[7.0, 7.5, 8.0],
-    samplers=["DPM++ 2M Karras", "DPM++ SDE Karras", "Euler a"],
-    schedulers=["Automatic", "Karras"],
-    resolutions=[512, 768, 640]
-)
+# --- Registro de presets por modelo ---
+# Los presets viven en PRESETS_FILE (por defecto pressets/presets.json): cada entrada
+# tiene los campos de Preset más "match", subcadenas del nombre del checkpoint que lo
+# seleccionan. Ejemplo: "dreamshaper" coincidirá con "dreamshaper_8_93211.safetensors".
+# Si varias coinciden gana la que aparece antes en el archivo.
+_BUNDLED_PRESETS = Path(__file__).with_name("presets.json")
 
-# Preset para el modelo Janku
-JANKU_PRESET = Preset(
-    model_name="janku",
-    steps=[25, 30],
-    cfg=[3, 5],
-    samplers=["Euler", "Euler a"],
-    schedulers=["Normal", "Simple"],
-    resolutions=[768, 1024],
-    post_prompt="masterpiece, best quality, very aesthetic",
-    negative_prompt="lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry"
-)
+def _normalize(name: str) -> str:
+    return name.lower().replace("_", "").replace("-", "").replace(" ", "")
 
-# Preset para el modelo WAI Illustrious
-WAI_ILLUSTRIOUS_PRESET = Preset(
-    model_name="waiIllustrious",
-    steps=[25, 30],
-    cfg=[5, 7],
-    samplers=["Euler a"],
-    schedulers=["Normal"],
-    resolutions=[1024],
-    pre_prompt="(4k,8k,Ultra HD), masterpiece, best quality, ultra-detailed, very aesthetic, depth of field, best lighting, detailed illustration, detailed background, cinematic",
-    negative_prompt="(worst quality, low quality, extra digits:1.4),(extra fingers), (bad hands), missing fingers, child, loli, (watermark), censored, sagging breasts"
-)
+class _PresetIndex:
+    """
+    Instantánea inmutable del archivo de presets: todas las subcadenas en un único
+    regex y la resolución memoizada por título de checkpoint. Al recargar se
+    sustituye entera.
+    """
+    __slots__ = ("presets", "keys", "by_key", "pattern", "lookup", "mtime")
 
-# Preset para el modelo Hassaku
-HASSAKU_PRESET = Preset(
-    model_name="hassaku",
-    steps=[25, 30],
-    cfg=[3, 5],
-    samplers=["Euler", "Euler a"],
-    schedulers=["Normal", "Simple"],
-    resolutions=[768, 1024],
-    post_prompt="masterpiece, best quality, very aesthetic, absurdres",
-    negative_prompt="lowres, (bad), text, error, fewer, extra, missing, worst quality, jpeg artifacts, low quality, watermark, unfinished, displeasing, oldest, early, chromatic aberration, signature, extra digits, artistic error, username, scan, [abstract]"
-)
+    def __init__(self, entries: List[Tuple[str, Preset]], mtime: Optional[int], cache_size: int):
+        self.presets = list(dict.fromkeys(p for _, p in entries))
+        self.keys = [(_normalize(key), preset) for key, preset in entries]
+        by_key: Dict[str, Preset] = {}
+        for key, preset in entries:
+            by_key.setdefault(key, preset)
+        self.by_key = MappingProxyType(by_key)
+        self.mtime = mtime
+        # Lookahead para ver todas las coincidencias, también las solapadas; de las que
+        # empiezan en la misma posición la alternancia ya elige la de más prioridad
+        alternatives = "|".join(re.escape(key) for key in dict.fromkeys(k for k, _ in self.keys) if key)
+        self.pattern = re.compile(f"(?=({alternatives}))") if alternatives else None
+        self.lookup = lru_cache(maxsize=cache_size)(self._match)
 
-# Preset para el modelo Juggernaut
-JUGGERNAUT_PRESET = Preset(
-    model_name="juggernaut",
-    steps=[30, 40],
-    cfg=[3, 6],
-    samplers=["DPM++ 2M SDE"],
-    schedulers=[" Karras"],
-    resolutions=[1024],
-    post_prompt="masterpiece, best quality, very aesthetic, absurdres",
-    negative_prompt="lowres, (bad), text, error, fewer, extra, missing, worst quality, jpeg artifacts, low quality, watermark, unfinished, displeasing, oldest, early, chromatic aberration, signature, extra digits, artistic error, username, scan, [abstract]"
-)
+    def _match(self, model_name: str) -> Optional[Preset]:
+        if self.pattern is None:
+            return None
+        found = {m.group(1) for m in self.pattern.finditer(_normalize(model_name))}
+        for key, preset in self.keys:
+            if key in found:
+                return preset
+        return None
 
-# Perfect Illustrious (nota: el nombre real del modelo tiene typo 'prefect' no 'perfect')
-PERFECT_ILLUSTRIOUS_PRESET = Preset(
-    model_name="prefectIllustrious",
-    steps=[25, 30],
-    cfg=[5, 6],
-    samplers=["Euler a", "DPM++ 2M"],
-    schedulers=["Normal"],
-    resolutions=[1024],
-    pre_prompt="masterpiece,best quality,amazing quality,absurdres",
-    negative_prompt="bad quality,worst quality,worst detail,sketch,censored,watermark, signature, artist name"
-)
+class PresetRegistry:
+    """
+    Presets cargados de un archivo JSON, para añadir modelos sin tocar el código.
+    Como mucho cada `reload_interval` segundos se mira el mtime del archivo y, si
+    cambió, se vuelve a cargar; si el archivo nuevo no es válido se sigue con el anterior.
+    """
+    def __init__(self, path: Optional[str] = None, reload_interval: float = 2.0, cache_size: int = 256):
+        self.path = Path(path) if path else _BUNDLED_PRESETS
+        self.reload_interval = reload_interval
+        self.cache_size = cache_size
+        self._index: Optional[_PresetIndex] = None
+        self._checked = 0.0
 
-# IlustMix Presset
-ILUSTMIX_PRESET = Preset(
-    model_name="ilustmix",
-    steps=[25, 30],
-    cfg=[3.5, 7],
-    samplers=["Euler a"],
-    schedulers=["Normal"],
-    resolutions=[1024],
-    pre_prompt="masterpiece, best quality, amazing quality, very aesthetic, detailed eyes, perfect eyes, realistic eyes",
-    negative_prompt="bad quality,worst quality,worst detail,sketch,censored,watermark, signature, artist name"
-)
+    @property
+    def presets(self) -> List[Preset]:
+        return self._current().presets
 
-# cyberrealisticPony presset
-CYBERREALISTICPONY_PRESET = Preset(
-    model_name="cyberrealisticPony",
-    steps=[30, 35, 40],
-    cfg=[5],
-    samplers=["Euler a"],
-    schedulers=["Normal"],
-    resolutions=[1024],
-    pre_prompt="score_9, score_8_up, score_7_up",
-    # post_prompt="masterpiece, best quality, very aesthetic, absurdres",
-    negative_prompt="score_6, score_5, score_4, (worst quality:1.2), (low quality:1.2), (normal quality:1.2), lowres, bad anatomy, bad hands, signature, watermarks, ugly, imperfect eyes, skewed eyes, unnatural face, unnatural body, error, extra limb, missing limbs"
-)
+    @property
+    def by_key(self) -> Mapping[str, Preset]:
+        """Clave de "match" -> preset, en el orden del archivo (solo lectura)."""
+        return self._current().by_key
 
-# animij_v12 presset
-ANIMIJ_V12_PRESET = Preset(
-    model_name="animij_v12",
-    steps=[30],
-    cfg=[5],
-    samplers=["Euler a"],
-    schedulers=["Normal"],
-    resolutions=[1024],
-    pre_prompt="masterpiece, hig_quality, highres",
-    # post_prompt="masterpiece, best quality, very aesthetic, absurdres",
-    negative_prompt="worst_quality, bad_quality, poorly_detailed, (worst quality:1.2), (low quality:1.2), (normal quality:1.2), lowres, bad anatomy, bad hands, signature, watermarks, ugly, imperfect eyes, skewed eyes, unnatural face, unnatural body, error, extra limb, missing limbs"
-)
+    def get(self, model_name: str) -> Optional[Preset]:
+        if not model_name:
+            return None
+        return self._current().lookup(model_name)
 
-# --- Mapeo de modelos a sus presets ---
-# La clave es una subcadena del nombre del archivo del modelo para que coincida
-# Ejemplo: "dreamshaper" coincidirá con "dreamshaper_8_93211.safetensors"
-PRESETS = {
-    "dreamshaper": DREAMSHAPER_PRESET,
-    "janku": JANKU_PRESET,
-    "wai_illustrious": WAI_ILLUSTRIOUS_PRESET,
-    "waiillustrious": WAI_ILLUSTRIOUS_PRESET,  # Alias sin underscore
-    "hassaku": HASSAKU_PRESET,
-    "juggernaut": JUGGERNAUT_PRESET,
-    "prefectillustrious": PERFECT_ILLUSTRIOUS_PRESET,  # Coincide con el modelo real (tiene typo)
-    "perfectillustrious": PERFECT_ILLUSTRIOUS_PRESET,  # También coincide con la escritura correcta
-    "ilustmix": ILUSTMIX_PRESET,
-    "cyberrealisticpony": CYBERREALISTICPONY_PRESET,
-    "animij_v12": ANIMIJ_V12_PRESET
-}
+    def _current(self) -> _PresetIndex:
+        index = self._index
+        now = time.monotonic()
+        if index is not None and now - self._checked < self.reload_interval:
+            return index
+        self._checked = now
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if index is None or mtime != index.mtime:
+            try:
+                entries = self._load() if mtime is not None else []
+                if mtime is None:
+                    logging.error(f"No se encontró el archivo de presets {self.path}")
+                self._index = index = _PresetIndex(entries, mtime, self.cache_size)
+                logging.info(f"Presets cargados de {self.path}: {len(index.presets)} modelos")
+            except (OSError, ValueError, TypeError) as e:
+                logging.error(f"Archivo de presets {self.path} no válido: {e}")
+                if index is None:
+                    self._index = index = _PresetIndex([], mtime, self.cache_size)
+        return index
+
+    def _load(self) -> List[Tuple[str, Preset]]:
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        entries = []
+        for item in data["presets"] if isinstance(data, dict) else data:
+            item = dict(item)
+            match = item.pop("match", None) or [item["model_name"]]
+            preset = Preset(**item)
+            if not (preset.steps and preset.cfg and preset.samplers and preset.schedulers and preset.resolutions):
+                raise ValueError(f"preset '{preset.model_name}' sin valores recomendados")
+            entries.extend((key, preset) for key in match)
+        return entries
+
+preset_registry = PresetRegistry(PRESETS_FILE, reload_interval=RESOURCE_RELOAD_INTERVAL)
+
+class _PresetsView(Mapping):
+    """Vista de solo lectura de las claves del registro; sigue las recargas del archivo."""
+    def __getitem__(self, key: str) -> Preset:
+        return preset_registry.by_key[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(preset_registry.by_key)
+
+    def __len__(self) -> int:
+        return len(preset_registry.by_key)
+
+# Compatibilidad con el antiguo diccionario PRESETS (clave -> preset)
+PRESETS: Mapping[str, Preset] = _PresetsView()
 
 def get_preset_for_model(model_name: str) -> Optional[Preset]:
     """
@@ -174,19 +196,7 @@ def get_preset_for_model(model_name: str) -> Optional[Preset]:
     Returns:
         El objeto Preset correspondiente o None si no se encuentra.
     """
-    if not model_name:
-        return None
-
-    def normalize(name: str) -> str:
-        return name.lower().replace("_", "").replace("-", "").replace(" ", "")
-
-    normalized_model_name = normalize(model_name)
-
-    for preset_key, preset_obj in PRESETS.items():
-        if normalize(preset_key) in normalized_model_name:
-            return preset_obj
-            
-    return None
+    return preset_registry.get(model_name)
 
 def are_settings_compliant(settings: dict, preset: Optional[Preset]) -> bool:
     """
@@ -202,18 +212,7 @@ def are_settings_compliant(settings: dict, preset: Optional[Preset]) -> bool:
     if not preset:
         return False
     
-    if settings.get("steps") not in preset.steps:
-        return False
-    if settings.get("cfg_scale") not in preset.cfg:
-        return False
-    if settings.get("sampler_name") not in preset.samplers:
-        return False
-    if settings.get("scheduler") not in preset.schedulers:
-        return False
-    if settings.get("base_size") not in preset.resolutions:
-        return False
-    
-    return True
+    return all(preset.allows(key, settings.get(key)) for key in PRESET_FIELDS)
 
 def validate_and_correct_settings(settings: dict, preset: Optional[Preset]) -> Tuple[dict, bool]:
     """
@@ -234,27 +233,27 @@ def validate_and_correct_settings(settings: dict, preset: Optional[Preset]) -> T
     new_settings = settings.copy()
     
     # Validate Steps
-    if new_settings.get("steps") not in preset.steps:
+    if not preset.allows("steps", new_settings.get("steps")):
         new_settings["steps"] = random.choice(preset.steps)
         modified = True
         
     # Validate CFG
-    if new_settings.get("cfg_scale") not in preset.cfg:
+    if not preset.allows("cfg_scale", new_settings.get("cfg_scale")):
         new_settings["cfg_scale"] = random.choice(preset.cfg)
         modified = True
         
     # Validate Sampler
-    if new_settings.get("sampler_name") not in preset.samplers:
+    if not preset.allows("sampler_name", new_settings.get("sampler_name")):
         new_settings["sampler_name"] = random.choice(preset.samplers)
         modified = True
         
     # Validate Scheduler
-    if new_settings.get("scheduler") not in preset.schedulers:
+    if not preset.allows("scheduler", new_settings.get("scheduler")):
         new_settings["scheduler"] = random.choice(preset.schedulers)
         modified = True
         
     # Validate Resolution (Base Size)
-    if new_settings.get("base_size") not in preset.resolutions:
+    if not preset.allows("base_size", new_settings.get("base_size")):
         new_settings["base_size"] = random.choice(preset.resolutions)
         modified = True
         
@@ -7,7 +7,9 @@ import logging
 from pathlib import Path
 from datetime import datetime
 
-from config import A1111_URL
+from config import A1111_URL, A1111_POOL_SIZE, A1111_KEEPALIVE, A1111_CONNECT_TIMEOUT, A1111_TIMEOUTS, A1111_METADATA_TTL, A1111_METADATA_STALE_TTL, A1111_MODEL_RECONCILE_INTERVAL
+from utils.cache import TTLCache
+from services.model_state import ModelTracker
 LOG_DIR = Path(__file__).resolve().parent.parent / "data" / "logs"
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -31,19 +33,69 @@ def _log_api_call(phase: str, payload: Optional[dict] = None, response: Optional
     except Exception:
         logging.exception("Failed to write a1111 log")
 
-async def a1111_get_json(path: str):
-    url = f"{A1111_URL}{path}"
-    logging.info(f"Getting JSON from: {url}")
-    headers = {"X-Pinggy-No-Screen": "true"}
-    timeout = aiohttp.ClientTimeout(total=10)  # 10 second timeout
-    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
-        async with session.get(url) as resp:
+class A1111Client:
+    """
+    Cliente HTTP de larga duración para la API de A1111.
+    Mantiene una única ClientSession con pool de conexiones y keep-alive, de modo
+    que el polling de progreso y los clics de menú reutilizan conexiones calientes.
+    """
+    def __init__(self, base_url: str, pool_size: int = A1111_POOL_SIZE, keepalive: float = A1111_KEEPALIVE, timeouts: Optional[dict] = None):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.timeouts = timeouts or A1111_TIMEOUTS
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> None:
+        """Abre la sesión compartida (llamar desde el arranque de la aplicación)."""
+        self._get_session()
+
+    async def close(self) -> None:
+        """Cierra la sesión y libera las conexiones del pool."""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Se crea de forma perezosa para que los scripts que no pasan por
+        # _post_init también puedan usar el cliente
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"X-Pinggy-No-Screen": "true"},
+            )
+        return self._session
+
+    def _timeout_for(self, method: str, path: str) -> aiohttp.ClientTimeout:
+        total = self.timeouts.get(f"{method.upper()} {path}", self.timeouts.get("default", 10))
+        return aiohttp.ClientTimeout(total=total, sock_connect=A1111_CONNECT_TIMEOUT)
+
+    def request(self, method: str, path: str, **kwargs):
+        """Devuelve el context manager de la petición usando el timeout del endpoint."""
+        timeout = kwargs.pop("timeout", None) or self._timeout_for(method, path)
+        return self._get_session().request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+
+    async def get_json(self, path: str):
+        async with self.request("GET", path) as resp:
             return await resp.json()
 
-async def a1111_get_progress() -> dict:
-    """Obtiene el progreso actual de la generación desde A1111."""
+# Cliente global compartido por todas las llamadas a A1111
+a1111_client = A1111Client(A1111_URL)
+
+async def a1111_get_json(path: str):
+    logging.info(f"Getting JSON from: {a1111_client.base_url}{path}")
+    return await a1111_client.get_json(path)
+
+async def a1111_get_progress(client: Optional[A1111Client] = None) -> dict:
+    """Obtiene el progreso actual de la generación desde A1111 (por defecto, el backend principal)."""
     try:
-        data = await a1111_get_json("/sdapi/v1/progress")
+        data = await (client or a1111_client).get_json("/sdapi/v1/progress")
         return data
     except Exception as e:
         logging.error(f"Error al obtener progreso: {e}")
@@ -52,31 +104,39 @@ async def a1111_get_progress() -> dict:
 async def a1111_test_connection():
     """Test connection to A1111 API"""
     try:
-        url = f"{A1111_URL}/sdapi/v1/extra-single-image"
-        logging.info(f"Testing connection to A1111 API at: {url}")
-        headers = {"X-Pinggy-No-Screen": "true"}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            # Test with a simple GET to see if endpoint exists
-            async with session.get(url) as resp:
-                logging.info(f"A1111 test response status: {resp.status}")
-                if resp.status == 405:  # Method not allowed is expected for GET on POST endpoint
-                    logging.info("A1111 API endpoint exists (405 Method Not Allowed is expected)")
-                    return True
-                elif resp.status == 404:
-                    logging.error("A1111 API endpoint not found - check A1111_URL and ensure extra-single-image endpoint exists")
-                    return False
-                else:
-                    logging.info(f"A1111 API test response: {resp.status}")
-                    return True
+        path = "/sdapi/v1/extra-single-image"
+        logging.info(f"Testing connection to A1111 API at: {a1111_client.base_url}{path}")
+        # Test with a simple GET to see if endpoint exists
+        async with a1111_client.request("GET", path) as resp:
+            logging.info(f"A1111 test response status: {resp.status}")
+            if resp.status == 405:  # Method not allowed is expected for GET on POST endpoint
+                logging.info("A1111 API endpoint exists (405 Method Not Allowed is expected)")
+                return True
+            elif resp.status == 404:
+                logging.error("A1111 API endpoint not found - check A1111_URL and ensure extra-single-image endpoint exists")
+                return False
+            else:
+                logging.info(f"A1111 API test response: {resp.status}")
+                return True
     except Exception as e:
         logging.error(f"Failed to connect to A1111 API: {str(e)}")
         return False
 
-async def fetch_samplers() -> list[str]:
+# Listas de metadatos cacheadas para no consultar A1111 en cada clic de menú
+_metadata_cache = TTLCache(ttl=A1111_METADATA_TTL, stale_ttl=A1111_METADATA_STALE_TTL)
+
+def invalidate_metadata_cache(key: Optional[str] = None) -> None:
+    """Invalida una lista cacheada ("samplers", "schedulers", "loras", "sd_models", "adetailer_models") o todas."""
+    _metadata_cache.invalidate(key)
+
+async def _load_samplers() -> list[str]:
     data = await a1111_get_json("/sdapi/v1/samplers")
     return [x.get("name") for x in data if isinstance(x, dict) and x.get("name")]
 
-async def fetch_schedulers() -> list[dict]:
+async def fetch_samplers() -> list[str]:
+    return list(await _metadata_cache.get("samplers", _load_samplers))
+
+async def _load_schedulers() -> list[dict]:
     data = await a1111_get_json("/sdapi/v1/schedulers")
     return [
         {"name": x.get("name"), "label": x.get("label") or x.get("name")}
@@ -84,7 +144,10 @@ async def fetch_schedulers() -> list[dict]:
         if isinstance(x, dict) and x.get("name")
     ]
 
-async def fetch_loras() -> list[str]:
+async def fetch_schedulers() -> list[dict]:
+    return list(await _metadata_cache.get("schedulers", _load_schedulers))
+
+async def _load_loras() -> list[str]:
     data = await a1111_get_json("/sdapi/v1/loras")
     names = []
     for x in data:
@@ -93,59 +156,73 @@ async def fetch_loras() -> list[str]:
             names.append(n)
     return names
 
+async def fetch_loras() -> list[str]:
+    return list(await _metadata_cache.get("loras", _load_loras))
+
+async def _load_sd_models() -> list[dict]:
+    data = await a1111_get_json("/sdapi/v1/sd-models")
+    return [
+        {"title": x.get("title"), "model_name": x.get("model_name")}
+        for x in data
+        if isinstance(x, dict) and x.get("title") and x.get("model_name")
+    ]
+
 async def fetch_sd_models() -> list[dict]:
     """Obtiene la lista de modelos de SD disponibles."""
     try:
-        data = await a1111_get_json("/sdapi/v1/sd-models")
-        return [
-            {"title": x.get("title"), "model_name": x.get("model_name")}
-            for x in data
-            if isinstance(x, dict) and x.get("title") and x.get("model_name")
-        ]
+        return list(await _metadata_cache.get("sd_models", _load_sd_models))
     except Exception as e:
         logging.error(f"Error al obtener los modelos de SD: {e}")
         return []
 
+async def _load_adetailer_models() -> list[str]:
+    # Endpoint común para ADetailer: /adetailer/v1/ad_model
+    data = await a1111_get_json("/adetailer/v1/ad_model")
+    # La respuesta suele ser {"ad_model": ["face_yolov8n.pt", ...]}
+    if isinstance(data, dict):
+        return [str(x) for x in data.get("ad_model", [])]
+    elif isinstance(data, list):
+        return [str(x) for x in data]
+    return []
+
 async def fetch_adetailer_models() -> list[str]:
     """Obtiene la lista de modelos de ADetailer disponibles."""
     try:
-        # Endpoint común para ADetailer: /adetailer/v1/ad_model
-        data = await a1111_get_json("/adetailer/v1/ad_model")
-        # La respuesta suele ser {"ad_model": ["face_yolov8n.pt", ...]}
-        if isinstance(data, dict):
-            return [str(x) for x in data.get("ad_model", [])]
-        elif isinstance(data, list):
-            return [str(x) for x in data]
-        return []
+        return list(await _metadata_cache.get("adetailer_models", _load_adetailer_models))
     except Exception as e:
         logging.error(f"Error al obtener modelos ADetailer: {e}")
         return []
 
-async def set_sd_model(model_name: str) -> bool:
-    """Establece el modelo de SD actual en A1111."""
+async def set_sd_model(model_name: str, backend=None) -> bool:
+    """Establece el modelo de SD actual en A1111 (en `backend` si se indica, si no en el principal)."""
+    client = backend.client if backend else a1111_client
+    tracker = backend.tracker if backend else model_tracker
     try:
-        url = f"{A1111_URL}/sdapi/v1/options"
         payload = {"sd_model_checkpoint": model_name}
-        headers = {"X-Pinggy-No-Screen": "true"}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.post(url, json=payload) as resp:
-                resp.raise_for_status()
-                return resp.status == 200
+        async with client.request("POST", "/sdapi/v1/options", json=payload) as resp:
+            resp.raise_for_status()
+            ok = resp.status == 200
+        if ok:
+            tracker.set(model_name)
+            # El menú de modelos vuelve a pedir la lista (y marca el checkpoint recién cargado)
+            invalidate_metadata_cache("sd_models")
+        return ok
     except Exception as e:
         logging.error(f"Error al establecer el modelo de SD: {e}")
         return False
 
-async def get_current_model() -> str:
+async def get_current_model(client: Optional[A1111Client] = None) -> str:
     """Obtiene el nombre del checkpoint del modelo SD actual desde A1111."""
+    client = client or a1111_client
     try:
-        options = await a1111_get_json("/sdapi/v1/options")
+        options = await client.get_json("/sdapi/v1/options")
         model_name = options.get("sd_model_checkpoint")
         if model_name:
             logging.info(f"Modelo actual de A1111 (desde options): {model_name}")
             return model_name
 
         logging.warning("No se pudo determinar el modelo actual desde /sdapi/v1/options. Intentando con /sd-models.")
-        models = await a1111_get_json("/sdapi/v1/sd-models")
+        models = await client.get_json("/sdapi/v1/sd-models")
         if models and isinstance(models, list) and len(models) > 0:
             first_model = models[0]
             model_name = first_model.get("model_name")
@@ -159,12 +236,15 @@ async def get_current_model() -> str:
         logging.error(f"Error al obtener el modelo de A1111: {e}")
         return "Not available"
 
+# Modelo cargado en A1111, cacheado localmente y reconciliado en segundo plano
+model_tracker = ModelTracker(get_current_model, reconcile_interval=A1111_MODEL_RECONCILE_INTERVAL)
+
 def _normalize_scheduler(scheduler: Optional[str]) -> Optional[str]:
     if not scheduler or str(scheduler).lower() in {"", "none", "automatic"}:
         return "Automatic"
     return scheduler
 
-async def a1111_txt2img(prompt: str, width: int = 512, height: int = 512, steps: int = 4, cfg_scale: float = 1.0, sampler_name: str = "LCM", n_iter: int = 1, scheduler: str = "", seed: int = -1, negative_prompt: str = "", hr_options: Optional[dict] = None, alwayson_scripts: Optional[dict] = None) -> dict:
+async def a1111_txt2img(prompt: str, width: int = 512, height: int = 512, steps: int = 4, cfg_scale: float = 1.0, sampler_name: str = "LCM", n_iter: int = 1, scheduler: str = "", seed: int = -1, negative_prompt: str = "", hr_options: Optional[dict] = None, alwayson_scripts: Optional[dict] = None, batch_size: int = 1, backend=None) -> dict:
     payload = {
         "prompt": prompt,
         "negative_prompt": negative_prompt,
@@ -175,7 +255,7 @@ async def a1111_txt2img(prompt: str, width: int = 512, height: int = 512, steps:
         "height": height,
         "sampler_name": sampler_name,
         "scheduler": _normalize_scheduler(scheduler),
-        "batch_size": 1,
+        "batch_size": max(1, min(8, batch_size)),
         "n_iter": max(1, min(8, n_iter)),
         "send_images": True,
         "save_images": False,
@@ -194,25 +274,22 @@ async def a1111_txt2img(prompt: str, width: int = 512, height: int = 512, steps:
         })
     if alwayson_scripts:
         payload["alwayson_scripts"] = alwayson_scripts
-    url = f"{A1111_URL}/sdapi/v1/txt2img"
-    headers = {"X-Pinggy-No-Screen": "true"}
-    timeout = aiohttp.ClientTimeout(total=300)  # 5 minute timeout for generation
-    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
-        logging.info(f"txt2img payload: {payload}")
-        _log_api_call("request", payload=payload)
-        async with session.post(url, json=payload) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-            imgs = [base64.b64decode(b) for b in (data.get("images") or [])]
-            info_raw = data.get("info")
+    logging.info(f"txt2img payload: {payload}")
+    _log_api_call("request", payload=payload)
+    client = backend.client if backend else a1111_client
+    async with client.request("POST", "/sdapi/v1/txt2img", json=payload) as resp:
+        resp.raise_for_status()
+        data = await resp.json()
+        imgs = [base64.b64decode(b) for b in (data.get("images") or [])]
+        info_raw = data.get("info")
+        info = None
+        try:
+            info = json.loads(info_raw) if isinstance(info_raw, str) else info_raw
+        except Exception:
             info = None
-            try:
-                info = json.loads(info_raw) if isinstance(info_raw, str) else info_raw
-            except Exception:
-                info = None
-            response_log = {"parameters": data.get("parameters"), "info": info_raw}
-            _log_api_call("response", response=response_log)
-            return {"images": imgs, "parameters": data.get("parameters"), "info": info}
+        response_log = {"parameters": data.get("parameters"), "info": info_raw}
+        _log_api_call("response", response=response_log)
+        return {"images": imgs, "parameters": data.get("parameters"), "info": info}
 
 async def a1111_extra_single_image(image_bytes: bytes, upscaler_1: str = "R-ESRGAN 4x+", upscaling_resize: int = 2, upscaling_resize_w: int = 0, upscaling_resize_h: int = 0, upscaling_crop: bool = True) -> bytes:
     b64 = base64.b64encode(image_bytes).decode("ascii")
@@ -230,37 +307,34 @@ async def a1111_extra_single_image(image_bytes: bytes, upscaler_1: str = "R-ESRG
         "upscale_first": False,
         "image": b64,
     }
-    url = f"{A1111_URL}/sdapi/v1/extra-single-image"
-    headers = {"X-Pinggy-No-Screen": "true"}
-    async with aiohttp.ClientSession(headers=headers) as session:
-        logging.info(f"Llamando a extra-single-image con payload: upscaler={upscaler_1}, resize={upscaling_resize}, image_size={len(b64)} chars")
-        _log_api_call("extras_request", payload=payload)
-        try:
-            async with session.post(url, json=payload) as resp:
-                logging.info(f"Response status: {resp.status}")
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    logging.error(f"A1111 API Error Response: {error_text}")
-                    resp.raise_for_status()
-                
-                data = await resp.json()
-                logging.info(f"Response data keys: {list(data.keys()) if data else 'None'}")
-                img_b64 = data.get("image")
-                if not img_b64:
-                    logging.warning(f"No 'image' key in response. Full response: {data}")
-                    # Fallback for older API versions that might return "images"
-                    images_list = data.get("images")
-                    if images_list:
-                        img_b64 = images_list[0]
-
-                if not img_b64:
-                    logging.error("Respuesta de A1111 no contiene imagen.")
-                    _log_api_call("extras_response_error", response={"error": "No image in response", "response_preview": str(data)[:500]})
-                    return b""
-
-                out = base64.b64decode(img_b64)
-                _log_api_call("extras_response", response={"ok": True, "has_image": True, "response_keys": list(data.keys()) if data else []})
-                return out
-        except Exception as e:
-            logging.error(f"Error en extra-single-image: {str(e)}", exc_info=True)
-            raise
\ No newline at end of file
+    logging.info(f"Llamando a extra-single-image con payload: upscaler={upscaler_1}, resize={upscaling_resize}, image_size={len(b64)} chars")
+    _log_api_call("extras_request", payload=payload)
+    try:
+        async with a1111_client.request("POST", "/sdapi/v1/extra-single-image", json=payload) as resp:
+            logging.info(f"Response status: {resp.status}")
+            if resp.status != 200:
+                error_text = await resp.text()
+                logging.error(f"A1111 API Error Response: {error_text}")
+                resp.raise_for_status()
+            
+            data = await resp.json()
+            logging.info(f"Response data keys: {list(data.keys()) if data else 'None'}")
+            img_b64 = data.get("image")
+            if not img_b64:
+                logging.warning(f"No 'image' key in response. Full response: {data}")
+                # Fallback for older API versions that might return "images"
+                images_list = data.get("images")
+                if images_list:
+                    img_b64 = images_list[0]
+
+            if not img_b64:
+                logging.error("Respuesta de A1111 no contiene imagen.")
+                _log_api_call("extras_response_error", response={"error": "No image in response", "response_preview": str(data)[:500]})
+                return b""
+
+            out = base64.b64decode(img_b64)
+            _log_api_call("extras_response", response={"ok": True, "has_image": True, "response_keys": list(data.keys()) if data else []})
+            return out
+    except Exception as e:
+        logging.error(f"Error en extra-single-image: {str(e)}", exc_info=True)
+        raise
\ No newline at end of file
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import aiohttp
+from functools import partial
+from typing import Iterable, List, Optional
+
+from config import A1111_BACKENDS, A1111_ROUTING, A1111_HEALTH_INTERVAL, A1111_MAX_FAILURES, A1111_MODEL_RECONCILE_INTERVAL
+from services.a1111 import A1111Client, a1111_client, model_tracker, get_current_model, a1111_get_progress
+from services.model_state import ModelTracker
+
+def is_backend_failure(e: BaseException) -> bool:
+    """Errores que indican que el servidor no está disponible (no un payload inválido)."""
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500
+    return isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError, asyncio.TimeoutError, ConnectionError))
+
+class A1111Backend:
+    """Un servidor A1111: su cliente HTTP, el modelo que tiene cargado y sus slots de generación."""
+    def __init__(self, name: str, client: A1111Client, tracker: ModelTracker, concurrency: int = 1):
+        self.name = name
+        self.client = client
+        self.tracker = tracker
+        self.concurrency = max(1, concurrency)
+        self.active = 0
+        self.healthy = True
+        self.failures = 0
+        self.completed = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def free(self) -> bool:
+        return self.healthy and self.active < self.concurrency
+
+    @property
+    def load(self) -> float:
+        return self.active / self.concurrency
+
+    async def get_progress(self) -> dict:
+        return await a1111_get_progress(self.client)
+
+    def __repr__(self) -> str:
+        return f"<A1111Backend {self.name} {self.client.base_url} {self.active}/{self.concurrency}{'' if self.healthy else ' DOWN'}>"
+
+class A1111Pool:
+    """
+    Conjunto de servidores A1111 con reparto de trabajos.
+
+    Cada backend tiene `concurrency` slots. `acquire` elige un backend sano con hueco:
+    con A1111_ROUTING = "affinity" prefiere el que ya tiene cargado el checkpoint del
+    trabajo y, si no hay, el menos cargado; con "least_loaded" solo mira la carga.
+    Un sondeo periódico marca como caído el backend que acumula `max_failures`
+    errores seguidos y lo recupera en cuanto vuelve a responder.
+    """
+    def __init__(self, backends: List[A1111Backend], routing: str = "affinity", health_interval: float = 30, max_failures: int = 2):
+        if not backends:
+            raise ValueError("Se necesita al menos un backend de A1111")
+        self.backends = backends
+        self.routing = routing
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def primary(self) -> A1111Backend:
+        return self.backends[0]
+
+    @property
+    def capacity(self) -> int:
+        return sum(b.concurrency for b in self.backends)
+
+    async def start(self) -> None:
+        for b in self.backends:
+            await b.client.start()
+            await b.tracker.start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._health_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for b in self.backends:
+            await b.tracker.stop()
+            await b.client.close()
+
+    def status(self) -> List[dict]:
+        """Estado de cada servidor (para /status)."""
+        return [
+            {"name": b.name, "healthy": b.healthy, "active": b.active, "concurrency": b.concurrency,
+             "model": b.tracker.current, "completed": b.completed, "last_error": b.last_error}
+            for b in self.backends
+        ]
+
+    def has_loaded(self, model_name: Optional[str]) -> bool:
+        """True si algún backend con hueco ya tiene cargado `model_name` (lo usa el planificador)."""
+        return any(b.free and b.tracker.is_loaded(model_name) for b in self.backends)
+
+    def _pick(self, target_model: Optional[str], exclude: Iterable[A1111Backend] = ()) -> Optional[A1111Backend]:
+        candidates = [b for b in self.backends if b.free and b not in exclude]
+        if not candidates:
+            return None
+        if self.routing == "affinity" and target_model:
+            warm = [b for b in candidates if b.tracker.is_loaded(target_model)]
+            if warm:
+                candidates = warm
+        # Menos cargado; a igualdad, el que menos trabajos lleva (reparte en reposo)
+        return min(candidates, key=lambda b: (b.load, b.completed))
+
+    async def wait_available(self) -> None:
+        """Espera a que algún backend sano tenga un slot libre."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: any(b.free for b in self.backends))
+
+    async def acquire(self, target_model: Optional[str] = None, exclude: Iterable[A1111Backend] = ()) -> A1111Backend:
+        exclude = tuple(exclude)
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._pick(target_model, exclude) is not None)
+            backend = self._pick(target_model, exclude)
+            backend.active += 1
+            return backend
+
+    async def release(self, backend: A1111Backend, error: Optional[Exception] = None) -> None:
+        """Devuelve el slot; con `error`, cuenta un fallo y puede marcar el backend como caído."""
+        async with self._changed:
+            backend.active -= 1
+            if error is None:
+                backend.failures = 0
+                backend.completed += 1
+            else:
+                self._record_failure(backend, error)
+            self._changed.notify_all()
+
+    def _record_failure(self, backend: A1111Backend, error: Exception) -> None:
+        backend.failures += 1
+        backend.last_error = str(error)
+        if backend.healthy and backend.failures >= self.max_failures:
+            backend.healthy = False
+            logging.error(f"Backend A1111 '{backend.name}' marcado como caído tras {backend.failures} errores: {error}")
+
+    async def probe(self, backend: A1111Backend) -> bool:
+        try:
+            async with backend.client.request("GET", "/sdapi/v1/progress?skip_current_image=true") as resp:
+                resp.raise_for_status()
+            ok = True
+        except Exception as e:
+            ok = False
+            error = e
+        async with self._changed:
+            if ok:
+                if not backend.healthy:
+                    logging.info(f"Backend A1111 '{backend.name}' disponible de nuevo")
+                backend.healthy = True
+                backend.failures = 0
+            elif backend.healthy:
+                self._record_failure(backend, error)
+            self._changed.notify_all()
+        return ok
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.gather(*(self.probe(b) for b in self.backends))
+            await asyncio.sleep(self.health_interval)
+
+def _build_pool() -> A1111Pool:
+    backends = []
+    for i, conf in enumerate(A1111_BACKENDS):
+        name = conf.get("name") or f"a1111-{i}"
+        if i == 0:
+            # El primero reutiliza el cliente y el tracker globales que usan los menús
+            a1111_client.base_url = conf["url"].rstrip("/")
+            client, tracker = a1111_client, model_tracker
+        else:
+            client = A1111Client(conf["url"])
+            tracker = ModelTracker(partial(get_current_model, client), reconcile_interval=A1111_MODEL_RECONCILE_INTERVAL)
+        backends.append(A1111Backend(name, client, tracker, conf.get("concurrency", 1)))
+    return A1111Pool(backends, routing=A1111_ROUTING, health_interval=A1111_HEALTH_INTERVAL, max_failures=A1111_MAX_FAILURES)
+
+a1111_pool = _build_pool()
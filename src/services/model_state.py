@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import re
+from typing import Awaitable, Callable, Optional
+
+# Valores que get_current_model devuelve cuando A1111 no responde; nunca se cachean
+_UNKNOWN_MODELS = {"", "Unknown", "Not available"}
+
+_HASH_SUFFIX = re.compile(r"\s*\[[0-9a-fA-F]+\]\s*$")
+_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".gguf")
+
+def checkpoint_key(name: Optional[str]) -> str:
+    """
+    Normaliza un nombre de checkpoint para poder comparar el "title" de A1111
+    ("sub/dreamshaper_8.safetensors [879db523c3]") con su "model_name" ("sub_dreamshaper_8").
+    """
+    if not name:
+        return ""
+    key = _HASH_SUFFIX.sub("", str(name)).strip().replace("\\", "_").replace("/", "_")
+    for ext in _EXTENSIONS:
+        if key.lower().endswith(ext):
+            key = key[: -len(ext)]
+            break
+    return key.lower()
+
+class ModelTracker:
+    """
+    Recuerda qué checkpoint tiene cargado A1111 para no consultar /sdapi/v1/options
+    en cada callback. Se actualiza localmente cuando set_sd_model tiene éxito y se
+    reconcilia con A1111 en segundo plano cada `reconcile_interval` segundos.
+    """
+    def __init__(self, fetch: Callable[[], Awaitable[str]], reconcile_interval: float = 120):
+        self._fetch = fetch
+        self.reconcile_interval = reconcile_interval
+        self.current: Optional[str] = None
+        self._version = 0  # se incrementa en cada set() para descartar reconciliaciones obsoletas
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def get(self) -> str:
+        """Devuelve el modelo cargado; solo consulta A1111 si aún no se conoce."""
+        if self.current is not None:
+            return self.current
+        async with self._lock:
+            if self.current is None:
+                return await self.reconcile()
+        return self.current
+
+    def set(self, model_name: str) -> None:
+        """Registra el modelo que acaba de cargarse con éxito."""
+        self.current = model_name
+        self._version += 1
+
+    def is_loaded(self, model_name: Optional[str]) -> bool:
+        return bool(model_name) and self.current is not None and checkpoint_key(self.current) == checkpoint_key(model_name)
+
+    async def reconcile(self) -> str:
+        """Consulta A1111 y actualiza el estado salvo que un set() más reciente lo haya cambiado."""
+        version = self._version
+        name = await self._fetch()
+        if name not in _UNKNOWN_MODELS and version == self._version:
+            if self.current is not None and not self.is_loaded(name):
+                logging.info(f"Modelo reconciliado con A1111: '{self.current}' -> '{name}'")
+            self.current = name
+        return self.current if self.current is not None else name
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._reconcile_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _reconcile_loop(self) -> None:
+        while True:
+            try:
+                await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"No se pudo reconciliar el modelo actual: {e}")
+            await asyncio.sleep(self.reconcile_interval)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from telegram.error import BadRequest, RetryAfter
+from utils.rate_limit import TokenBucket
+
+def retry_after_seconds(value) -> float:
+    """RetryAfter.retry_after puede ser int o timedelta según la versión de PTB."""
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+class EditDispatcher:
+    """
+    Cola de ediciones de mensajes de Telegram con límite de ritmo.
+
+    Solo se conserva el último texto pendiente por mensaje (las ediciones superadas se
+    descartan), se respetan un token bucket global y otro por chat, y ante un 429 se
+    pausa todo el envío durante el `retry_after` indicado por Telegram.
+    """
+    def __init__(self, global_rate: float = 20, global_burst: float = 20, chat_rate: float = 0.5, chat_burst: float = 3):
+        self.bot = None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._pending: "OrderedDict[Tuple[int, int], dict]" = OrderedDict()
+        self._blocked_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Métricas
+        self.sent = 0
+        self.superseded = 0
+        self.rate_limited = 0
+
+    def start(self, bot) -> None:
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._pending.clear()
+
+    def submit(self, chat_id: int, message_id: int, text: str, **kwargs) -> None:
+        """Programa una edición; si ya había una pendiente para el mensaje, la reemplaza."""
+        key = (chat_id, message_id)
+        if key in self._pending:
+            self.superseded += 1
+        self._pending[key] = {"text": text, **kwargs}
+        self._wakeup.set()
+
+    def discard(self, chat_id: int, message_id: int) -> None:
+        """Olvida la edición pendiente de un mensaje (p. ej. antes de borrarlo)."""
+        self._pending.pop((chat_id, message_id), None)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_chats(self) -> None:
+        """Olvida los chats sin ediciones pendientes cuyo bucket ya está lleno (uno nuevo sería igual)."""
+        busy = {chat_id for chat_id, _ in self._pending}
+        idle = [chat_id for chat_id, bucket in self._chats.items()
+                if chat_id not in busy and bucket.time_until(bucket.capacity) <= 0]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    def _next_ready(self) -> Tuple[Optional[Tuple[int, int]], float]:
+        """Primer mensaje (por orden de llegada) cuyo chat tiene cupo, o el tiempo a esperar."""
+        wait = float("inf")
+        for key in self._pending:
+            delay = self._chat_bucket(key[0]).time_until()
+            if delay <= 0:
+                return key, 0.0
+            wait = min(wait, delay)
+        return None, wait
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                self._prune_chats()
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            if self._blocked_until > now:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            key, wait = self._next_ready()
+            if key is None:
+                # Despertar antes si llega una edición para otro chat
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._global.acquire()
+            kwargs = self._pending.pop(key, None)
+            if kwargs is None:
+                continue  # descartada mientras esperábamos cupo global
+            self._chat_bucket(key[0]).try_acquire()
+            await self._send(key, kwargs)
+
+    async def _send(self, key: Tuple[int, int], kwargs: dict) -> None:
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, **kwargs)
+            self.sent += 1
+        except RetryAfter as e:
+            self.rate_limited += 1
+            delay = retry_after_seconds(e.retry_after)
+            self._blocked_until = time.monotonic() + delay
+            logging.warning(f"Telegram flood control: pausando ediciones {delay:.0f}s")
+            # Reintentar después salvo que ya haya un texto más nuevo
+            self._pending.setdefault(key, kwargs)
+        except BadRequest as e:
+            text = str(e).lower()
+            if "not modified" not in text and "not found" not in text:
+                logging.warning(f"Failed to edit message {message_id} in chat {chat_id}: {e}")
+        except Exception as e:
+            logging.warning(f"Failed to edit message {message_id} in chat {chat_id}: {e}")
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import logging
+from typing import Dict, Optional
+
+import aiohttp
+
+class TelegramAPIError(Exception):
+    def __init__(self, description: str, retry_after: Optional[float] = None, error_code: Optional[int] = None):
+        super().__init__(description)
+        self.retry_after = retry_after
+        self.error_code = error_code
+
+def is_transient(e: BaseException) -> bool:
+    """429, 5xx y fallos de red se reintentan; otro 4xx (p. ej. 400 Bad Request) fallaría igual."""
+    if isinstance(e, TelegramAPIError):
+        return e.error_code == 429 or (e.error_code or 0) >= 500
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
+class TelegramUploader:
+    """
+    Subidas de archivos a la Bot API de Telegram sobre una única sesión aiohttp con pool
+    de conexiones. Limita las subidas simultáneas por chat y reintenta los 429 (respetando
+    el `retry_after` que devuelve Telegram), los 5xx y los fallos de red.
+    """
+    def __init__(self, pool_size: int = 8, per_chat: int = 1, max_attempts: int = 3, timeout: float = 300, base_url: str = "https://api.telegram.org"):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.per_chat = per_chat
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.token: Optional[str] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._chat_locks: Dict[int, asyncio.Semaphore] = {}
+
+    async def start(self, token: str) -> None:
+        self.token = token
+        self._get_session()
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def _chat_lock(self, chat_id: int) -> asyncio.Semaphore:
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Semaphore(self.per_chat)
+        return lock
+
+    async def send_document(self, chat_id: int, data: bytes, filename: str, caption: str = "", reply_markup: Optional[dict] = None, content_type: str = "image/png") -> dict:
+        return await self.send_file("sendDocument", "document", chat_id, data, filename, caption, reply_markup, content_type)
+
+    async def send_file(self, method: str, field: str, chat_id: int, data: bytes, filename: str, caption: str = "", reply_markup: Optional[dict] = None, content_type: str = "image/png") -> dict:
+        """Envía `data` con el método indicado (sendDocument, sendPhoto...) y devuelve el Message como dict."""
+        url = f"{self.base_url}/bot{self.token}/{method}"
+        fields = {"chat_id": str(chat_id), "caption": caption, "parse_mode": "HTML"}
+        if reply_markup:
+            fields["reply_markup"] = json.dumps(reply_markup)
+        attempt = 0
+        async with self._chat_lock(chat_id):
+            while True:
+                # FormData es de un solo uso en aiohttp; reconstruirlo solo envuelve los mismos bytes
+                form = aiohttp.FormData(fields)
+                form.add_field(field, data, filename=filename, content_type=content_type)
+                try:
+                    async with self._get_session().post(url, data=form) as resp:
+                        status = resp.status
+                        try:
+                            result = await resp.json(content_type=None)
+                        except ValueError:
+                            # Un proxy o un servidor Bot API local caído puede responder HTML
+                            result = {"ok": False, "error_code": status, "description": f"HTTP {status}"}
+                    if not result.get("ok"):
+                        params = result.get("parameters") or {}
+                        logging.error(f"Telegram API error: {result}")
+                        raise TelegramAPIError(result.get("description", "Unknown error"), params.get("retry_after"), result.get("error_code", status))
+                    return result.get("result", {})
+                except Exception as e:
+                    attempt += 1
+                    logging.error(f"Error en {method} (attempt {attempt}): {str(e)}")
+                    if attempt >= self.max_attempts or not is_transient(e):
+                        raise
+                    retry_after = getattr(e, "retry_after", None)
+                    await asyncio.sleep(float(retry_after) if retry_after else 5 * attempt)
@@ -0,0 +1,452 @@
+"""
+Motores de almacenamiento para ajustes de usuario, trabajos y mensajes de error.
+
+`JsonBackend` conserva el árbol histórico de `data/` (un JSON por usuario y por
+trabajo); `SqliteBackend` guarda lo mismo en una única base SQLite en modo WAL con
+índices por usuario, chat y fecha. `storage.users`, `storage.jobs` y
+`storage.error_messages` hablan con el motor configurado en `STORAGE_BACKEND`.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from config import ERROR_LOG_COMPACT_EVERY, STORAGE_BACKEND, STORAGE_FSYNC, STORAGE_SQLITE_PATH
+from storage.durable import SQLITE_SYNCHRONOUS, append_line, atomic_write, write_many
+
+DATA_DIR = Path(__file__).resolve().parents[2] / "data"
+
+class StorageBackend:
+    """Interfaz común de los motores de almacenamiento."""
+
+    # Ajustes de usuario
+    def get_user(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put_user(self, user_id: int, settings: dict) -> None:
+        raise NotImplementedError
+
+    def put_users(self, users: Dict[int, dict]) -> None:
+        for user_id, settings in users.items():
+            self.put_user(user_id, settings)
+
+    def iter_users(self) -> Iterator[Tuple[int, dict]]:
+        raise NotImplementedError
+
+    # Trabajos enviados (uno por imagen, clave message_id)
+    def get_job(self, message_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def put_job(self, message_id: int, data: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def delete_job(self, message_id: int) -> None:
+        raise NotImplementedError
+
+    def iter_jobs(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        raise NotImplementedError
+
+    def prune_jobs(self, max_age: Optional[float] = None, per_user: Optional[int] = None) -> List[Tuple[int, Dict[str, Any]]]:
+        """Borra los trabajos más viejos que `max_age` segundos o fuera de los `per_user` más recientes de cada usuario. Devuelve los borrados."""
+        raise NotImplementedError
+
+    # Mensajes de error pendientes de borrar, agrupados por chat
+    def get_error_messages(self) -> Dict[int, Set[int]]:
+        raise NotImplementedError
+
+    def add_error_message(self, chat_id: int, message_id: int) -> None:
+        raise NotImplementedError
+
+    def remove_error_message(self, chat_id: int, message_id: int) -> None:
+        raise NotImplementedError
+
+    def replace_error_messages(self, error_msgs: Dict[int, Set[int]]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+class JsonBackend(StorageBackend):
+    """Un archivo JSON por usuario y por trabajo, y un único JSON para los mensajes de error."""
+
+    def __init__(self, root: Path = DATA_DIR):
+        self.users_dir = root / "users"
+        self.jobs_dir = root / "jobs"
+        self.error_messages_file = root / "error_messages.json"
+        self.error_log_file = root / "error_messages.log"
+        self._errors: Optional[Dict[int, Set[int]]] = None
+        self._error_log_entries = 0
+        # Índice de trabajos message_id -> (user_id, timestamp) para la retención, construido en la primera pasada
+        self._jobs: Optional[Dict[int, Tuple[Optional[int], float]]] = None
+        self._jobs_lock = threading.Lock()
+        self.users_dir.mkdir(parents=True, exist_ok=True)
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        fp = self.users_dir / f"{user_id}.json"
+        if fp.exists():
+            try:
+                return json.loads(fp.read_text(encoding="utf-8"))
+            except Exception as e:
+                # No sobrescribir en silencio: se aparta para poder recuperarlo a mano
+                logging.error(f"Ajustes corruptos en {fp}, se apartan como .corrupt: {e}")
+                os.replace(fp, fp.with_suffix(".json.corrupt"))
+                return None
+        return None
+
+    def put_user(self, user_id: int, settings: dict) -> None:
+        atomic_write(self.users_dir / f"{user_id}.json", json.dumps(settings, ensure_ascii=False))
+
+    def put_users(self, users: Dict[int, dict]) -> None:
+        write_many((self.users_dir / f"{user_id}.json", json.dumps(settings, ensure_ascii=False)) for user_id, settings in users.items())
+
+    def iter_users(self) -> Iterator[Tuple[int, dict]]:
+        for fp in self.users_dir.glob("*.json"):
+            try:
+                yield int(fp.stem), json.loads(fp.read_text(encoding="utf-8"))
+            except Exception as e:
+                logging.warning(f"Ajustes ilegibles en {fp}: {e}")
+
+    def get_job(self, message_id: int) -> Optional[Dict[str, Any]]:
+        job_file = self.jobs_dir / f"{message_id}.json"
+        if job_file.exists():
+            try:
+                return json.loads(job_file.read_text(encoding="utf-8"))
+            except Exception:
+                return None
+        return None
+
+    def put_job(self, message_id: int, data: Dict[str, Any]) -> None:
+        atomic_write(self.jobs_dir / f"{message_id}.json", json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        with self._jobs_lock:
+            if self._jobs is not None:
+                self._jobs[message_id] = self._job_key(data)
+
+    def delete_job(self, message_id: int) -> None:
+        job_file = self.jobs_dir / f"{message_id}.json"
+        if job_file.exists():
+            job_file.unlink()
+        with self._jobs_lock:
+            if self._jobs is not None:
+                self._jobs.pop(message_id, None)
+
+    def iter_jobs(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        for fp in self.jobs_dir.glob("*.json"):
+            try:
+                yield int(fp.stem), json.loads(fp.read_text(encoding="utf-8"))
+            except Exception as e:
+                logging.warning(f"Trabajo ilegible en {fp}: {e}")
+
+    @staticmethod
+    def _job_key(data: Dict[str, Any]) -> Tuple[Optional[int], float]:
+        return data.get("user_id"), data.get("timestamp", 0.0)
+
+    def _job_index(self) -> Dict[int, Tuple[Optional[int], float]]:
+        with self._jobs_lock:
+            if self._jobs is None:
+                self._jobs = {message_id: self._job_key(data) for message_id, data in self.iter_jobs()}
+            return self._jobs
+
+    def prune_jobs(self, max_age: Optional[float] = None, per_user: Optional[int] = None) -> List[Tuple[int, Dict[str, Any]]]:
+        index = self._job_index()
+        cutoff = time.time() - max_age if max_age else None
+        with self._jobs_lock:
+            by_user: Dict[Optional[int], List[Tuple[float, int]]] = {}
+            for message_id, (uid, ts) in index.items():
+                by_user.setdefault(uid, []).append((ts, message_id))
+        doomed = []
+        for entries in by_user.values():
+            entries.sort(reverse=True)
+            for rank, (ts, message_id) in enumerate(entries):
+                if (cutoff is not None and ts < cutoff) or (per_user and rank >= per_user):
+                    doomed.append(message_id)
+        removed = []
+        for message_id in doomed:
+            data = self.get_job(message_id)
+            self.delete_job(message_id)
+            removed.append((message_id, data or {}))
+        return removed
+
+    # Mensajes de error: instantánea JSON + registro de solo anexado ("+ chat msg" / "- chat msg").
+    # Cada alta/baja es una línea; el registro se compacta en la instantánea cada
+    # ERROR_LOG_COMPACT_EVERY entradas. El índice en memoria se reconstruye al arrancar.
+
+    def _error_index(self) -> Dict[int, Set[int]]:
+        if self._errors is None:
+            self._errors = self._read_error_snapshot()
+            self._error_log_entries = 0
+            damaged = False
+            if self.error_log_file.exists():
+                for line in self.error_log_file.read_text(encoding="utf-8").splitlines():
+                    try:
+                        op, chat_id, message_id = line.split()
+                        self._apply_error(op, int(chat_id), int(message_id))
+                        self._error_log_entries += 1
+                    except ValueError:
+                        # Línea truncada por un corte a mitad de escritura
+                        logging.warning(f"Entrada ilegible en {self.error_log_file}: {line!r}")
+                        damaged = True
+            if damaged:
+                # Compactar ya: anexar tras una línea truncada corrompería la siguiente entrada
+                self._compact_errors()
+        return self._errors
+
+    def _read_error_snapshot(self) -> Dict[int, Set[int]]:
+        if self.error_messages_file.exists():
+            try:
+                data = json.loads(self.error_messages_file.read_text(encoding="utf-8"))
+                # Convert string keys to int and values to sets
+                return {int(k): set(v) for k, v in data.items()}
+            except Exception as e:
+                logging.error(f"Error loading error messages: {e}")
+        return {}
+
+    def _apply_error(self, op: str, chat_id: int, message_id: int) -> None:
+        if op == "+":
+            self._errors.setdefault(chat_id, set()).add(message_id)
+        elif op == "-":
+            ids = self._errors.get(chat_id)
+            if ids is not None:
+                ids.discard(message_id)
+                # Remove chat if no more error messages
+                if not ids:
+                    del self._errors[chat_id]
+        else:
+            raise ValueError(op)
+
+    def _log_error(self, op: str, chat_id: int, message_id: int) -> None:
+        self._apply_error(op, chat_id, message_id)
+        try:
+            append_line(self.error_log_file, f"{op} {chat_id} {message_id}")
+            self._error_log_entries += 1
+            if self._error_log_entries >= ERROR_LOG_COMPACT_EVERY:
+                self._compact_errors()
+        except Exception as e:
+            logging.error(f"Error saving error messages: {e}")
+
+    def _compact_errors(self) -> None:
+        """Reescribe la instantánea con el índice actual y vacía el registro."""
+        self.error_messages_file.parent.mkdir(parents=True, exist_ok=True)
+        # Convert integer keys to strings and sets to lists for JSON
+        data = {str(k): sorted(v) for k, v in self._errors.items()}
+        atomic_write(self.error_messages_file, json.dumps(data))
+        # Solo después de guardar la instantánea se vacía el registro
+        atomic_write(self.error_log_file, "")
+        self._error_log_entries = 0
+
+    def get_error_messages(self) -> Dict[int, Set[int]]:
+        return {chat_id: set(ids) for chat_id, ids in self._error_index().items()}
+
+    def add_error_message(self, chat_id: int, message_id: int) -> None:
+        self._error_index()
+        self._log_error("+", chat_id, message_id)
+
+    def remove_error_message(self, chat_id: int, message_id: int) -> None:
+        if message_id in self._error_index().get(chat_id, ()):
+            self._log_error("-", chat_id, message_id)
+
+    def replace_error_messages(self, error_msgs: Dict[int, Set[int]]) -> None:
+        self._errors = {chat_id: set(ids) for chat_id, ids in error_msgs.items() if ids}
+        try:
+            self._compact_errors()
+        except Exception as e:
+            logging.error(f"Error saving error messages: {e}")
+
+class SqliteBackend(StorageBackend):
+    """
+    Base SQLite única en modo WAL; `synchronous` sigue a STORAGE_FSYNC. Las consultas son sentencias fijas
+    parametrizadas, que el módulo sqlite3 prepara una vez y reutiliza. Una sola conexión
+    compartida, serializada con un lock para poder usarse también desde hilos.
+    """
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        settings TEXT NOT NULL,
+        updated REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS jobs (
+        message_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        chat_id INTEGER,
+        seed INTEGER,
+        timestamp REAL NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_user_ts ON jobs (user_id, timestamp);
+    CREATE INDEX IF NOT EXISTS jobs_chat ON jobs (chat_id);
+    CREATE INDEX IF NOT EXISTS jobs_ts ON jobs (timestamp);
+    CREATE TABLE IF NOT EXISTS error_messages (
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, message_id)
+    ) WITHOUT ROWID;
+    """
+
+    _PUT_USER = (
+        "INSERT INTO users (user_id, settings, updated) VALUES (?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET settings = excluded.settings, updated = excluded.updated"
+    )
+    _PUT_JOB = "INSERT OR REPLACE INTO jobs (message_id, user_id, chat_id, seed, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)"
+    _ADD_ERROR = "INSERT OR IGNORE INTO error_messages (chat_id, message_id) VALUES (?, ?)"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, cached_statements=64)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS[STORAGE_FSYNC]}")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(self._SCHEMA)
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _user_row(user_id: int, settings: dict) -> tuple:
+        return user_id, json.dumps(settings, ensure_ascii=False), time.time()
+
+    @staticmethod
+    def _job_row(message_id: int, data: Dict[str, Any]) -> tuple:
+        return (
+            message_id,
+            data.get("user_id"),
+            data.get("chat_id"),
+            data.get("seed"),
+            data.get("timestamp", time.time()),
+            json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+        )
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        row = self._fetchone("SELECT settings FROM users WHERE user_id = ?", (user_id,))
+        return json.loads(row[0]) if row else None
+
+    def put_user(self, user_id: int, settings: dict) -> None:
+        self._execute(self._PUT_USER, self._user_row(user_id, settings))
+
+    def put_users(self, users: Dict[int, dict]) -> None:
+        rows = [self._user_row(user_id, settings) for user_id, settings in users.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(self._PUT_USER, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def iter_users(self) -> Iterator[Tuple[int, dict]]:
+        for user_id, settings in self._fetchall("SELECT user_id, settings FROM users"):
+            yield user_id, json.loads(settings)
+
+    def get_job(self, message_id: int) -> Optional[Dict[str, Any]]:
+        row = self._fetchone("SELECT data FROM jobs WHERE message_id = ?", (message_id,))
+        return json.loads(row[0]) if row else None
+
+    def put_job(self, message_id: int, data: Dict[str, Any]) -> None:
+        self._execute(self._PUT_JOB, self._job_row(message_id, data))
+
+    def delete_job(self, message_id: int) -> None:
+        self._execute("DELETE FROM jobs WHERE message_id = ?", (message_id,))
+
+    def iter_jobs(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        for message_id, data in self._fetchall("SELECT message_id, data FROM jobs"):
+            yield message_id, json.loads(data)
+
+    def prune_jobs(self, max_age: Optional[float] = None, per_user: Optional[int] = None) -> List[Tuple[int, Dict[str, Any]]]:
+        cutoff = time.time() - max_age if max_age else None
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                rows = self._conn.execute(
+                    "SELECT message_id, data FROM ("
+                    "  SELECT message_id, data, timestamp,"
+                    "         ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC) AS rank"
+                    "  FROM jobs"
+                    ") WHERE (?1 IS NOT NULL AND timestamp < ?1) OR (?2 IS NOT NULL AND rank > ?2)",
+                    (cutoff, per_user or None),
+                ).fetchall()
+                self._conn.executemany("DELETE FROM jobs WHERE message_id = ?", [(message_id,) for message_id, _ in rows])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [(message_id, json.loads(data)) for message_id, data in rows]
+
+    def get_error_messages(self) -> Dict[int, Set[int]]:
+        error_msgs: Dict[int, Set[int]] = {}
+        for chat_id, message_id in self._fetchall("SELECT chat_id, message_id FROM error_messages"):
+            error_msgs.setdefault(chat_id, set()).add(message_id)
+        return error_msgs
+
+    def add_error_message(self, chat_id: int, message_id: int) -> None:
+        self._execute(self._ADD_ERROR, (chat_id, message_id))
+
+    def remove_error_message(self, chat_id: int, message_id: int) -> None:
+        self._execute("DELETE FROM error_messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+
+    def replace_error_messages(self, error_msgs: Dict[int, Set[int]]) -> None:
+        rows = [(chat_id, mid) for chat_id, mids in error_msgs.items() for mid in mids]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM error_messages")
+                self._conn.executemany(self._ADD_ERROR, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def bulk_load(self, users: Iterator[Tuple[int, dict]], jobs: Iterator[Tuple[int, Dict[str, Any]]], error_msgs: Dict[int, Set[int]]) -> Tuple[int, int]:
+        """Inserta todo en una única transacción (usado por el migrador). Devuelve (usuarios, trabajos)."""
+        n_users = n_jobs = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for user_id, settings in users:
+                    self._conn.execute(self._PUT_USER, self._user_row(user_id, settings))
+                    n_users += 1
+                for message_id, data in jobs:
+                    self._conn.execute(self._PUT_JOB, self._job_row(message_id, data))
+                    n_jobs += 1
+                self._conn.executemany(
+                    self._ADD_ERROR,
+                    [(chat_id, mid) for chat_id, mids in error_msgs.items() for mid in mids],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return n_users, n_jobs
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+_backend: Optional[StorageBackend] = None
+
+def get_backend() -> StorageBackend:
+    """Motor configurado en STORAGE_BACKEND ("json" o "sqlite"), creado en el primer uso."""
+    global _backend
+    if _backend is None:
+        if STORAGE_BACKEND == "sqlite":
+            _backend = SqliteBackend(DATA_DIR / STORAGE_SQLITE_PATH)
+        elif STORAGE_BACKEND == "json":
+            _backend = JsonBackend(DATA_DIR)
+        else:
+            raise ValueError(f"STORAGE_BACKEND desconocido: {STORAGE_BACKEND!r}")
+    return _backend
@@ -0,0 +1,134 @@
+import json
+import logging
+import secrets
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from storage.durable import atomic_write
+
+SPILL_DIR = Path(__file__).resolve().parents[2] / "data" / "callbacks"
+
+class RequestStore:
+    """
+    Bounded store for the payloads referenced by inline-button ``callback_data``.
+
+    - Keys are 8 url-safe characters, so ``job:<action>:<key>`` stays far below
+      Telegram's 64-byte limit, and are checked against live keys on creation.
+    - At most ``max_entries`` payloads stay in memory; the least recently used one
+      is evicted first, to ``spill_dir`` as JSON when a spill directory is set.
+    - Entries (in memory or spilled) expire ``ttl`` seconds after they were stored.
+    """
+
+    def __init__(self, max_entries: int = 5000, ttl: float = 172800, spill_dir: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spilled = 0
+        self.spill_hits = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, payload: Any) -> str:
+        key = self._new_key()
+        self._entries[key] = (time.time(), payload)
+        while len(self._entries) > self.max_entries:
+            old_key, entry = self._entries.popitem(last=False)
+            self.evictions += 1
+            self._spill(old_key, entry)
+        self._puts += 1
+        if self.spill_dir and self._puts % self.max_entries == 0:
+            self.purge()
+        return key
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._unspill(key)
+            if entry is not None:
+                self.spill_hits += 1
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    old_key, old = self._entries.popitem(last=False)
+                    self.evictions += 1
+                    self._spill(old_key, old)
+        if entry is None:
+            self.misses += 1
+            return None
+        if time.time() - entry[0] >= self.ttl:
+            self._entries.pop(key, None)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def purge(self) -> int:
+        """Drop every expired entry, in memory and on disk. Returns how many were removed."""
+        cutoff = time.time() - self.ttl
+        expired = [k for k, (ts, _) in self._entries.items() if ts <= cutoff]
+        for k in expired:
+            del self._entries[k]
+        removed = len(expired)
+        if self.spill_dir:
+            for path in self.spill_dir.glob("*.json"):
+                try:
+                    if path.stat().st_mtime <= cutoff:
+                        path.unlink()
+                        removed += 1
+                except OSError:
+                    pass
+        self.expirations += removed
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "spilled": self.spilled,
+            "spill_hits": self.spill_hits,
+        }
+
+    def _new_key(self) -> str:
+        while True:
+            key = secrets.token_urlsafe(6)
+            if key not in self._entries and not (self.spill_dir and (self.spill_dir / f"{key}.json").exists()):
+                return key
+
+    def _spill(self, key: str, entry: Tuple[float, Any]) -> None:
+        if not self.spill_dir or time.time() - entry[0] >= self.ttl:
+            return
+        try:
+            # Only a cache: never leaving a half-written file is enough
+            atomic_write(self.spill_dir / f"{key}.json", json.dumps({"ts": entry[0], "payload": entry[1]}, ensure_ascii=False), policy="none")
+            self.spilled += 1
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning(f"Could not spill callback payload {key}: {e}")
+
+    def _unspill(self, key: str) -> Optional[Tuple[float, Any]]:
+        if not self.spill_dir:
+            return None
+        # Keys are generated url-safe tokens; anything else never hits the filesystem
+        if not key or not all(c.isalnum() or c in "-_" for c in key):
+            return None
+        path = self.spill_dir / f"{key}.json"
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            path.unlink()
+        except (OSError, ValueError):
+            return None
+        return data["ts"], data["payload"]
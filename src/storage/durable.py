@@ -0,0 +1,101 @@
+"""
+Escrituras atómicas para todo `storage/`: archivo temporal + fsync opcional + rename.
+
+Políticas de fsync (STORAGE_FSYNC):
+- "none": solo temporal + rename. Nunca quedan archivos a medias, pero un corte de
+  luz puede perder las últimas escrituras.
+- "file": fsync del temporal antes del rename; el contenido está en disco al volver.
+- "full": además fsync del directorio, para que el propio rename sobreviva a un corte.
+
+`write_many` hace group commit: escribe primero todos los temporales, después los
+sincroniza seguidos (el sistema de archivos puede agrupar sus escrituras en disco), los
+renombra y sincroniza cada directorio una sola vez.
+"""
+import os
+from pathlib import Path
+from typing import Iterable, Optional, Tuple, Union
+
+from config import STORAGE_FSYNC
+
+FSYNC_POLICIES = ("none", "file", "full")
+
+# Equivalente para las bases SQLite (PRAGMA synchronous; en WAL, NORMAL ya es consistente)
+SQLITE_SYNCHRONOUS = {"none": "OFF", "file": "NORMAL", "full": "FULL"}
+
+Data = Union[str, bytes]
+
+def _resolve(policy: Optional[str]) -> str:
+    policy = policy or STORAGE_FSYNC
+    if policy not in FSYNC_POLICIES:
+        raise ValueError(f"Política de fsync desconocida: {policy!r}")
+    return policy
+
+def _write_temp(path: Path, data: Data, sync: bool) -> Path:
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data.encode("utf-8") if isinstance(data, str) else data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    return tmp
+
+def fsync_dir(directory: Path) -> None:
+    # En Windows no se pueden abrir directorios; allí el rename ya es lo máximo posible
+    if os.name == "nt":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write(path: Path, data: Data, policy: Optional[str] = None) -> None:
+    """Sustituye `path` por `data` de forma atómica."""
+    policy = _resolve(policy)
+    path = Path(path)
+    tmp = _write_temp(path, data, policy != "none")
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    if policy == "full":
+        fsync_dir(path.parent)
+
+def _fsync_file(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_many(items: Iterable[Tuple[Path, Data]], policy: Optional[str] = None) -> int:
+    """Group commit de varios archivos. Devuelve cuántos se escribieron."""
+    policy = _resolve(policy)
+    staged = []
+    try:
+        for path, data in items:
+            path = Path(path)
+            staged.append((_write_temp(path, data, sync=False), path))
+        if policy != "none":
+            for tmp, _ in staged:
+                _fsync_file(tmp)
+    except BaseException:
+        for tmp, _ in staged:
+            tmp.unlink(missing_ok=True)
+        raise
+    for tmp, path in staged:
+        os.replace(tmp, path)
+    if policy == "full":
+        for directory in {path.parent for _, path in staged}:
+            fsync_dir(directory)
+    return len(staged)
+
+def append_line(path: Path, line: str, policy: Optional[str] = None) -> None:
+    """Añade una línea a un registro; con "file"/"full" la línea está en disco al volver."""
+    policy = _resolve(policy)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line if line.endswith("\n") else line + "\n")
+        if policy != "none":
+            f.flush()
+            os.fsync(f.fileno())
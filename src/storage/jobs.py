@@ -1,30 +1,62 @@
-import json
+import asyncio
+import logging
 import time
-from pathlib import Path
 from typing import Dict, Any, Optional
 
-JOBS_DIR = Path(__file__).resolve().parents[2] / "data" / "jobs"
-JOBS_DIR.mkdir(parents=True, exist_ok=True)
+from config import JOB_RETENTION_DAYS, JOB_RETENTION_PER_USER, JOB_REAPER_INTERVAL
+from storage.backend import get_backend
+from storage.originals import delete_original
 
 def get_job(message_id: int) -> Optional[Dict[str, Any]]:
     """Obtiene la información de un trabajo por message_id"""
-    job_file = JOBS_DIR / f"{message_id}.json"
-    if job_file.exists():
-        try:
-            return json.loads(job_file.read_text(encoding="utf-8"))
-        except Exception:
-            return None
-    return None
+    return get_backend().get_job(message_id)
 
 def save_job(message_id: int, data: Dict[str, Any]) -> None:
     """Guarda la información de un trabajo"""
-    job_file = JOBS_DIR / f"{message_id}.json"
     job_data = data.copy()
     job_data["timestamp"] = time.time()
-    job_file.write_text(json.dumps(job_data, ensure_ascii=False, indent=2), encoding="utf-8")
+    get_backend().put_job(message_id, job_data)
 
 def delete_job(message_id: int) -> None:
     """Elimina la información de un trabajo"""
-    job_file = JOBS_DIR / f"{message_id}.json"
-    if job_file.exists():
-        job_file.unlink()
\ No newline at end of file
+    get_backend().delete_job(message_id)
+
+def prune_jobs(max_age_days: Optional[float] = JOB_RETENTION_DAYS, per_user: Optional[int] = JOB_RETENTION_PER_USER) -> int:
+    """Aplica la retención al historial y borra los PNG originales asociados. Devuelve cuántos trabajos se eliminaron"""
+    removed = get_backend().prune_jobs(max_age=max_age_days * 86400 if max_age_days else None, per_user=per_user)
+    for _, data in removed:
+        if data.get("original"):
+            delete_original(data["original"])
+    return len(removed)
+
+class JobReaper:
+    """Tarea de fondo que aplica la retención del historial de trabajos cada `interval` segundos."""
+    def __init__(self, interval: float = JOB_REAPER_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                # Fuera del event loop: la primera pasada puede recorrer todo data/jobs
+                removed = await asyncio.to_thread(prune_jobs)
+                if removed:
+                    logging.info(f"🧹 Historial de trabajos: {removed} trabajos eliminados por retención")
+            except Exception as e:
+                logging.error(f"Error aplicando la retención de trabajos: {e}")
+            await asyncio.sleep(self.interval)
+
+job_reaper = JobReaper()
@@ -0,0 +1,43 @@
+"""
+Migración única del árbol JSON de `data/` a la base SQLite.
+
+Uso (desde src/):  python -m storage.migrate [--db RUTA]
+
+Los archivos JSON no se tocan; después basta con poner STORAGE_BACKEND = "sqlite".
+Volver a ejecutarla es seguro: los registros existentes se reemplazan.
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+
+from config import STORAGE_SQLITE_PATH
+from storage.backend import DATA_DIR, JsonBackend, SqliteBackend
+
+def migrate(source: JsonBackend, target: SqliteBackend) -> dict:
+    start = time.perf_counter()
+    error_msgs = source.get_error_messages()
+    n_users, n_jobs = target.bulk_load(source.iter_users(), source.iter_jobs(), error_msgs)
+    return {
+        "users": n_users,
+        "jobs": n_jobs,
+        "error_messages": sum(len(v) for v in error_msgs.values()),
+        "seconds": round(time.perf_counter() - start, 2),
+    }
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Migra data/ (JSON) a SQLite")
+    parser.add_argument("--data", type=Path, default=DATA_DIR, help="directorio data/ de origen")
+    parser.add_argument("--db", type=Path, default=DATA_DIR / STORAGE_SQLITE_PATH, help="base SQLite de destino")
+    args = parser.parse_args()
+
+    target = SqliteBackend(args.db)
+    try:
+        stats = migrate(JsonBackend(args.data), target)
+    finally:
+        target.close()
+    logging.info(f"✅ Migración completada en {stats['seconds']}s: {stats['users']} usuarios, {stats['jobs']} trabajos, {stats['error_messages']} mensajes de error -> {args.db}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from storage.durable import atomic_write
+
+ORIGINALS_DIR = Path(__file__).resolve().parents[2] / "data" / "originals"
+ORIGINALS_DIR.mkdir(parents=True, exist_ok=True)
+
+def save_original(data: bytes) -> str:
+    """Guarda el PNG sin pérdida y devuelve su clave"""
+    key = uuid.uuid4().hex
+    atomic_write(ORIGINALS_DIR / f"{key}.png", data)
+    return key
+
+def load_original(key: str) -> Optional[bytes]:
+    """Obtiene el PNG original por clave"""
+    path = ORIGINALS_DIR / f"{Path(key).name}.png"
+    if path.exists():
+        return path.read_bytes()
+    return None
+
+def delete_original(key: str) -> None:
+    """Elimina el PNG original"""
+    path = ORIGINALS_DIR / f"{Path(key).name}.png"
+    if path.exists():
+        path.unlink()
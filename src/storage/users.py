@@ -1,8 +1,12 @@
-import json
-from pathlib import Path
+import asyncio
+import atexit
+import copy
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Set
 
-USER_DATA_DIR = Path(__file__).resolve().parents[2] / "data" / "users"
-USER_DATA_DIR.mkdir(parents=True, exist_ok=True)
+from config import USER_SETTINGS_CACHE_SIZE, USER_SETTINGS_FLUSH_DELAY
+from storage.backend import get_backend
 
 DEFAULT_SETTINGS = {
     "sampler_name": "LCM",
@@ -16,6 +20,8 @@ DEFAULT_SETTINGS = {
     "pre_value": "",
     "post_mode": "none",
     "post_value": "",
+    "pre_modifiers": [],
+    "post_modifiers": [],
     "loras": [],
     "selected_model": None,  # Modelo seleccionado por el usuario
     "auto_mode": False,      # Generación automática activada/desactivada
@@ -35,15 +41,84 @@ PRESETS_POST = [
     "highly detailed background",
 ]
 
-def load_user_settings(user_id: int) -> dict:
-    fp = USER_DATA_DIR / f"{user_id}.json"
-    if fp.exists():
+class _SettingsCache:
+    """
+    Caché write-behind de ajustes: las lecturas salen de memoria y las escrituras
+    marcan al usuario como sucio y programan un único volcado diferido que guarda
+    todos los pendientes de una vez. Los usuarios sucios nunca se expulsan.
+    """
+    def __init__(self, max_entries: int, flush_delay: float):
+        self.max_entries = max_entries
+        self.flush_delay = flush_delay
+        # None = el usuario no tiene ajustes guardados (evita volver a leer el disco)
+        self._entries: "OrderedDict[int, Optional[dict]]" = OrderedDict()
+        self._dirty: Set[int] = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def get(self, user_id: int) -> Optional[dict]:
+        if user_id in self._entries:
+            self._entries.move_to_end(user_id)
+            return self._entries[user_id]
+        settings = get_backend().get_user(user_id)
+        self._entries[user_id] = settings
+        self._evict()
+        return settings
+
+    def put(self, user_id: int, settings: dict) -> None:
+        self._entries[user_id] = settings
+        self._entries.move_to_end(user_id)
+        self._dirty.add(user_id)
+        self._evict()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Sin event loop (scripts, migraciones): escritura inmediata
+            self.flush()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_delay, self.flush)
+
+    def flush(self) -> int:
+        """Guarda todos los usuarios sucios. Devuelve cuántos se escribieron."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return 0
+        pending: Dict[int, dict] = {uid: self._entries[uid] for uid in self._dirty}
+        self._dirty.clear()
         try:
-            return json.loads(fp.read_text(encoding="utf-8"))
-        except Exception:
-            return DEFAULT_SETTINGS.copy()
-    return DEFAULT_SETTINGS.copy()
+            get_backend().put_users(pending)
+        except Exception as e:
+            logging.error(f"Error guardando ajustes de {len(pending)} usuarios: {e}")
+            # Se reintentan en el próximo volcado
+            self._dirty.update(pending)
+            return 0
+        return len(pending)
+
+    def _evict(self) -> None:
+        if len(self._entries) <= self.max_entries:
+            return
+        for uid in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if uid not in self._dirty:
+                del self._entries[uid]
+
+_cache = _SettingsCache(USER_SETTINGS_CACHE_SIZE, USER_SETTINGS_FLUSH_DELAY)
+# Red de seguridad si el proceso sale sin pasar por el apagado normal (p. ej. SIGTERM)
+atexit.register(_cache.flush)
+
+def load_user_settings(user_id: int) -> dict:
+    settings = _cache.get(user_id)
+    if settings is None:
+        return copy.deepcopy(DEFAULT_SETTINGS)
+    # Copia: quien llama puede modificar el dict sin llegar a guardarlo
+    return copy.deepcopy(settings)
 
 def save_user_settings(user_id: int, settings: dict) -> None:
-    fp = USER_DATA_DIR / f"{user_id}.json"
-    fp.write_text(json.dumps(settings, ensure_ascii=False), encoding="utf-8")
\ No newline at end of file
+    _cache.put(user_id, copy.deepcopy(settings))
+
+def flush_user_settings() -> int:
+    """Vuelca ya los ajustes pendientes (llamar al apagar el bot)."""
+    return _cache.flush()
@@ -69,7 +69,7 @@ def models_page_keyboard(models: list, current_model: str, page: int = 0) -> Inl
     if nav:
         kb.append(nav)
 
-    kb.append([InlineKeyboardButton("⬅️ Atrás", callback_data="menu:main")])
+    kb.append([InlineKeyboardButton("🔄 Actualizar", callback_data="menu:refresh:model"), InlineKeyboardButton("⬅️ Atrás", callback_data="menu:main")])
     return InlineKeyboardMarkup(kb)
 
 def loras_page_keyboard(loras: list[str], selected: set[str], page: int) -> InlineKeyboardMarkup:
@@ -87,6 +87,7 @@ def loras_page_keyboard(loras: list[str], selected: set[str], page: int) -> Inli
         nav.append(InlineKeyboardButton("Next", callback_data=f"loras:page:{page+1}"))
     if nav:
         rows.append(nav)
+    rows.append([InlineKeyboardButton("🔄 Actualizar", callback_data="menu:refresh:loras")])
     rows.append([InlineKeyboardButton("Volver", callback_data="menu:main"), InlineKeyboardButton("Cerrar", callback_data="menu:close")])
     return InlineKeyboardMarkup(rows)
 
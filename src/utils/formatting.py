@@ -48,13 +48,58 @@ def escape_html_entities(text: str) -> str:
     """Escape HTML entities in text"""
     return html_escape(text)
 
-def format_queue_status(position: int, total: int, prompt: str) -> str:
+def format_wait(seconds: float) -> str:
+    """Duración aproximada legible ("~40 s", "~3 min")"""
+    if seconds < 60:
+        return f"~{max(1, int(round(seconds)))} s"
+    return f"~{int(round(seconds / 60))} min"
+
+def format_queue_status(position: int, total: int, prompt: str, eta: Optional[float] = None) -> str:
     """Format queue status message with emojis"""
     status_emoji = "🔄" if position > 1 else "⚙️"
+    eta_line = f"{FormatText.bold('Espera estimada:')} {format_wait(eta)}\n" if eta else ""
     return (
         f"{FormatText.bold(FormatText.emoji('Solicitud en cola', status_emoji))}\n"
         f"{FormatText.bold('Posición:')} {position} de {total}\n"
-        f"{FormatText.bold('Prompt:')} {FormatText.code(escape_html_entities(prompt[:100]) + '...' if len(prompt) > 100 else prompt)}"
+        f"{eta_line}"
+        f"{FormatText.bold('Prompt:')} {FormatText.code(prompt[:100] + '...' if len(prompt) > 100 else prompt)}"
+    )
+
+def describe_queue_rejection(reason: str, eta: float, retry_after: float) -> str:
+    """Texto plano del rechazo de admisión (sirve también para alertas de botones)"""
+    if reason == "user_cap":
+        return "Ya tienes el máximo de solicitudes en cola. Espera a que termine alguna."
+    if reason == "rate":
+        return f"Vas demasiado rápido. Podrás enviar otra solicitud en {format_wait(retry_after)}."
+    if reason == "wait":
+        return f"Hay mucha demanda: la espera estimada es de {format_wait(eta)}. Inténtalo de nuevo en {format_wait(retry_after)}."
+    return f"La cola está llena. Inténtalo de nuevo en {format_wait(retry_after)}."
+
+def format_queue_rejected(reason: str, eta: float, retry_after: float) -> str:
+    """Format admission rejection message"""
+    return (
+        f"{FormatText.bold(FormatText.emoji('Solicitud no aceptada', '⏳'))}\n"
+        f"{escape_html_entities(describe_queue_rejection(reason, eta, retry_after))}"
+    )
+
+def format_queue_stats(stats: dict) -> str:
+    """Format /status message (JobQueue.stats())"""
+    requests = stats["requests"]
+    backends = "".join(
+        f"• {escape_html_entities(b['name'])}: "
+        + (f"{b['active']}/{b['concurrency']} ocupado, modelo {FormatText.code(b['model'] or '?')}" if b["healthy"] else "caído")
+        + "\n"
+        for b in stats["backends"]
+    )
+    return (
+        f"{FormatText.bold(FormatText.emoji('Estado de la cola', '📊'))}\n"
+        f"{FormatText.bold('En cola:')} {stats['pending']} trabajos\n"
+        f"{FormatText.bold('Generando:')} {stats['in_flight_images']} imágenes\n"
+        f"{FormatText.bold('Cambios de modelo:')} {stats['model_swaps']} (evitados: {stats['model_swaps_skipped']})\n"
+        f"{FormatText.bold('Servidores:')}\n{backends}"
+        f"{FormatText.bold('Reintentos en otro servidor:')} {stats['failovers']}\n"
+        f"{FormatText.bold('Botones:')} {requests['size']} en memoria, {requests['hits']} aciertos, "
+        f"{requests['misses']} fallos, {requests['spilled']} volcados a disco ({requests['spill_hits']} recuperados)"
     )
 
 def format_generation_complete(prompt: str, seed: int, settings: dict) -> str:
@@ -80,6 +125,7 @@ def format_welcome_message() -> str:
         f"{FormatText.bold('Comandos disponibles:')}\n"
         f"• {FormatText.code('/start')} - Mostrar este mensaje\n"
         f"• {FormatText.code('/settings')} - Configurar opciones de generación\n"
+        f"• {FormatText.code('/status')} - Ver el estado de la cola\n"
         f"• {FormatText.code('/txt2img <prompt>')} - Generar imagen con prompt\n"
         f"• {FormatText.code('<prompt>')} - Generar imagen directamente\n\n"
         f"{FormatText.bold('Características:')}\n"
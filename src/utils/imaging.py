@@ -0,0 +1,47 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow es opcional: sin él solo se puede entregar el PNG original
+    Image = None
+
+PREVIEW_CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+def previews_available() -> bool:
+    return Image is not None
+
+def _get_executor(workers: int) -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preview")
+    return _executor
+
+def encode_preview(png_bytes: bytes, fmt: str = "JPEG", quality: int = 85, max_side: int = 1280) -> bytes:
+    """Recomprime un PNG a JPEG/WebP reduciéndolo a `max_side` px en su lado mayor."""
+    with Image.open(BytesIO(png_bytes)) as img:
+        img = img.convert("RGB")
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = BytesIO()
+        img.save(out, format=fmt, quality=quality, optimize=True)
+        return out.getvalue()
+
+async def encode_preview_async(png_bytes: bytes, fmt: str = "JPEG", quality: int = 85, max_side: int = 1280, workers: int = 2) -> Optional[bytes]:
+    """
+    Codifica la vista previa en un pool de hilos para no bloquear el event loop.
+    Devuelve None si Pillow no está instalado o la imagen no se puede decodificar.
+    """
+    if Image is None:
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_executor(workers), encode_preview, png_bytes, fmt, quality, max_side)
+    except Exception as e:
+        logging.warning(f"No se pudo generar la vista previa comprimida: {e}")
+        return None
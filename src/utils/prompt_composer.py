@@ -0,0 +1,219 @@
+"""
+Composición del prompt final en etapas: usuario -> modificadores -> preset -> LoRA.
+
+El texto se parte en tags una sola vez (con caché por texto, así los pre/post prompts
+de cada preset y los modificadores habituales se analizan una vez) y los duplicados se
+descartan con búsquedas en un set de tags normalizados en lugar de buscar subcadenas.
+
+El prompt se compone una vez al crear el trabajo (`prompt_composer`, sin preset) y se
+guarda así; al generar solo se añade el preset del modelo cargado (`preset_composer`).
+Volver a componer un prompt ya compuesto no repite tags.
+"""
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+# Agrupan tags con comas dentro: (a, b), [a, b], {a|b, c}. "<" no cuenta: las LoRA no
+# llevan comas y el texto libre puede tener "<3" sueltos
+_OPEN = "([{"
+_GROUPING = re.compile(r"[()\[\]{}]")
+_NESTING = re.compile(r"[(\[{]")
+# Caracteres que obligan a analizar tag por tag (paréntesis, pesos o <lora:...>)
+_BRACKETS = re.compile(r"[()\[\]{}<>]")
+_WEIGHTED = re.compile(r"^[(\[]+(.*?)(?::\s*[\d.]+)?[)\]]+$")
+_LORA = re.compile(r"^<lora:([^:>]+)(?::[^>]*)?>$")
+
+@lru_cache(maxsize=16384)
+def normalize_tag(tag: str) -> str:
+    """Minúsculas, espacios colapsados y sin paréntesis/peso de énfasis: "(Best  Quality:1.2)" -> "best quality"."""
+    text = " ".join(tag.lower().split())
+    first = text[:1]
+    if first == "<":
+        lora = _LORA.match(text)
+        if lora:
+            # La misma LoRA con otro peso cuenta como duplicada
+            return f"<lora:{lora.group(1)}>"
+    elif first in "([":
+        weighted = _WEIGHTED.match(text)
+        if weighted:
+            text = weighted.group(1).strip()
+    return text
+
+class TagList(NamedTuple):
+    """Tags de un texto ya analizados: los normales y las LoRA por separado."""
+    tags: Tuple[str, ...]
+    norms: Tuple[str, ...]
+    norm_set: FrozenSet[str]
+    loras: Tuple[str, ...]
+    lora_norms: Tuple[str, ...]
+
+def split_tags(text: str) -> List[str]:
+    """
+    Parte `text` por las comas de primer nivel: las de dentro de (), [] o {} no separan,
+    así "(4k, 8k)" o un bloque {a, b|c} siguen siendo un único tag. Si los paréntesis no
+    cuadran (un ":(" suelto) se parte por todas las comas.
+    """
+    if "," not in text or not _NESTING.search(text):
+        return [t for t in map(str.strip, text.split(",")) if t]
+    # Solo se recorren los paréntesis: las comas de dentro de cada grupo de primer
+    # nivel se marcan para que el split normal no corte por ellas
+    out, depth, start = [], 0, 0
+    for m in _GROUPING.finditer(text):
+        if m.group() in _OPEN:
+            if not depth:
+                out.append(text[start:m.start()])
+                start = m.start()
+            depth += 1
+        elif depth:
+            depth -= 1
+            if not depth:
+                out.append(text[start:m.end()].replace(",", "\0"))
+                start = m.end()
+    if depth:
+        return [t for t in map(str.strip, text.split(",")) if t]
+    out.append(text[start:])
+    return [t.replace("\0", ",") if "\0" in t else t for t in map(str.strip, "".join(out).split(",")) if t]
+
+@lru_cache(maxsize=4096)
+def parse_tags(text: str) -> TagList:
+    """Analiza un texto una sola vez; los pre/post prompts y modificadores se repiten mucho."""
+    if not text:
+        return _EMPTY
+    if not _BRACKETS.search(text):
+        # Camino rápido: sin paréntesis ni LoRA basta con partir y normalizar espacios
+        tags = [t.strip() for t in text.split(",")]
+        norms = [" ".join(t.split()) for t in text.lower().split(",")]
+        if "" in norms:
+            tags = [t for t in tags if t]
+            norms = [n for n in norms if n]
+        return TagList(tuple(tags), tuple(norms), frozenset(norms), (), ())
+    tags = split_tags(text)
+    norms = [normalize_tag(t) if t[0] in "<([" else " ".join(t.lower().split()) for t in tags]
+    loras, lora_norms = (), ()
+    if "<lora:" in text.lower():
+        is_lora = [n.startswith("<lora:") for n in norms]
+        loras = tuple(t for t, lora in zip(tags, is_lora) if lora)
+        lora_norms = tuple(n for n, lora in zip(norms, is_lora) if lora)
+        tags = [t for t, lora in zip(tags, is_lora) if not lora]
+        norms = [n for n, lora in zip(norms, is_lora) if not lora]
+    return TagList(tuple(tags), tuple(norms), frozenset(norms), loras, lora_norms)
+
+_EMPTY = TagList((), (), frozenset(), (), ())
+
+@dataclass
+class PromptDraft:
+    """Prompt a medio componer: secciones en orden y tags ya presentes."""
+    pre: List[str] = field(default_factory=list)
+    body: List[str] = field(default_factory=list)
+    post: List[str] = field(default_factory=list)
+    tail: List[str] = field(default_factory=list)  # LoRA, siempre al final
+    seen: Set[str] = field(default_factory=set)
+    norms: Dict[str, str] = field(default_factory=dict)  # tag -> forma normalizada
+
+    def add_body(self, parsed: TagList) -> None:
+        """Tags que se conservan tal cual, sin filtrar (el prompt del usuario)."""
+        self.body.extend(parsed.tags)
+        self.seen.update(parsed.norm_set)
+        self.norms.update(zip(parsed.tags, parsed.norms))
+
+    def fresh(self, parsed: TagList) -> List[str]:
+        """Tags normales de `parsed` que aún no están en el prompt (y los marca como presentes)."""
+        self.norms.update(zip(parsed.tags, parsed.norms))
+        if self.seen.isdisjoint(parsed.norm_set) and len(parsed.norm_set) == len(parsed.norms):
+            self.seen.update(parsed.norm_set)
+            return list(parsed.tags)
+        out = []
+        for tag, norm in zip(parsed.tags, parsed.norms):
+            if norm not in self.seen:
+                self.seen.add(norm)
+                out.append(tag)
+        return out
+
+    def add_loras(self, parsed: TagList) -> None:
+        for tag, norm in zip(parsed.loras, parsed.lora_norms):
+            if norm not in self.seen:
+                self.seen.add(norm)
+                self.norms[tag] = norm
+                self.tail.append(tag)
+
+    def render(self) -> str:
+        return ", ".join(self.pre + self.body + self.post + self.tail)
+
+    def tag_list(self) -> Optional[TagList]:
+        """El resultado ya analizado, o None si alguna etapa añadió texto sin pasar por fresh()."""
+        tags = tuple(self.pre + self.body + self.post)
+        try:
+            norms = tuple(self.norms[t] for t in tags)
+            lora_norms = tuple(self.norms[t] for t in self.tail)
+        except KeyError:
+            return None
+        return TagList(tags, norms, frozenset(norms), tuple(self.tail), lora_norms)
+
+# Prompts compuestos recientes ya analizados: el trabajo vuelve a pasar su prompt por
+# preset_composer al generar y así no se parte otra vez
+_COMPOSED: "OrderedDict[str, TagList]" = OrderedDict()
+_COMPOSED_MAX = 1024
+
+def composed_tags(text: str) -> TagList:
+    """TagList de `text`, reutilizando el análisis si salió de PromptComposer.compose."""
+    return _COMPOSED.get(text) or parse_tags(text)
+
+# Una etapa recibe el borrador, el prompt del usuario, sus ajustes y el preset (o None)
+Stage = Callable[[PromptDraft, str, dict, Optional[object]], None]
+
+def user_stage(draft: PromptDraft, prompt: str, settings: dict, preset) -> None:
+    """El prompt del usuario se conserva tal cual (incluidas sus repeticiones); sus LoRA van al final."""
+    parsed = composed_tags(prompt)
+    draft.add_body(parsed)
+    draft.add_loras(parsed)
+
+def modifiers_stage(draft: PromptDraft, prompt: str, settings: dict, preset) -> None:
+    """pre_modifiers / post_modifiers de los ajustes del usuario."""
+    pre = settings.get("pre_modifiers")
+    if pre:
+        draft.pre.extend(draft.fresh(parse_tags(", ".join(pre))))
+    post = settings.get("post_modifiers")
+    if post:
+        draft.post.extend(draft.fresh(parse_tags(", ".join(post))))
+
+def preset_stage(draft: PromptDraft, prompt: str, settings: dict, preset) -> None:
+    """pre_prompt / post_prompt del preset del modelo, sin los tags que ya estén."""
+    if preset is None:
+        return
+    if preset.pre_prompt:
+        draft.pre[:0] = draft.fresh(parse_tags(preset.pre_prompt))
+    if preset.post_prompt:
+        draft.post.extend(draft.fresh(parse_tags(preset.post_prompt)))
+
+def lora_stage(draft: PromptDraft, prompt: str, settings: dict, preset) -> None:
+    """LoRA elegidas en los ajustes, detrás de las que ya traiga el prompt."""
+    loras = settings.get("loras")
+    if loras:
+        draft.add_loras(parse_tags(", ".join(f"<lora:{name}:1>" for name in loras)))
+
+DEFAULT_STAGES: Tuple[Stage, ...] = (user_stage, modifiers_stage, preset_stage, lora_stage)
+# Para un prompt ya compuesto: solo el preset (las LoRA que traiga siguen al final)
+PRESET_STAGES: Tuple[Stage, ...] = (user_stage, preset_stage)
+
+class PromptComposer:
+    """Ejecuta las etapas en orden sobre un PromptDraft y devuelve el prompt final."""
+    def __init__(self, stages: Sequence[Stage] = DEFAULT_STAGES):
+        self.stages = tuple(stages)
+
+    def compose(self, prompt: str, settings: Optional[dict] = None, preset=None) -> str:
+        draft = PromptDraft()
+        settings = settings or {}
+        for stage in self.stages:
+            stage(draft, prompt, settings, preset)
+        text = draft.render()
+        parsed = draft.tag_list()
+        if parsed is not None:
+            _COMPOSED[text] = parsed
+            if len(_COMPOSED) > _COMPOSED_MAX:
+                _COMPOSED.popitem(last=False)
+        return text
+
+prompt_composer = PromptComposer()
+preset_composer = PromptComposer(PRESET_STAGES)
@@ -1,92 +1,220 @@
+import logging
+import os
 import random
 import re
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from config import RESOURCES_DIR, RESOURCE_RELOAD_INTERVAL, RESOURCE_CHAT_PACKS
+
+# Estrategia de muestreo: recibe las opciones de un recurso y el RNG, devuelve las que
+# van al bloque {a|b|c} de A1111
+Sampler = Callable[[Tuple[str, ...], random.Random], Sequence[str]]
+
+def sample_subset(max_choices: int = 33) -> Sampler:
+    """Hasta `max_choices` opciones al azar por aparición (evita prompts enormes)."""
+    def _sample(values: Tuple[str, ...], rng: random.Random) -> Sequence[str]:
+        if len(values) > max_choices:
+            return rng.sample(values, max_choices)
+        return values
+    return _sample
+
+def all_values(values: Tuple[str, ...], rng: random.Random) -> Sequence[str]:
+    """Todas las opciones del recurso; A1111 elige una."""
+    return values
+
+_RNG = random.Random()
+
+# Plantilla compilada: literales en posiciones pares y claves de recurso en las impares
+Compiled = Tuple[str, ...]
+
+# Claves con valores incorporados aunque falte su archivo
+_DEFAULT_VALUES = {
+    "r_color": ["vibrant", "pastel", "monochrome", "colorful", "muted"],
+    "r_artist": ["artgerm", "greg rutkowski", "makoto shinkai", "studio ghibli"],
+    "r_place": ["forest", "city", "beach", "mountain", "space"],
+    "r_style": ["realistic", "anime", "cartoon", "painting", "digital art"],
+    "r_action": ["standing", "sitting", "running", "jumping", "dancing"],
+    "r_object": ["sword", "book", "flower", "crown", "wand"],
+    "f_anime": ["cute", "beautiful", "kawaii", "moe", "elegant"],
+    "m_anime": ["handsome", "cool", "strong", "mysterious", "brave"],
+    "r_light": ["soft lighting", "dramatic lighting", "golden hour", "neon lights"],
+    "r_angle": ["front view", "side view", "back view", "aerial view", "close-up"],
+}
+
+_PACK_NAME = re.compile(r"^[\w-]+$")
+
+# Firma de los archivos de un conjunto: (ruta, mtime_ns, tamaño) de cada .txt
+Signature = Tuple[Tuple[str, int, int], ...]
+
+class _ResourceSet:
+    """
+    Instantánea inmutable de un conjunto de recursos con su regex y sus cachés.
+    Al recargar se construye otra y se sustituye la referencia, así un prompt en
+    curso termina con la que empezó.
+    """
+    __slots__ = ("replacements", "pattern", "compile", "full_blocks", "signature")
+
+    def __init__(self, replacements: Dict[str, Tuple[str, ...]], signature: Signature, cache_size: int):
+        self.replacements = replacements
+        self.signature = signature
+        self.pattern = re.compile(r"\b(" + "|".join(re.escape(k) for k in sorted(replacements, key=len, reverse=True)) + r")\b") if replacements else None
+        self.compile = lru_cache(maxsize=cache_size)(self._compile_template)
+        self.full_blocks: Dict[str, str] = {}
+
+    def _compile_template(self, template: str) -> Compiled:
+        if self.pattern is None:
+            return (template,)
+        # re.split con un grupo deja las claves en las posiciones impares
+        return tuple(self.pattern.split(template))
 
 class PromptGenerator:
-    """Advanced prompt generator with resource files and templates"""
+    """
+    Advanced prompt generator with resource files and templates.
+
+    Cada `*.txt` de `resources_dir` es una clave (el nombre sin extensión). Un pack
+    (`resources_dir/packs/<nombre>/*.txt`) añade o sustituye claves para un chat o
+    preset. Los conjuntos se cargan a demanda como tuplas sin duplicados con un único
+    regex precompilado, y cada plantilla se compila a segmentos (con caché). Como mucho
+    cada `reload_interval` segundos se comparan los mtimes y, si cambiaron, se recarga
+    y se sustituye el conjunto entero sin reiniciar el bot.
+    """
     
-    def __init__(self, resources_dir: str = "resources"):
+    def __init__(self, resources_dir: str = "resources", sampler: Optional[Sampler] = None, template_cache_size: int = 1024, reload_interval: float = 2.0):
         self.resources_dir = Path(resources_dir)
-        self.replacements = self._load_resources()
+        self.sampler: Sampler = sampler or sample_subset(33)
+        self.template_cache_size = template_cache_size
+        self.reload_interval = reload_interval
+        self._sets: Dict[Optional[str], _ResourceSet] = {}
+        self._checked: Dict[Optional[str], float] = {}
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    @property
+    def replacements(self) -> Dict[str, Tuple[str, ...]]:
+        """Recursos del conjunto base."""
+        return self._resource_set(None).replacements
+
+    def _dirs(self, pack: Optional[str]) -> List[Path]:
+        dirs = [self.resources_dir]
+        if pack:
+            dirs.append(self.resources_dir / "packs" / pack)
+        return dirs
+
+    @staticmethod
+    def _signature(dirs: List[Path]) -> Signature:
+        entries = []
+        for directory in dirs:
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.name.endswith(".txt") and not entry.name.startswith(("_", ".")) and entry.is_file():
+                            st = entry.stat()
+                            entries.append((entry.path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                continue
+        return tuple(sorted(entries))
+
+    def _resource_set(self, pack: Optional[str]) -> _ResourceSet:
+        current = self._sets.get(pack)
+        now = time.monotonic()
+        if current is not None and now - self._checked.get(pack, 0.0) < self.reload_interval:
+            return current
+        # Solo un hilo recarga; los demás siguen con el conjunto vigente
+        if not self._lock.acquire(blocking=current is None):
+            return current
+        try:
+            current = self._sets.get(pack)
+            self._checked[pack] = now
+            dirs = self._dirs(pack)
+            signature = self._signature(dirs)
+            if current is None or signature != current.signature:
+                replacements = self._load_resources(dirs)
+                self._sets[pack] = current = _ResourceSet(replacements, signature, self.template_cache_size)
+                self.reloads += 1
+                logging.info(f"Recursos de prompts cargados{f' (pack {pack})' if pack else ''}: {len(replacements)} claves")
+            return current
+        finally:
+            self._lock.release()
     
-    def _load_resources(self) -> Dict[str, List[str]]:
-        """Load resource files for prompt generation"""
-        replacements = {}
-        resource_files = {
-            "r_color": "r_color.txt",
-            "r_artist": "r_artist.txt", 
-            "r_place": "r_place.txt",
-            "r_style": "r_style.txt",
-            "r_action": "r_action.txt",
-            "r_object": "r_object.txt",
-            "f_anime": "f_anime.txt",
-            "m_anime": "m_anime.txt",
-            "r_light": "r_light.txt",
-            "r_angle": "r_angle.txt",
-        }
-        
-        for key, filename in resource_files.items():
-            file_path = self.resources_dir / filename
-            if file_path.exists():
+    def _load_resources(self, dirs: Optional[List[Path]] = None) -> Dict[str, Tuple[str, ...]]:
+        """Load resource files for prompt generation (later directories override earlier ones)"""
+        replacements = {key: self._get_default_values(key) for key in _DEFAULT_VALUES}
+        for directory in dirs or [self.resources_dir]:
+            if not directory.is_dir():
+                continue
+            for file_path in sorted(directory.glob("*.txt")):
+                key = file_path.stem
+                if key.startswith(("_", ".")):
+                    continue  # borradores o archivos ocultos
                 try:
                     with open(file_path, "r", encoding="utf-8-sig") as f:
                         # Use dict.fromkeys to remove duplicates while preserving order
                         lines = [line.strip() for line in f if line.strip()]
-                        replacements[key] = list(dict.fromkeys(lines))
+                        replacements[key] = tuple(dict.fromkeys(lines)) or (f"!{key.upper()}!",)
                 except Exception:
-                    replacements[key] = [f"!{key.upper()}!"]
-            else:
-                # Default values if file doesn't exist
-                replacements[key] = self._get_default_values(key)
-        
+                    replacements[key] = (f"!{key.upper()}!",)
         return replacements
     
-    def _get_default_values(self, key: str) -> List[str]:
+    def _get_default_values(self, key: str) -> Tuple[str, ...]:
         """Get default values for resource keys"""
-        defaults = {
-            "r_color": ["vibrant", "pastel", "monochrome", "colorful", "muted"],
-            "r_artist": ["artgerm", "greg rutkowski", "makoto shinkai", "studio ghibli"],
-            "r_place": ["forest", "city", "beach", "mountain", "space"],
-            "r_style": ["realistic", "anime", "cartoon", "painting", "digital art"],
-            "r_action": ["standing", "sitting", "running", "jumping", "dancing"],
-            "r_object": ["sword", "book", "flower", "crown", "wand"],
-            "f_anime": ["cute", "beautiful", "kawaii", "moe", "elegant"],
-            "m_anime": ["handsome", "cool", "strong", "mysterious", "brave"],
-            "r_light": ["soft lighting", "dramatic lighting", "golden hour", "neon lights"],
-            "r_angle": ["front view", "side view", "back view", "aerial view", "close-up"],
-        }
-        return list(dict.fromkeys(defaults.get(key, [f"!{key.upper()}!"])))
+        return tuple(dict.fromkeys(_DEFAULT_VALUES.get(key, [f"!{key.upper()}!"])))
+    
+    def _render(self, rs: _ResourceSet, key: str, rng: random.Random) -> str:
+        values = rs.replacements.get(key) or (f"!{key.upper()}!",)
+        chosen = self.sampler(values, rng)
+        if chosen is values:
+            # Lista completa: el bloque se construye una sola vez por recurso
+            block = rs.full_blocks.get(key)
+            if block is None:
+                block = rs.full_blocks[key] = "{" + "|".join(values) + "}"
+            return block
+        # Create A1111 choice format: {option1|option2|option3}
+        return "{" + "|".join(chosen) + "}"
+    
+    def _parts(self, template: str, pack: Optional[str]) -> Tuple[_ResourceSet, Compiled]:
+        if pack and not _PACK_NAME.match(pack):
+            logging.warning(f"Nombre de pack de recursos no válido: {pack!r}")
+            pack = None
+        rs = self._resource_set(pack)
+        return rs, rs.compile(template)
+    
+    def has_keys(self, template: str, pack: Optional[str] = None) -> bool:
+        """True si la plantilla contiene alguna clave de recurso."""
+        return bool(template) and len(self._parts(template, pack)[1]) > 1
     
-    def generate(self, template: str) -> str:
+    def generate(self, template: str, rng: Optional[random.Random] = None, pack: Optional[str] = None) -> str:
         """Generate enhanced prompt from template using A1111 choice syntax"""
         if not template:
             return template
-            
-        # Pattern to match resource keys
-        pattern = re.compile(r"\b(r_color|r_artist|r_place|r_style|r_action|r_object|f_anime|m_anime|r_light|r_angle)\b")
-        
-        def replace_match(match):
-            key = match.group(1)
-            values = self.replacements.get(key, [f"!{key.upper()}!"])
-            
-            # Deduplicate values while preserving order
-            unique_values = list(dict.fromkeys(values))
-            
-            # Randomly select up to 5 values to avoid extremely long prompts
-            max_choices = 33
-            if len(unique_values) > max_choices:
-                selected_values = random.sample(unique_values, max_choices)
-            else:
-                selected_values = unique_values
-            
-            # Create A1111 choice format: {option1|option2|option3}
-            formatted_values = "|".join(selected_values)
-            return f"{{{formatted_values}}}"
-        
-        # Replace all occurrences
-        enhanced_template = pattern.sub(replace_match, template)
-        return enhanced_template
+        rs, parts = self._parts(template, pack)
+        if len(parts) == 1:
+            return template
+        rng = rng or _RNG
+        out = list(parts)
+        for i in range(1, len(out), 2):
+            out[i] = self._render(rs, out[i], rng)
+        return "".join(out)
+    
+    def expand(self, template: str, seed: int, pack: Optional[str] = None) -> str:
+        """
+        Sustituye cada clave por un valor concreto elegido con un RNG sembrado con `seed`:
+        la misma plantilla y seed dan siempre el mismo prompt, sin bloques {a|b|c}.
+        """
+        if not template:
+            return template
+        rs, parts = self._parts(template, pack)
+        if len(parts) == 1:
+            return template
+        rng = random.Random(seed)
+        out = list(parts)
+        for i in range(1, len(out), 2):
+            values = rs.replacements.get(out[i]) or (f"!{out[i].upper()}!",)
+            out[i] = rng.choice(values)
+        return "".join(out)
     
     def enhance_prompt(self, prompt: str, style: str = "general") -> str:
         """Enhance prompt with quality modifiers"""
@@ -117,5 +245,9 @@ class PromptGenerator:
         
         return enhanced
 
+def resource_pack_for(chat_id: Optional[int], preset=None) -> Optional[str]:
+    """Pack de recursos de un chat (RESOURCE_CHAT_PACKS) o, si no tiene, el del preset."""
+    return RESOURCE_CHAT_PACKS.get(chat_id) or getattr(preset, "resource_pack", None)
+
 # Global instance for easy access
-prompt_generator = PromptGenerator()
\ No newline at end of file
+prompt_generator = PromptGenerator(RESOURCES_DIR, reload_interval=RESOURCE_RELOAD_INTERVAL)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import jobqueue.jobs as jobs
+from jobqueue.jobs import GenJob, JobQueue
+import aiohttp
+from services.a1111_pool import A1111Backend, A1111Pool
+from services.model_state import ModelTracker
+
+def make_backend(name: str, loaded: str) -> A1111Backend:
+    """Servidor sin HTTP: solo su tracker de modelo y sus slots."""
+    tracker = ModelTracker(lambda: asyncio.sleep(0, loaded))
+    tracker.set(loaded)
+    return A1111Backend(name, None, tracker)
+
+class FakePool(A1111Pool):
+    def __init__(self, *loaded: str):
+        super().__init__([make_backend(f"gpu{i}", model) for i, model in enumerate(loaded)])
+        self.backend = self.backends[0]
+
+@pytest.fixture
+def queue(monkeypatch):
+    async def fake_set_sd_model(model_name, backend=None):
+        backend.tracker.set(model_name)
+        return True
+
+    monkeypatch.setattr(jobs, "QUEUE_JOURNAL", False)
+    monkeypatch.setattr(jobs, "set_sd_model", fake_set_sd_model)
+
+    def make(*loaded: str) -> JobQueue:
+        return JobQueue(pool=FakePool(*loaded))
+    return make
+
+def make_job(user_id: int, model: str) -> GenJob:
+    job = GenJob(user_id=user_id, chat_id=user_id, prompt="1girl", status_message_id=0, user_name=str(user_id))
+    job.target_model = model
+    return job
+
+async def run_queue(jq: JobQueue, pending: list) -> None:
+    """Saca los trabajos en el orden del planificador y carga el checkpoint de cada uno."""
+    for job in pending:
+        await jq.q.put(job)
+    while not jq.q.empty():
+        job = await jq.q.get()
+        await jq._ensure_model(job, {"selected_model": job.target_model}, jq.pool.backend)
+
+def test_shared_loaded_checkpoint_needs_no_swap(queue):
+    jq = queue("modelA")
+    asyncio.run(run_queue(jq, [make_job(1, "modelA"), make_job(2, "modelA")]))
+    stats = jq.stats()
+    assert stats["model_swaps"] == 0
+    assert stats["model_swaps_skipped"] == 2
+
+def test_shared_checkpoint_swaps_once(queue):
+    jq = queue("modelB")
+    asyncio.run(run_queue(jq, [make_job(1, "modelA"), make_job(2, "modelA")]))
+    stats = jq.stats()
+    assert stats["model_swaps"] == 1
+    assert stats["model_swaps_skipped"] == 1
+
+class FakeUploader:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.sent = []
+
+    async def send_file(self, method, field, chat_id, data, filename, caption="", reply_markup=None, content_type="image/png"):
+        if self.fail:
+            raise RuntimeError("Bad Request")
+        self.sent.append(filename)
+        return {"message_id": len(self.sent), "photo": [{"file_id": filename}]}
+
+@pytest.fixture
+def preview_queue(queue, monkeypatch, tmp_path):
+    async def slow_encode(png_bytes, *args):
+        # La primera imagen es la que más tarda en codificarse
+        await asyncio.sleep(0.03 * (3 - int(png_bytes)))
+        return png_bytes
+
+    monkeypatch.setattr(jobs, "DELIVERY_MODE", "preview")
+    monkeypatch.setattr(jobs, "encode_preview_async", slow_encode)
+    monkeypatch.setattr("storage.originals.ORIGINALS_DIR", tmp_path)
+    monkeypatch.setattr("storage.jobs.save_job", lambda message_id, data: None)
+    return queue("modelA")
+
+SPEC = {"prompt": "1girl", "width": 512, "height": 512, "steps": 4, "cfg_scale": 1.0, "sampler_name": "LCM", "scheduler": ""}
+
+def test_previews_keep_image_order(preview_queue, tmp_path):
+    preview_queue.uploader = FakeUploader()
+    res = {"images": [b"0", b"1", b"2"]}
+    asyncio.run(preview_queue._deliver(make_job(1, "modelA"), {}, SPEC, res))
+    assert preview_queue.uploader.sent == ["image_0.jpeg", "image_1.jpeg", "image_2.jpeg"]
+    assert len(list(tmp_path.iterdir())) == 3
+
+def test_failed_send_deletes_original(preview_queue, tmp_path):
+    preview_queue.uploader = FakeUploader(fail=True)
+    with pytest.raises(RuntimeError):
+        asyncio.run(preview_queue._deliver(make_job(1, "modelA"), {}, SPEC, {"images": [b"0", b"1"]}))
+    assert list(tmp_path.iterdir()) == []
+
+def test_stats_report_request_store(queue):
+    jq = queue("modelA")
+    before = jq.stats()["requests"]
+    rid = jobs.put_request({"prompt": "1girl"})
+    assert jobs.get_request(rid) == {"prompt": "1girl"}
+    assert jobs.get_request("missing") is None
+    after = jq.stats()["requests"]
+    assert after["hits"] == before["hits"] + 1
+    assert after["misses"] == before["misses"] + 1
+
+def test_stop_closes_journal(queue, monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, "QUEUE_JOURNAL", True)
+    monkeypatch.setattr(jobs, "DATA_DIR", tmp_path)
+    jq = queue("modelA")
+
+    async def run():
+        jq.journal.add("job", {"prompt": "1girl"})
+        jq.workers.append(asyncio.create_task(asyncio.sleep(3600)))
+        await jq.stop()
+    asyncio.run(run())
+    with pytest.raises(sqlite3.ProgrammingError):
+        len(jq.journal)
+
+def test_failover_loads_checkpoint_and_rebuilds_spec(queue, monkeypatch):
+    jq = queue("modelA", "modelB")
+    monkeypatch.setattr(jobs, "load_user_settings", lambda user_id: {"selected_model": "modelA"})
+    monkeypatch.setattr(jobs, "get_preset_for_model", lambda model: None)
+    calls = []
+
+    async def fake_txt2img(backend, batch, spec, counts):
+        calls.append((backend.name, backend.tracker.current))
+        if backend.name == "gpu0":
+            raise aiohttp.ClientConnectionError("connection refused")
+        return {"images": [b"png"], "info": {}}
+    jq._txt2img = fake_txt2img
+
+    [(job, s, spec, res)] = asyncio.run(jq._generate(make_job(1, "modelA")))
+    assert calls == [("gpu0", "modelA"), ("gpu1", "modelA")]
+    assert res["images"] == [b"png"]
+    stats = jq.stats()
+    assert stats["failovers"] == 1
+    assert stats["model_swaps"] == 1
+    assert [b["model"] for b in stats["backends"]] == ["modelA", "modelA"]
@@ -0,0 +1,96 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from utils.prompt_composer import PromptComposer, parse_tags, preset_composer, prompt_composer, split_tags
+
+class FakePreset:
+    def __init__(self, pre_prompt="", post_prompt=""):
+        self.pre_prompt = pre_prompt
+        self.post_prompt = post_prompt
+
+SETTINGS = {
+    "pre_modifiers": ["masterpiece, best quality"],
+    "post_modifiers": ["film grain"],
+    "loras": ["add_detail"],
+}
+
+PRESET = FakePreset(pre_prompt="(4k, 8k), masterpiece, very aesthetic", post_prompt="absurdres, (Best Quality:1.2)")
+
+def test_sections_in_pipeline_order():
+    out = prompt_composer.compose("1girl, smile", SETTINGS, PRESET)
+    assert out == "(4k, 8k), very aesthetic, masterpiece, best quality, 1girl, smile, film grain, absurdres, <lora:add_detail:1>"
+
+def test_dedup_keeps_first_occurrence():
+    # "Masterpiece" del usuario gana a los modificadores y al preset; "best quality" del
+    # modificador gana al "(Best Quality:1.2)" del preset
+    out = prompt_composer.compose("Masterpiece, 1girl", SETTINGS, PRESET)
+    tags = split_tags(out)
+    assert [t.lower() for t in tags].count("masterpiece") == 1
+    assert tags.index("best quality") < tags.index("Masterpiece")
+    assert "(Best Quality:1.2)" not in tags
+
+def test_dedup_is_exact_not_substring():
+    out = prompt_composer.compose("best quality portrait", {"pre_modifiers": ["quality"]})
+    assert split_tags(out) == ["quality", "best quality portrait"]
+
+def test_user_repetitions_are_kept():
+    assert prompt_composer.compose("cat, cat", {}) == "cat, cat"
+
+def test_lora_weights_merge_by_name():
+    out = prompt_composer.compose("<lora:add_detail:0.6>, 1girl, <LORA:add_detail:0.8>", SETTINGS)
+    assert out.count("add_detail") == 1
+    assert out.endswith("<lora:add_detail:0.6>")
+
+def test_loras_go_last():
+    out = prompt_composer.compose("<lora:style:0.7>, 1girl", SETTINGS, PRESET)
+    assert split_tags(out)[-2:] == ["<lora:style:0.7>", "<lora:add_detail:1>"]
+
+@pytest.mark.parametrize("prompt", [
+    "1girl, smile, cat",
+    "(masterpiece:1.2), 1girl, (4k, 8k), {red|blue, green} hair",
+    "<lora:x:0.5>, 1girl, <lora:x:1>",
+    "1girl, smile <3, cat",
+    "crying :(, rain, cat",
+    "[sketch, lineart",
+    "a, a, , b",
+])
+def test_compose_is_idempotent(prompt):
+    once = prompt_composer.compose(prompt, SETTINGS, PRESET)
+    assert prompt_composer.compose(once, SETTINGS, PRESET) == once
+    assert preset_composer.compose(once, preset=PRESET) == once
+
+@pytest.mark.parametrize("prompt, expected", [
+    ("1girl, smile <3, cat", ["1girl", "smile <3", "cat"]),
+    ("crying :(, rain, cat", ["crying :(", "rain", "cat"]),
+    ("[sketch, lineart, cat", ["[sketch", "lineart", "cat"]),
+    ("a), b, c", ["a)", "b", "c"]),
+])
+def test_unbalanced_brackets_split_on_every_comma(prompt, expected):
+    assert split_tags(prompt) == expected
+
+def test_unbalanced_brackets_still_dedup():
+    out = prompt_composer.compose("smile <3, film grain, crying :(", SETTINGS)
+    assert split_tags(out).count("film grain") == 1
+    assert out.count("<lora:add_detail:1>") == 1
+
+def test_nested_groups_are_one_tag():
+    assert split_tags("a, (b, (c, d)), {e, f|g}, h") == ["a", "(b, (c, d))", "{e, f|g}", "h"]
+
+def test_parse_tags_normalizes():
+    parsed = parse_tags("(Best  Quality:1.2), <lora:X:0.4>, Cat")
+    assert parsed.norms == ("best quality", "cat")
+    assert parsed.lora_norms == ("<lora:x>",)
+
+def test_preset_composer_only_adds_preset():
+    composed = prompt_composer.compose("1girl", SETTINGS)
+    out = preset_composer.compose(composed, {"pre_modifiers": ["new modifier"], "loras": ["newlora"]}, PRESET)
+    assert "new modifier" not in out and "newlora" not in out
+    assert out.startswith("(4k, 8k), very aesthetic, masterpiece")
+
+def test_custom_stages():
+    shout = lambda draft, prompt, settings, preset: draft.post.append("LOUD")
+    assert PromptComposer(stages=(shout,)).compose("ignored") == "LOUD"
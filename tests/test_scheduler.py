@@ -0,0 +1,48 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from jobqueue.scheduler import JobScheduler
+
+class Job:
+    def __init__(self, user_id, target_model, cost=1, priority=0):
+        self.user_id = user_id
+        self.target_model = target_model
+        self.cost = cost
+        self.priority = priority
+
+def drain(jobs, loaded, max_bypass=3):
+    """Saca todos los trabajos cargando el checkpoint de cada uno; devuelve (modelos en orden, cambios)."""
+    state = {"loaded": loaded}
+    scheduler = JobScheduler(lambda model: model == state["loaded"], max_bypass=max_bypass)
+    for job in jobs:
+        scheduler.put_nowait(job)
+
+    async def run():
+        order, swaps = [], 0
+        while not scheduler.empty():
+            job = await scheduler.get()
+            if job.target_model != state["loaded"]:
+                swaps += 1
+                state["loaded"] = job.target_model
+            order.append((job.user_id, job.target_model))
+        return order, swaps
+    return asyncio.run(run())
+
+def test_single_user_alternating_models_are_grouped():
+    order, swaps = drain([Job(1, m) for m in "BABA"], loaded="A")
+    assert [m for _, m in order] == ["A", "A", "B", "B"]
+    assert swaps == 1
+
+def test_single_user_reordering_is_bounded_by_max_bypass():
+    order, swaps = drain([Job(1, m) for m in "BAAA"], loaded="A", max_bypass=1)
+    assert [m for _, m in order] == ["A", "B", "A", "A"]
+    assert swaps == 2
+
+def test_users_still_take_turns():
+    jobs = [Job(1, "A"), Job(1, "A"), Job(1, "A"), Job(2, "A"), Job(2, "A")]
+    order, swaps = drain(jobs, loaded="A")
+    assert [u for u, _ in order] == [1, 2, 1, 2, 1]
+    assert swaps == 0